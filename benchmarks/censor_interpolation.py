@@ -0,0 +1,107 @@
+"""Benchmark censor box interpolation against IC_player/scripts/interpolate.py.
+
+"legacy" is the script's loop, which writes a string-keyed position entry per
+frame; "numpy" and "python" are ``core.interpolation.interpolate`` with and
+without NumPy, which write a packed track. Sizes are of the JSON output.
+
+Usage:
+    uv run benchmarks/censor_interpolation.py [--censors 200] [--minutes 10]
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import random
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "yvideo.settings")
+
+MAX = 1 / 30
+
+
+def stringify(flt):
+    if int(flt) == flt:
+        return str(int(flt))
+    return str(flt)
+
+
+def legacy_interpolate(position):
+    """Interpolation loop of IC_player/scripts/interpolate.py."""
+    tmp_pos_dict = {float(k): v for k, v in position.items()}
+    times = list(sorted(tmp_pos_dict))
+    for t1, t2 in zip(times, times[1:]):
+        tdiff = t2 - t1
+        incr = int(tdiff / MAX)
+        if tdiff <= MAX:
+            continue
+        x1, y1, w1, h1 = tmp_pos_dict[t1]
+        x2, y2, w2, h2 = tmp_pos_dict[t2]
+        xincr = (x2 - x1) / incr
+        yincr = (y2 - y1) / incr
+        wincr = (w2 - w1) / incr
+        hincr = (h2 - h1) / incr
+        for i in range(1, incr):
+            tmid = t1 + i * MAX
+            xmid = x1 + i * xincr
+            ymid = y1 + i * yincr
+            wmid = w1 + i * wincr
+            if xmid + wmid > 100:
+                wmid = 100 - xmid
+            hmid = h1 + i * hincr
+            if ymid + hmid > 100:
+                hmid = 100 - ymid
+            tmp_pos_dict[tmid] = [xmid, ymid, wmid, hmid]
+    return {stringify(t): p for t, p in sorted(tmp_pos_dict.items())}
+
+
+def random_position(duration):
+    """Keyframes every 0.5-5 seconds over ``duration`` seconds."""
+    position = {}
+    t = 0.0
+    while t < duration:
+        position[stringify(round(t, 2))] = [
+            random.uniform(0, 80),
+            random.uniform(0, 80),
+            random.uniform(5, 30),
+            random.uniform(5, 30),
+        ]
+        t += random.uniform(0.5, 5)
+    return position
+
+
+def timed(label, positions, fn):
+    began = time.perf_counter()
+    results = [fn(position) for position in positions]
+    elapsed = time.perf_counter() - began
+    size = len(json.dumps(results))
+    print(f"{label:>7}: {elapsed:8.3f} s  {size / 1024 / 1024:8.2f} MiB of JSON")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--censors", type=int, default=200)
+    parser.add_argument("--minutes", type=float, default=10)
+    args = parser.parse_args()
+
+    import django
+
+    django.setup()
+    from core import interpolation
+
+    random.seed(0)
+    positions = [random_position(args.minutes * 60) for _ in range(args.censors)]
+    timed("legacy", positions, legacy_interpolate)
+    if interpolation.np is not None:
+        timed("numpy", positions, interpolation.interpolate)
+    else:
+        print("  numpy: not installed")
+    with mock.patch.object(interpolation, "np", None):
+        timed("python", positions, interpolation.interpolate)
+
+
+if __name__ == "__main__":
+    main()
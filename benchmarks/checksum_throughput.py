@@ -0,0 +1,74 @@
+"""Benchmark checksum throughput of the old and new upload hashing paths.
+
+"legacy" is the previous 4 KiB read loop, run twice as it was per upload
+(validator and ``File.save``); "mmap" and "buffered" are
+``core.checksums.calculate_checksum`` on a file descriptor and on a
+descriptor-less stream, run once.
+
+Usage:
+    uv run benchmarks/checksum_throughput.py [--size-mb 2048]
+"""
+
+import argparse
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "yvideo.settings")
+
+
+def legacy_checksum(file):
+    """Checksum loop used before core.checksums."""
+    import xxhash
+
+    file.seek(0)
+    file_hash = xxhash.xxh64()
+    for chunk in iter(lambda: file.read(4096), b""):
+        file_hash.update(chunk)
+    file.seek(0)
+    return file_hash.hexdigest()
+
+
+class NoFileno:
+    """Hide the descriptor of a file to force the buffered path."""
+
+    def __init__(self, file):
+        self.read = file.read
+        self.seek = file.seek
+
+
+def timed(label, size, fn, repeat=1):
+    began = time.perf_counter()
+    for _ in range(repeat):
+        digest = fn()
+    elapsed = time.perf_counter() - began
+    print(f"{label:>9}: {size / elapsed / 1024 / 1024:9.1f} MB/s per upload  {digest}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=2048)
+    args = parser.parse_args()
+
+    import django
+
+    django.setup()
+    from core.checksums import calculate_checksum
+
+    with tempfile.TemporaryFile() as media:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            media.write(block)
+        media.flush()
+        size = args.size_mb * 1024 * 1024
+
+        timed("legacy", size, lambda: legacy_checksum(media), repeat=2)
+        timed("mmap", size, lambda: calculate_checksum(media))
+        timed("buffered", size, lambda: calculate_checksum(NoFileno(media)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Load test /stream/ with many slow concurrent video clients.
+
+Each client opens its own connection, requests a byte range and reads it at a
+fixed bitrate, the way a browser buffers a video. The harness reports how
+many clients were served, time to first byte and errors, so a WSGI deployment
+can be compared with an ASGI one serving the same file key.
+
+Start the two servers (gunicorn and uvicorn are not project dependencies):
+    uv run --with gunicorn gunicorn yvideo.wsgi -w 2 --threads 8 -b :8001
+    # with STREAM_ASYNC = True in yvideo/settings.py
+    uv run --with uvicorn uvicorn yvideo.asgi:application --workers 2 --port 8002
+
+Then run:
+    uv run benchmarks/stream_concurrency.py 12 \\
+        --url wsgi=http://localhost:8001 --url asgi=http://localhost:8002 \\
+        --clients 500 --range-mb 4 --kbps 4000
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def client(url, file_key, range_size, bytes_per_second, timeout):
+    """Fetch one range at a capped read rate; return (ttfb, bytes) or raise."""
+    parts = urlsplit(url)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, parts.port or 80), timeout
+    )
+    began = time.perf_counter()
+    try:
+        request = (
+            f"GET /stream/{file_key} HTTP/1.1\r\n"
+            f"Host: {parts.netloc}\r\n"
+            f"Range: bytes=0-{range_size - 1}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(request.encode("ascii"))
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        ttfb = time.perf_counter() - began
+        if b" 206 " not in status_line and b" 200 " not in status_line:
+            raise RuntimeError(status_line.decode(errors="replace").strip())
+        while (await asyncio.wait_for(reader.readline(), timeout)) not in (
+            b"\r\n",
+            b"",
+        ):
+            pass
+
+        received = 0
+        block = max(bytes_per_second // 10, 1)
+        while True:
+            chunk = await asyncio.wait_for(reader.read(block), timeout)
+            if not chunk:
+                break
+            received += len(chunk)
+            # Sleep so the effective read rate matches the client's bitrate
+            expected = received / bytes_per_second
+            elapsed = time.perf_counter() - began - ttfb
+            if expected > elapsed:
+                await asyncio.sleep(expected - elapsed)
+        return ttfb, received
+    finally:
+        writer.close()
+
+
+async def run(label, url, args):
+    range_size = args.range_mb * 1024 * 1024
+    bytes_per_second = args.kbps * 1000 // 8
+    began = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            client(url, args.file_key, range_size, bytes_per_second, args.timeout)
+            for _ in range(args.clients)
+        ),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - began
+
+    served = [r for r in results if not isinstance(r, BaseException)]
+    errors = len(results) - len(served)
+    ttfbs = sorted(ttfb for ttfb, _ in served)
+    total = sum(received for _, received in served)
+    p95 = ttfbs[int(len(ttfbs) * 0.95) - 1] if ttfbs else float("nan")
+    print(
+        f"{label:>6}: served {len(served)}/{args.clients} "
+        f"errors {errors}  ttfb p50 {statistics.median(ttfbs) if ttfbs else float('nan'):.3f}s "
+        f"p95 {p95:.3f}s  {total / elapsed / 1024 / 1024:.1f} MB/s in {elapsed:.1f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file_key", type=int)
+    parser.add_argument(
+        "--url",
+        action="append",
+        required=True,
+        help="label=base URL of a running server; may be repeated",
+    )
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--range-mb", type=int, default=4)
+    parser.add_argument("--kbps", type=int, default=4000, help="client bitrate")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    for target in args.url:
+        label, _, url = target.partition("=")
+        asyncio.run(run(label, url, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Benchmark concurrent Range requests against the media streaming engine.
+
+Compares the previous implementation (read the whole range into memory and
+wrap it in an HttpResponse) with ``core.streaming.serve_file``. Each mode runs
+in its own subprocess so the reported peak RSS is not shared between them.
+
+Usage:
+    uv run benchmarks/stream_ranges.py [--size-mb 512] [--range-mb 8]
+        [--requests 200] [--concurrency 16]
+
+When a response exposes a file descriptor (as it does for gunicorn/uWSGI's
+sendfile-based ``wsgi.file_wrapper``), the body is sent with ``os.sendfile``
+to /dev/null to mimic the server; otherwise the response is iterated.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "yvideo.settings")
+
+
+def legacy_response(path, start, end):
+    """Range handling as done before the streaming engine."""
+    from django.http import HttpResponse
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        content = f.read(end - start + 1)
+    return HttpResponse(content, status=206)
+
+
+def consume(response, devnull):
+    """Send a response body to /dev/null the way a WSGI server would."""
+    filelike = getattr(response, "file_to_stream", None)
+    if filelike is not None and hasattr(filelike, "fileno"):
+        fd = filelike.fileno()
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+        remaining = int(response["Content-Length"])
+        while remaining > 0:
+            sent = os.sendfile(devnull, fd, offset, remaining)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+        response.close()
+        return int(response["Content-Length"])
+    total = 0
+    for chunk in response:
+        total += len(chunk)
+    response.close()
+    return total
+
+
+def run_mode(args):
+    import django
+
+    django.setup()
+    from django.test import RequestFactory
+
+    from core.streaming import serve_file
+
+    factory = RequestFactory()
+    size = os.path.getsize(args.path)
+    range_size = args.range_mb * 1024 * 1024
+    rng = random.Random(0)
+    starts = [rng.randrange(0, size - range_size) for _ in range(args.requests)]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+
+    def one(start):
+        end = start + range_size - 1
+        if args.mode == "legacy":
+            response = legacy_response(args.path, start, end)
+        else:
+            request = factory.get("/", HTTP_RANGE=f"bytes={start}-{end}")
+            response = serve_file(request, args.path, os.path.basename(args.path))
+        return consume(response, devnull)
+
+    began = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        total = sum(pool.map(one, starts))
+    elapsed = time.perf_counter() - began
+
+    print(
+        json.dumps(
+            {
+                "mode": args.mode,
+                "bytes": total,
+                "seconds": elapsed,
+                "mb_per_s": total / elapsed / 1024 / 1024,
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / 1024,
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--range-mb", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mode", choices=["legacy", "engine"])
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=".mp4") as media:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            media.write(block)
+        media.flush()
+        print(
+            f"{args.requests} x {args.range_mb} MiB ranges of a {args.size_mb} MiB "
+            f"file, {args.concurrency} concurrent"
+        )
+        for mode in ("legacy", "engine"):
+            result = subprocess.run(
+                [sys.executable, __file__, *sys.argv[1:], "--mode", mode]
+                + ["--path", media.name],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            stats = json.loads(result.stdout)
+            print(
+                f"{mode:>7}: {stats['mb_per_s']:9.1f} MB/s  "
+                f"peak RSS {stats['peak_rss_mb']:7.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
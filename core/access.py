@@ -0,0 +1,236 @@
+"""Who may watch what: the EffectiveAccess table and its lookups.
+
+A user's role in a collection comes from several places: owning it makes
+them its INSTRUCTOR, a CollectionUserAccess row gives its role, and
+otherwise sharing a course with the collection makes them a STUDENT.
+Resolving that per request takes several joins, so ``refresh`` stores the
+result as one EffectiveAccess row per (user, collection), and
+``collection_role`` reads it back with a single indexed query.
+
+Signal handlers in core.signals refresh the affected users or collections
+after each commit that changes a source. Bulk writes send no signals, so
+code using them (e.g. ``manage.py sync_rosters``) calls ``refresh`` itself.
+``manage.py check_access`` rebuilds the whole table and reports the rows it
+would change.
+
+Whether the role is enough to watch a Content also depends on the flags of
+the collection and content; ``can_view`` checks those, and admins (taking
+``privilege_level_override`` into account) can watch everything.
+``can_view_file`` guards the views serving a File through a FileKey.
+"""
+
+from collections import defaultdict
+from typing import NamedTuple
+
+from django.db import transaction
+
+from .models import Collection
+from .models import CollectionRole
+from .models import CollectionUserAccess
+from .models import Content
+from .models import EffectiveAccess
+from .models import PrivilegeLevel
+from .models import User
+
+# Roles that can watch content before it is published or after it is archived
+EDITOR_ROLES = (CollectionRole.INSTRUCTOR, CollectionRole.TA)
+
+
+class Changes(NamedTuple):
+    """(user id, collection id, role) of rows added, changed and removed."""
+
+    added: list
+    changed: list
+    removed: list
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+
+def scoped(
+    queryset, user_ids, collection_ids, user="user_id", collection="collection_id"
+):
+    if user_ids is not None:
+        queryset = queryset.filter(**{f"{user}__in": user_ids})
+    if collection_ids is not None:
+        queryset = queryset.filter(**{f"{collection}__in": collection_ids})
+    return queryset
+
+
+def compute_access(user_ids=None, collection_ids=None):
+    """Return {(user id, collection id): role} derived from the source tables.
+
+    Only users in ``user_ids`` and collections in ``collection_ids`` are
+    considered; None means all of them.
+    """
+    roles = {}
+    owners = scoped(
+        Collection.objects.values_list("owner_id", "id"),
+        user_ids,
+        collection_ids,
+        user="owner_id",
+        collection="id",
+    )
+    for key in owners:
+        roles[key] = CollectionRole.INSTRUCTOR
+    for user_id, collection_id, role in scoped(
+        CollectionUserAccess.objects.values_list(
+            "user_id", "collection_id", "collection_role"
+        ),
+        user_ids,
+        collection_ids,
+    ):
+        roles.setdefault((user_id, collection_id), role)
+
+    links = Collection.courses.through.objects.all()
+    if user_ids is not None:
+        # Only the links of the users' own courses
+        links = links.filter(
+            course_id__in=User.courses.through.objects.filter(
+                user_id__in=user_ids
+            ).values("course_id")
+        )
+    links = scoped(links, None, collection_ids).values_list(
+        "course_id", "collection_id"
+    )
+    collections_by_course = defaultdict(list)
+    for course_id, collection_id in links:
+        collections_by_course[course_id].append(collection_id)
+    members = scoped(
+        User.courses.through.objects.filter(
+            course_id__in=links.values("course_id")
+        ).values_list("user_id", "course_id"),
+        user_ids,
+        None,
+    )
+    for user_id, course_id in members:
+        for collection_id in collections_by_course[course_id]:
+            roles.setdefault((user_id, collection_id), CollectionRole.STUDENT)
+    return roles
+
+
+def refresh(user_ids=None, collection_ids=None, dry_run=False):
+    """Make EffectiveAccess match the source tables and return the Changes.
+
+    Only rows of users in ``user_ids`` and collections in ``collection_ids``
+    are recomputed; with neither, the whole table is rebuilt. With
+    ``dry_run`` nothing is written.
+    """
+    with transaction.atomic():
+        expected = compute_access(user_ids, collection_ids)
+        current = {
+            (user_id, collection_id): (row_id, role)
+            for row_id, user_id, collection_id, role in scoped(
+                EffectiveAccess.objects.values_list(
+                    "id", "user_id", "collection_id", "role"
+                ),
+                user_ids,
+                collection_ids,
+            )
+        }
+        changes = Changes([], [], [])
+        updated = []
+        for key, role in expected.items():
+            if key not in current:
+                changes.added.append((*key, role))
+            elif current[key][1] != role:
+                changes.changed.append((*key, role))
+                updated.append(EffectiveAccess(id=current[key][0], role=role))
+        removed = []
+        for key, (row_id, role) in current.items():
+            if key not in expected:
+                changes.removed.append((*key, role))
+                removed.append(row_id)
+        if dry_run:
+            return changes
+
+        EffectiveAccess.objects.bulk_create(
+            EffectiveAccess(user_id=user_id, collection_id=collection_id, role=role)
+            for user_id, collection_id, role in changes.added
+        )
+        EffectiveAccess.objects.bulk_update(updated, ["role"])
+        EffectiveAccess.objects.filter(id__in=removed).delete()
+    return changes
+
+
+def refresh_on_commit(user_ids=None, collection_ids=None):
+    """``refresh`` once the current transaction commits.
+
+    Deferring lets cascading deletes finish first, so a refresh never
+    recreates rows for a collection or user about to be deleted.
+    """
+    transaction.on_commit(lambda: refresh(user_ids, collection_ids))
+
+
+def privilege_level(user):
+    if user.privilege_level_override is not None:
+        return user.privilege_level_override
+    return user.privilege_level
+
+
+def collection_roles(user, collection_ids):
+    """Return {collection id: CollectionRole} of the user in those collections."""
+    if not user.is_authenticated or not collection_ids:
+        return {}
+    if privilege_level(user) == PrivilegeLevel.ADMIN:
+        return dict.fromkeys(collection_ids, CollectionRole.INSTRUCTOR)
+    return dict(
+        EffectiveAccess.objects.filter(
+            user_id=user.pk, collection_id__in=collection_ids
+        ).values_list("collection_id", "role")
+    )
+
+
+def collection_role(user, collection_id):
+    """Return the user's CollectionRole in a collection, or None."""
+    return collection_roles(user, [collection_id]).get(collection_id)
+
+
+def is_open(content):
+    """Whether anyone may watch a Content, whatever their role."""
+    collection = content.collection
+    if collection is None:
+        return True
+    return collection.public and is_released(content)
+
+
+def is_released(content):
+    collection = content.collection
+    return collection.published and not collection.archived and content.published
+
+
+def can_view_any(user, contents):
+    """Return whether the user may watch any of ``contents``.
+
+    The contents' collections are used as loaded, so select them with the
+    contents. Roles are read with at most one query.
+    """
+    contents = list(contents)
+    if any(is_open(content) for content in contents):
+        return True
+    roles = collection_roles(user, {content.collection_id for content in contents})
+    for content in contents:
+        role = roles.get(content.collection_id)
+        if role is not None and (is_released(content) or role in EDITOR_ROLES):
+            return True
+    return False
+
+
+def can_view(user, content):
+    """Return whether the user may watch a Content."""
+    return can_view_any(user, [content])
+
+
+def can_view_file(user, file_key_user_id, file_id):
+    """Return whether the user may stream a File through someone's FileKey.
+
+    A FileKey issued to the user is enough, which needs no query; otherwise
+    the user must be an admin or be able to watch a Content of the file.
+    """
+    if user.is_authenticated and (
+        user.pk == file_key_user_id or privilege_level(user) == PrivilegeLevel.ADMIN
+    ):
+        return True
+    return can_view_any(
+        user, Content.objects.filter(file_id=file_id).select_related("collection")
+    )
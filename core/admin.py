@@ -1,20 +1,26 @@
 from django.contrib import admin
+from django.utils import timezone
 from reversion.admin import VersionAdmin
 
 from .models import Annotation
+from .models import AnnotationImport
 from .models import Clip
 from .models import Collection
 from .models import CollectionUserAccess
 from .models import Content
 from .models import Course
+from .models import EffectiveAccess
 from .models import Email
 from .models import File
 from .models import FileKey
+from .models import Job
 from .models import Language
 from .models import Resource
 from .models import ResourceAccess
 from .models import Subtitle
+from .models import Upload
 from .models import User
+from .models import WatchHistogram
 
 
 @admin.register(User)
@@ -54,10 +60,28 @@ class CollectionAdmin(VersionAdmin):
 
 @admin.register(File)
 class FileAdmin(VersionAdmin):
-    list_display = ("file", "resource", "version", "full_video", "created_at")
-    list_filter = ("full_video", "created_at")
+    list_display = (
+        "file",
+        "resource",
+        "version",
+        "full_video",
+        "processing",
+        "created_at",
+    )
+    list_filter = ("full_video", "jobs__status", "created_at")
     search_fields = ("file", "version", "resource__name")
-    readonly_fields = ("checksum", "checksum_at")
+    readonly_fields = ("checksum", "checksum_at", "duration")
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related("jobs")
+
+    @admin.display(description="Processing")
+    def processing(self, obj):
+        """Latest status of each background job kind for the file."""
+        latest = {}
+        for job in sorted(obj.jobs.all(), key=lambda job: job.id):
+            latest[job.kind] = job.get_status_display()
+        return ", ".join(f"{kind}: {status}" for kind, status in latest.items())
 
 
 @admin.register(Content)
@@ -125,6 +149,12 @@ class AnnotationAdmin(VersionAdmin):
     search_fields = ("name", "owner__name", "owner__netid", "file__resource__name")
 
 
+@admin.register(AnnotationImport)
+class AnnotationImportAdmin(admin.ModelAdmin):
+    list_display = ("path", "annotations", "checksum", "created_at")
+    search_fields = ("path", "checksum")
+
+
 @admin.register(Clip)
 class ClipAdmin(VersionAdmin):
     list_display = ("name", "owner", "file", "start_time", "end_time", "created_at")
@@ -171,8 +201,50 @@ class CollectionUserAccessAdmin(VersionAdmin):
     search_fields = ("user__netid", "collection__name")
 
 
+@admin.register(EffectiveAccess)
+class EffectiveAccessAdmin(admin.ModelAdmin):
+    list_display = ("user", "collection", "role")
+    list_filter = ("role",)
+    search_fields = ("user__netid", "collection__name")
+
+    # Maintained by core.access; run manage.py check_access --fix to repair
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(FileKey)
 class FileKeyAdmin(VersionAdmin):
     list_display = ("user", "file", "created_at")
     list_filter = ("created_at",)
     search_fields = ("user__netid", "file__resource__name")
+
+
+@admin.register(Upload)
+class UploadAdmin(admin.ModelAdmin):
+    list_display = ("filename", "resource", "version", "owner", "offset", "size")
+    list_filter = ("created_at",)
+    search_fields = ("filename", "resource__name", "owner__netid")
+    readonly_fields = ("offset", "file")
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("kind", "file", "status", "attempts", "worker", "updated_at")
+    list_filter = ("status", "kind", "created_at")
+    search_fields = ("kind", "file__resource__name", "worker")
+    readonly_fields = ("attempts", "error", "worker", "started_at", "finished_at")
+    actions = ("retry",)
+
+    @admin.action(description="Retry selected jobs")
+    def retry(self, request, queryset):
+        queryset.update(status=Job.Status.QUEUED, run_after=timezone.now())
+
+
+@admin.register(WatchHistogram)
+class WatchHistogramAdmin(admin.ModelAdmin):
+    list_display = ("content", "plays", "bucket_seconds", "updated_at")
+    search_fields = ("content__title",)
+    readonly_fields = ("content", "bucket_seconds", "watch_seconds", "seeks", "plays")
@@ -0,0 +1,187 @@
+"""Playback analytics: compact event storage and watch-time rollups.
+
+The player posts batches of heartbeat, seek, play, pause and ended events.
+They are stored without touching the database, as fixed-size binary records
+appended to hourly partitions: ``ANALYTICS_DIR/<YYYYMMDDHH>/<host>-<pid>.bin``.
+Each process appends to its own file with one write per batch, so ingestion
+needs no locks. ``manage.py rollup_analytics`` aggregates complete partitions
+into a WatchHistogram per Content and removes them.
+"""
+
+from collections import defaultdict
+import os
+import shutil
+import socket
+import struct
+import time
+
+from django.conf import settings
+from django.db import transaction
+import xxhash
+
+from .models import Content
+from .models import WatchHistogram
+
+# timestamp, content id, viewer hash, kind, position, value (seek target)
+RECORD = struct.Struct("<IIIBff")
+
+HEARTBEAT = 1
+SEEK = 2
+PLAY = 3
+PAUSE = 4
+ENDED = 5
+KINDS = {
+    "heartbeat": HEARTBEAT,
+    "seek": SEEK,
+    "play": PLAY,
+    "pause": PAUSE,
+    "ended": ENDED,
+}
+
+PARTITION_FORMAT = "%Y%m%d%H"
+
+
+class InvalidEvents(ValueError):
+    """Raised for malformed event batches."""
+
+
+def partition_name(timestamp):
+    return time.strftime(PARTITION_FORMAT, time.gmtime(timestamp))
+
+
+def in_range(position):
+    return 0 <= position <= settings.ANALYTICS_MAX_POSITION
+
+
+def encode_events(content_id, viewer, events, now):
+    """Pack a batch of event dicts (``type``, ``t`` and, for seeks, ``to``)."""
+    if not isinstance(events, list) or len(events) > settings.ANALYTICS_MAX_BATCH:
+        raise InvalidEvents(
+            f"Expected a list of at most {settings.ANALYTICS_MAX_BATCH} events"
+        )
+    viewer_hash = xxhash.xxh32(str(viewer).encode()).intdigest()
+    records = bytearray()
+    for event in events:
+        try:
+            kind = KINDS[event["type"]]
+            position = float(event["t"])
+            value = float(event.get("to", 0))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise InvalidEvents(f"Invalid event: {event!r}")
+        if not (in_range(position) and in_range(value)):
+            raise InvalidEvents(f"Invalid position: {event!r}")
+        try:
+            records += RECORD.pack(
+                int(now), content_id, viewer_hash, kind, position, value
+            )
+        except (OverflowError, struct.error):
+            raise InvalidEvents(f"Invalid event: {event!r}")
+    return bytes(records)
+
+
+def append_events(content_id, viewer, events):
+    """Append a batch of events to this process's file in the current partition."""
+    now = time.time()
+    records = encode_events(content_id, viewer, events, now)
+    if not records:
+        return 0
+    directory = os.path.join(settings.ANALYTICS_DIR, partition_name(now))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{socket.gethostname()}-{os.getpid()}.bin")
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, records)
+    finally:
+        os.close(fd)
+    return len(records) // RECORD.size
+
+
+def complete_partitions(now=None):
+    """Return the paths of partitions no longer being written to, oldest first."""
+    if not os.path.isdir(settings.ANALYTICS_DIR):
+        return []
+    current = partition_name(time.time() if now is None else now)
+    return [
+        os.path.join(settings.ANALYTICS_DIR, name)
+        for name in sorted(os.listdir(settings.ANALYTICS_DIR))
+        if name.isdigit() and name < current
+    ]
+
+
+def read_partition(path):
+    """Yield the records of every file in a partition."""
+    for name in sorted(os.listdir(path)):
+        with open(os.path.join(path, name), "rb") as f:
+            data = f.read()
+        # Ignore a torn record at the end of a file
+        usable = len(data) - len(data) % RECORD.size
+        yield from RECORD.iter_unpack(memoryview(data)[:usable])
+
+
+def aggregate(records):
+    """Return {content id: {"watch": {bucket: seconds}, "seeks": {bucket: n}, "plays": n}}."""
+    bucket_seconds = settings.ANALYTICS_BUCKET_SECONDS
+    heartbeat = settings.ANALYTICS_HEARTBEAT_SECONDS
+    totals = defaultdict(
+        lambda: {"watch": defaultdict(float), "seeks": defaultdict(int), "plays": 0}
+    )
+    for _, content_id, _, kind, position, value in records:
+        if not (in_range(position) and in_range(value)):
+            # Written before the limit was lowered, or corrupt
+            continue
+        stats = totals[content_id]
+        if kind == HEARTBEAT:
+            # A heartbeat stands for the interval of playback before it
+            stats["watch"][int(position // bucket_seconds)] += heartbeat
+        elif kind == SEEK:
+            stats["seeks"][int(value // bucket_seconds)] += 1
+        elif kind == PLAY:
+            stats["plays"] += 1
+    return totals
+
+
+def add_counts(counts, additions):
+    """Add a {bucket: amount} dict to a histogram list, growing it as needed.
+
+    Buckets outside the histogram of ANALYTICS_MAX_POSITION seconds are skipped.
+    """
+    size = settings.ANALYTICS_MAX_POSITION // settings.ANALYTICS_BUCKET_SECONDS + 1
+    additions = {b: amount for b, amount in additions.items() if 0 <= b < size}
+    if additions:
+        counts.extend([0] * (max(additions) + 1 - len(counts)))
+        for bucket, amount in additions.items():
+            counts[bucket] += amount
+    return counts
+
+
+def rollup(partitions):
+    """Merge the events of ``partitions`` into WatchHistograms and delete them."""
+    totals = aggregate(
+        record for partition in partitions for record in read_partition(partition)
+    )
+    bucket_seconds = settings.ANALYTICS_BUCKET_SECONDS
+    content_ids = set(
+        Content.objects.filter(id__in=totals).values_list("id", flat=True)
+    )
+    with transaction.atomic():
+        histograms = {
+            histogram.content_id: histogram
+            for histogram in WatchHistogram.objects.select_for_update().filter(
+                content_id__in=content_ids
+            )
+        }
+        for content_id in content_ids:
+            histogram = histograms.get(content_id)
+            if histogram is None or histogram.bucket_seconds != bucket_seconds:
+                # Start over when the bucket size changed
+                histogram = histogram or WatchHistogram(content_id=content_id)
+                histogram.bucket_seconds = bucket_seconds
+                histogram.watch_seconds, histogram.seeks, histogram.plays = [], [], 0
+            stats = totals[content_id]
+            add_counts(histogram.watch_seconds, stats["watch"])
+            add_counts(histogram.seeks, stats["seeks"])
+            histogram.plays += stats["plays"]
+            histogram.save()
+    for partition in partitions:
+        shutil.rmtree(partition)
+    return len(content_ids)
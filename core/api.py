@@ -1,51 +1,302 @@
 # This file defines the functions used to request data from OIT's APIs
+#
+# All requests go through one pooled requests.Session per process, so
+# connections (and their TLS handshakes) are kept alive and reused between
+# calls. Requests time out after API_TIMEOUT and are retried with exponential
+# backoff on connection errors and 429/5xx responses. Independent lookups can
+# run concurrently with Api.concurrently (see Api.get_login_details). The
+# bearer token is cached in-process and refreshed shortly before it expires
+# (see get_auth_token). Lookups are cached with per-lookup TTLs in Django's
+# cache, which every process sees (see cached).
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
+import functools
+import json
+import logging
+import os
+import threading
+import time
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db import transaction
+from django.utils import timezone
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import xxhash
 
 import yvideo.secret_settings as secret_settings
 
 from .models import AuthToken
 
+logger = logging.getLogger(__name__)
 
-class Api:
-    def __init__(self):
-        auth_tokens = AuthToken.objects.all()
-        auth_tokens_count = len(list(auth_tokens))
+_session = None
+_executor = None
+_pid = None
+_lock = threading.Lock()
 
-        # don't allow auth token to be older than 1 hour
-        oldest_valid_time = datetime.now() - timedelta(hours=1)
+# (token, expiry) of the OIT bearer token, shared by all Api instances
+_auth_token = None
+_auth_token_lock = threading.Lock()
+TOKEN_REFRESH_LOCK = "core.api.token-refresh"
 
-        # filter for tokens that have a creation date greater than (__gt) the oldest valid time
-        valid_auth_tokens = AuthToken.objects.filter(created_at__gt=oldest_valid_time)
-        valid_auth_tokens_count = len(list(valid_auth_tokens))
+CACHE_PREFIX = "core.api"
+CACHE_VERSION_KEY = f"{CACHE_PREFIX}:version"
 
-        if auth_tokens_count == 1 and valid_auth_tokens_count == 1:
-            # there is only one token, and it is valid
-            self.auth_token = auth_tokens.first().token
-        else:
-            # there are either more than 1 token, or that token is invalid
-            # either way, delete everything and generate a new token
-            auth_tokens.delete()
-            auth_token = self.generate_auth_token()
-            self.auth_token = AuthToken.objects.create(token=auth_token).token
-
-    def generate_auth_token(self):
-        # request an auth token from OIT's auth token granting endpoint
-        token_request = requests.post(
-            secret_settings.API_AUTH_TOKEN_URL,
-            data={"grant_type": "client_credentials"},
-            auth=(secret_settings.API_CLIENT_ID, secret_settings.API_CLIENT_SECRET),
-        )
-        token_json_result = token_request.json()
-        return token_json_result["access_token"]
+
+def _reset_after_fork():
+    # forked children must not share the parent's sockets, and threads do
+    # not survive a fork
+    global _session, _executor, _pid
+    if _pid != os.getpid():
+        _session, _executor, _pid = None, None, os.getpid()
+
+
+def session():
+    global _session
+    with _lock:
+        _reset_after_fork()
+        if _session is None:
+            retry = Retry(
+                total=settings.API_RETRIES,
+                backoff_factor=settings.API_RETRY_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=None,
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=settings.API_POOL_SIZE,
+                pool_maxsize=settings.API_POOL_SIZE,
+                max_retries=retry,
+            )
+            _session = requests.Session()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def executor():
+    global _executor
+    with _lock:
+        _reset_after_fork()
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                settings.API_MAX_CONCURRENCY, thread_name_prefix="oit-api"
+            )
+        return _executor
+
+
+def request_auth_token():
+    # request an auth token from OIT's auth token granting endpoint and
+    # return it with its expiry time
+    token_request = session().post(
+        secret_settings.API_AUTH_TOKEN_URL,
+        data={"grant_type": "client_credentials"},
+        auth=(secret_settings.API_CLIENT_ID, secret_settings.API_CLIENT_SECRET),
+        timeout=settings.API_TIMEOUT,
+    )
+    token_json_result = token_request.json()
+    lifetime = token_json_result.get("expires_in", settings.API_TOKEN_LIFETIME)
+    expires_at = timezone.now() + timedelta(seconds=int(lifetime))
+    return token_json_result["access_token"], expires_at
+
+
+def needs_refresh(expires_at):
+    # tokens are replaced API_TOKEN_REFRESH_MARGIN seconds before they
+    # expire, so requests never go out with an expired one
+    margin = timedelta(seconds=settings.API_TOKEN_REFRESH_MARGIN)
+    return timezone.now() >= expires_at - margin
+
+
+def load_auth_token():
+    # the newest token saved by any process, or None
+    auth_token = AuthToken.objects.exclude(token=None).order_by("-created_at").first()
+    if auth_token is None:
+        return None
+    expires_at = auth_token.expires_at or auth_token.created_at + timedelta(
+        seconds=settings.API_TOKEN_LIFETIME
+    )
+    return auth_token.token, expires_at
+
+
+def refresh_auth_token():
+    token, expires_at = request_auth_token()
+    with transaction.atomic():
+        AuthToken.objects.all().delete()
+        AuthToken.objects.create(token=token, expires_at=expires_at)
+    return token, expires_at
+
+
+def load_or_refresh_auth_token(current):
+    # only one process refreshes at a time, holding a lock in the shared
+    # cache. Others keep using a token that has not expired yet, or wait for the new one.
+    stored = load_auth_token()
+    if stored and not needs_refresh(stored[1]):
+        return stored
+    usable = [t for t in (stored, current) if t and t[1] > timezone.now()]
+    usable = max(usable, key=lambda t: t[1], default=None)
+    deadline = time.monotonic() + settings.API_TOKEN_REFRESH_WAIT
+    while True:
+        if cache.add(TOKEN_REFRESH_LOCK, os.getpid(), settings.API_TOKEN_REFRESH_WAIT):
+            try:
+                return refresh_auth_token()
+            finally:
+                cache.delete(TOKEN_REFRESH_LOCK)
+        if usable:
+            return usable
+        if time.monotonic() >= deadline:
+            # the refreshing process seems to have died
+            return refresh_auth_token()
+        time.sleep(0.1)
+        stored = load_auth_token()
+        if stored and not needs_refresh(stored[1]):
+            return stored
+
+
+def get_auth_token():
+    # the bearer token, cached in this process until it is due for refresh;
+    # the database is only read on a cold start or when a refresh is due
+    global _auth_token
+    token = _auth_token
+    if token is None or needs_refresh(token[1]):
+        with _auth_token_lock:
+            if _auth_token is None or needs_refresh(_auth_token[1]):
+                _auth_token = load_or_refresh_auth_token(_auth_token)
+            token = _auth_token
+    return token[0]
+
+
+def cache_key(name, args):
+    # keys include a version, so invalidate_all() drops every entry at once.
+    # Reading it never writes, so a cold cache costs no extra round trip
+    version = cache.get(CACHE_VERSION_KEY, 1)
+    digest = xxhash.xxh64(json.dumps(args).encode()).hexdigest()
+    return f"{CACHE_PREFIX}:{version}:{name}:{digest}"
+
+
+def cached(name):
+    # cache a lookup's results for API_CACHE_TTLS[name] seconds.
+    #
+    # Entries are kept for a second TTL after they go stale. Only the caller
+    # that takes the refresh lock goes to the network; the others keep
+    # getting the stale value meanwhile (or wait for it when there is none),
+    # so an expiring popular entry costs one request, not one per caller.
+    # The stale value is also returned if the refresh fails.
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            ttl = settings.API_CACHE_TTLS.get(name)
+            if not ttl:
+                return method(self, *args)
+            key = cache_key(name, args)
+            entry = cache.get(key)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+
+            lock_key = f"{key}:lock"
+            deadline = time.monotonic() + settings.API_CACHE_LOCK_TIMEOUT
+            while not cache.add(lock_key, 1, settings.API_CACHE_LOCK_TIMEOUT):
+                if entry is not None:
+                    return entry[1]
+                if time.monotonic() >= deadline:
+                    return method(self, *args)
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry is not None:
+                    return entry[1]
+            try:
+                value = method(self, *args)
+            except requests.RequestException:
+                if entry is None:
+                    raise
+                logger.warning("Serving stale %s after a failed refresh", name)
+                return entry[1]
+            else:
+                cache.set(key, (time.time() + ttl, value), ttl * 2)
+            finally:
+                cache.delete(lock_key)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate(name, *args):
+    # drop the cached result of one lookup, e.g.
+    # invalidate("student_enrollments", net_id, yearterm)
+    cache.delete(cache_key(name, args))
+
+
+def invalidate_all():
+    try:
+        cache.incr(CACHE_VERSION_KEY)
+    except ValueError:
+        # entries were keyed with the default version
+        cache.add(CACHE_VERSION_KEY, 2, None)
+
+
+def call_in_thread(func, *args):
+    # executor threads live on after the call, so close the database
+    # connections (token, cache) they opened instead of keeping one per thread
+    try:
+        return func(*args)
+    finally:
+        connections.close_all()
+
+
+class Api:
+    @property
+    def auth_token(self):
+        return get_auth_token()
 
     def build_auth_header(self):
         auth_header = f"Bearer {self.auth_token}"
         return auth_header
 
+    def get_json(self, url, params=None):
+        # GET an OIT endpoint with the auth header and return its JSON body
+        headers = {"Authorization": self.build_auth_header()}
+        response = session().get(
+            url, params=params, headers=headers, timeout=settings.API_TIMEOUT
+        )
+        return response.json()
+
+    def concurrently(self, *calls):
+        # run independent lookups in parallel, given as (function, *args)
+        # tuples, and return their results in order; the total latency is
+        # that of the slowest call instead of the sum of all of them. The token
+        # is fetched first so the calls never refresh it from other threads.
+        get_auth_token()
+        futures = [executor().submit(call_in_thread, *call) for call in calls]
+        return [future.result() for future in futures]
+
+    def get_login_details(self, byu_id, net_id, yearterm=None):
+        # everything needed to set up a user at login. The student summary,
+        # enrollments and worker id lookups run in one concurrent round;
+        # only employees need a second request for their worker summary.
+        if yearterm is None:
+            yearterm = self.get_current_year_term()["yearterm"]
+        student_summary, enrollments, worker_id = self.concurrently(
+            (self.get_student_summary, byu_id),
+            (self.get_student_enrollments, net_id, yearterm),
+            (self.get_worker_id_from_byu_id, byu_id),
+        )
+        worker_summary = None
+        if worker_id:
+            worker_summary = self.get_worker_summary(worker_id, byu_id)
+        return {
+            "student_summary": student_summary,
+            "worker_summary": worker_summary,
+            "enrollments": enrollments,
+            "yearterm": yearterm,
+        }
+
     def calculate_next_year_term(self, yearterm_string):
         year_string = yearterm_string[:4]
         term_string = yearterm_string[4:]
@@ -70,16 +321,17 @@ class Api:
 
         return new_year_string + new_term_string
 
+    @cached("year_terms")
+    def get_year_terms(self):
+        # get yearterm information
+        control_date_json_response = self.get_json(secret_settings.API_YEARTERM_URL)
+        return control_date_json_response["data"]
+
     def get_current_year_term(self):
         # to determine current year term, we have to compare to today's date
         today_datetime = datetime.today().strftime("%Y-%m-%dT%H:%M:%S")
 
-        # get yearterm information
-        url = secret_settings.API_YEARTERM_URL
-        headers = {"Authorization": self.build_auth_header()}
-        control_date_request = requests.get(url, headers=headers)
-        control_date_json_response = control_date_request.json()
-        response_data = control_date_json_response["data"]
+        response_data = self.get_year_terms()
 
         # determine which yearterm corresponds to current datetime
         yearterm = None
@@ -101,11 +353,11 @@ class Api:
 
         return {"yearterm": yearterm, "is_two_weeks_from_end": is_two_weeks_from_end}
 
+    @cached("worker_id")
     def get_worker_id_from_byu_id(self, byu_id):
-        url = secret_settings.API_WORKER_ID_IAM_URL + "?byu_id=" + byu_id
-        headers = {"Authorization": self.build_auth_header()}
-        worker_id_request = requests.get(url, headers=headers)
-        worker_id_json_response = worker_id_request.json()
+        worker_id_json_response = self.get_json(
+            secret_settings.API_WORKER_ID_IAM_URL, {"byu_id": byu_id}
+        )
         response_data = worker_id_json_response["data"]
         worker_id = None
         if len(response_data) > 0:
@@ -114,11 +366,11 @@ class Api:
         return worker_id
 
     # byu_id is passed into this so we can record it later. byu_id does not return in the response.
+    @cached("worker_summary")
     def get_worker_summary(self, worker_id, byu_id):
-        url = secret_settings.API_WORKER_SUMMARY_URL + "?worker_id=" + worker_id
-        headers = {"Authorization": self.build_auth_header()}
-        summary_request = requests.get(url, headers=headers)
-        summary_json_res = summary_request.json()
+        summary_json_res = self.get_json(
+            secret_settings.API_WORKER_SUMMARY_URL, {"worker_id": worker_id}
+        )
         response_data = summary_json_res["data"]
         parsed_summary = {
             "first_name": "",
@@ -152,11 +404,11 @@ class Api:
         else:
             return None
 
+    @cached("student_summary")
     def get_student_summary(self, byu_id):
-        url = secret_settings.API_STUDENT_SUMMARY_URL + "?byu_id=" + byu_id
-        headers = {"Authorization": self.build_auth_header()}
-        summary_request = requests.get(url, headers=headers)
-        summary_json_res = summary_request.json()
+        summary_json_res = self.get_json(
+            secret_settings.API_STUDENT_SUMMARY_URL, {"byu_id": byu_id}
+        )
         data = summary_json_res["data"]
         if data:
             data = data[0]
@@ -173,17 +425,12 @@ class Api:
         else:
             return None
 
+    @cached("student_enrollments")
     def get_student_enrollments(self, net_id, yearterm):
-        url = (
-            secret_settings.API_STUDENT_ENROLLMENTS_URL
-            + "?net_id="
-            + net_id
-            + "&year_term="
-            + yearterm
+        records_json_res = self.get_json(
+            secret_settings.API_STUDENT_ENROLLMENTS_URL,
+            {"net_id": net_id, "year_term": yearterm},
         )
-        headers = {"Authorization": self.build_auth_header()}
-        records_request = requests.get(url, headers=headers)
-        records_json_res = records_request.json()
         records_data = records_json_res["data"]
         if records_data:
             parsed_records = []
@@ -0,0 +1,99 @@
+"""Compute xxhash64 checksums of uploaded and stored media files.
+
+Files backed by a file descriptor (temporary uploads, stored media) are hashed
+through ``mmap``; anything else is read in ``CHECKSUM_BUFFER_SIZE`` blocks.
+The digest is cached on the file object, so the uniqueness validator and
+``File.save`` hash each upload only once.
+"""
+
+import io
+import mmap
+
+from django.conf import settings
+from django.utils import timezone
+import xxhash
+
+CACHE_ATTRIBUTE = "_xxh64_checksum"
+
+
+def _fileno(file):
+    """Return the OS file descriptor backing ``file``, or None."""
+    while file is not None:
+        try:
+            return file.fileno()
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            file = getattr(file, "file", None)
+    return None
+
+
+def _hash_fd(fd, buffer_size):
+    file_hash = xxhash.xxh64()
+    try:
+        mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty files cannot be mapped
+        return file_hash.hexdigest()
+    with mapped:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for offset in range(0, len(view), buffer_size):
+                file_hash.update(view[offset : offset + buffer_size])
+    return file_hash.hexdigest()
+
+
+def _hash_stream(file, buffer_size):
+    file_hash = xxhash.xxh64()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(buffer_size), b""):
+        file_hash.update(chunk)
+    file.seek(0)  # Reset the file pointer for subsequent reads
+    return file_hash.hexdigest()
+
+
+def calculate_checksum(file):
+    """Calculate and return the xxhash64 checksum of a file-like object."""
+    buffer_size = settings.CHECKSUM_BUFFER_SIZE
+    fd = _fileno(file)
+    if fd is not None:
+        return _hash_fd(fd, buffer_size)
+    return _hash_stream(file, buffer_size)
+
+
+def cached_checksum(file):
+    """Return the checksum already known for ``file``, or None."""
+    return getattr(file, CACHE_ATTRIBUTE, None)
+
+
+def get_checksum(file):
+    """Return the checksum of ``file``, computing it at most once per object."""
+    if not file:
+        return None
+    checksum = cached_checksum(file)
+    if checksum is None:
+        checksum = calculate_checksum(file)
+        set_checksum(file, checksum)
+    return checksum
+
+
+def set_checksum(file, checksum):
+    """Record an already known checksum for ``file`` (e.g. hashed while uploading)."""
+    setattr(file, CACHE_ATTRIBUTE, checksum)
+
+
+def update_stored_checksum(file_obj):
+    """Hash a stored File and save its checksum.
+
+    Raises ValueError if another File already has the same content.
+    """
+    with file_obj.file.open("rb"):
+        checksum = calculate_checksum(file_obj.file)
+    files = type(file_obj).objects
+    duplicate = files.filter(checksum=checksum).exclude(pk=file_obj.pk).first()
+    if duplicate:
+        raise ValueError(f"Same content as {duplicate.file.name}")
+    file_obj.checksum = checksum
+    file_obj.checksum_at = timezone.now()
+    files.filter(pk=file_obj.pk).update(
+        checksum=file_obj.checksum, checksum_at=file_obj.checksum_at
+    )
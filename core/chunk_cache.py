@@ -0,0 +1,221 @@
+"""Local disk cache of media blocks for files on slow or network storage.
+
+With ``STREAM_CHUNK_CACHE`` enabled, streamed files are read in aligned
+blocks of ``STREAM_CHUNK_SIZE`` bytes. Blocks within the first
+``STREAM_CHUNK_CACHE_HEAD`` bytes of a file (where every viewer starts) are
+kept in ``STREAM_CHUNK_CACHE_DIR`` on first read; other blocks once this
+process has read them ``STREAM_CHUNK_CACHE_MIN_READS`` times. Blocks are keyed
+by the file's ETag, so changed content never hits stale blocks, and written
+atomically, so all worker processes share the cache. Least recently used
+blocks are evicted when the cache outgrows ``STREAM_CHUNK_CACHE_MAX_SIZE``.
+
+Hit/miss counters are kept per process and added to a small SQLite database
+in the cache directory whenever a response finishes; ``stats()`` reads the
+totals.
+"""
+
+import asyncio
+from collections import Counter
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+
+from django.conf import settings
+import xxhash
+
+STATS = ("hits", "misses", "bytes_from_cache", "bytes_from_source", "stored", "evicted")
+
+# Popularity counts kept before they are reset, bounding memory
+MAX_TRACKED_BLOCKS = 100_000
+
+_reads = Counter()
+_stats = Counter()
+_lock = threading.Lock()
+_stored_since_eviction = 0
+_local = threading.local()
+
+
+def block_path(cache_key, index):
+    digest = xxhash.xxh64(cache_key.encode()).hexdigest()
+    return os.path.join(
+        settings.STREAM_CHUNK_CACHE_DIR, digest[:2], digest, f"{index}.block"
+    )
+
+
+def should_store(cache_key, index):
+    """Return whether a block read from the source is worth caching."""
+    if index * settings.STREAM_CHUNK_SIZE < settings.STREAM_CHUNK_CACHE_HEAD:
+        return True
+    with _lock:
+        if len(_reads) > MAX_TRACKED_BLOCKS:
+            _reads.clear()
+        _reads[cache_key, index] += 1
+        return _reads[cache_key, index] >= settings.STREAM_CHUNK_CACHE_MIN_READS
+
+
+def store(path, data):
+    global _stored_since_eviction
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    with _lock:
+        _stats["stored"] += 1
+        _stored_since_eviction += len(data)
+        evict_now = _stored_since_eviction > settings.STREAM_CHUNK_CACHE_MAX_SIZE / 10
+        if evict_now:
+            _stored_since_eviction = 0
+    if evict_now:
+        evict()
+
+
+def evict():
+    """Remove least recently used blocks until the cache is within 90% of its size."""
+    blocks = []
+    for root, _, names in os.walk(settings.STREAM_CHUNK_CACHE_DIR):
+        for name in names:
+            if name.endswith(".block"):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                blocks.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in blocks)
+    target = settings.STREAM_CHUNK_CACHE_MAX_SIZE * 0.9
+    evicted = 0
+    for _, size, path in sorted(blocks):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+    with _lock:
+        _stats["evicted"] += evicted
+
+
+def remove(cache_key):
+    """Remove the cached blocks of ``cache_key``, e.g. after its file changed in place."""
+    shutil.rmtree(os.path.dirname(block_path(cache_key, 0)), ignore_errors=True)
+
+
+class BlockReader:
+    """Reads blocks of one file through the cache, opening the source only on misses."""
+
+    def __init__(self, path, cache_key):
+        self.path = path
+        self.cache_key = cache_key
+        self.fd = None
+
+    def read_block(self, index):
+        cached_path = block_path(self.cache_key, index)
+        try:
+            with open(cached_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            pass
+        else:
+            # Mark as recently used for eviction
+            os.utime(cached_path)
+            with _lock:
+                _stats["hits"] += 1
+                _stats["bytes_from_cache"] += len(data)
+            return data
+
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        block_size = settings.STREAM_CHUNK_SIZE
+        data = os.pread(self.fd, block_size, index * block_size)
+        with _lock:
+            _stats["misses"] += 1
+            _stats["bytes_from_source"] += len(data)
+        if data and should_store(self.cache_key, index):
+            store(cached_path, data)
+        return data
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        flush_stats()
+
+
+def block_slices(start, length):
+    """Yield (block index, start, end) slices covering ``length`` bytes from ``start``."""
+    block_size = settings.STREAM_CHUNK_SIZE
+    end = start + length
+    while start < end:
+        index, offset = divmod(start, block_size)
+        stop = min(block_size, offset + end - start)
+        yield index, offset, stop
+        start += stop - offset
+
+
+def iter_range(path, cache_key, start, length):
+    """Yield ``length`` bytes of ``path`` from ``start``, reading through the cache."""
+    reader = BlockReader(path, cache_key)
+    try:
+        for index, offset, stop in block_slices(start, length):
+            data = reader.read_block(index)
+            if len(data) <= offset:
+                break
+            yield data[offset:stop]
+    finally:
+        reader.close()
+
+
+async def aiter_range(path, cache_key, start, length):
+    """Async iter_range; block reads and the final close run in worker threads."""
+    reader = BlockReader(path, cache_key)
+    try:
+        for index, offset, stop in block_slices(start, length):
+            data = await asyncio.to_thread(reader.read_block, index)
+            if len(data) <= offset:
+                break
+            yield data[offset:stop]
+    finally:
+        # Flushing the stats writes to SQLite
+        await asyncio.to_thread(reader.close)
+
+
+def connection():
+    path = os.path.join(settings.STREAM_CHUNK_CACHE_DIR, "stats.sqlite3")
+    conn = getattr(_local, "connection", None)
+    if conn is None or _local.path != path:
+        os.makedirs(settings.STREAM_CHUNK_CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=wal")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        _local.connection, _local.path = conn, path
+    return conn
+
+
+def flush_stats():
+    """Add this process's counters to the shared totals."""
+    with _lock:
+        counts = dict(_stats)
+        _stats.clear()
+    if not counts:
+        return
+    conn = connection()
+    conn.executemany(
+        "INSERT INTO stats (name, value) VALUES (?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+        counts.items(),
+    )
+
+
+def stats():
+    """Return the cache's hit/miss totals across processes."""
+    flush_stats()
+    values = dict.fromkeys(STATS, 0)
+    values.update(connection().execute("SELECT name, value FROM stats").fetchall())
+    return values
@@ -0,0 +1,73 @@
+"""Pre-cut media for clips.
+
+A clip plays only a window of its File, so each clip is cut (stream copy, no
+re-encoding) into its own small file under
+``MEDIA_ROOT/clips/<file checksum>/<start>-<end><ext>`` by a ``cut_clip``
+job when it is saved. The name is derived from the content and the window,
+so an asset never goes stale: changing a clip's times points it at a new
+asset, and the old one is removed by the signal handlers in core.signals.
+"""
+
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+
+from . import media
+
+CLIPS_DIR = "clips"
+
+
+def asset_key(clip):
+    """Return the (checksum, start, end) triple that identifies a clip's asset."""
+    return clip.file.checksum, clip.start_seconds, clip.end_seconds
+
+
+def asset_path(checksum, start, end, ext):
+    return os.path.join(
+        settings.MEDIA_ROOT, CLIPS_DIR, checksum, f"{start:.3f}-{end:.3f}{ext.lower()}"
+    )
+
+
+def clip_path(clip):
+    """Return the path of a clip's pre-cut asset, whether or not it exists yet."""
+    ext = os.path.splitext(clip.file.file.name)[1]
+    return asset_path(*asset_key(clip), ext)
+
+
+def is_cut(clip):
+    return bool(clip.file.checksum) and os.path.exists(clip_path(clip))
+
+
+def cut(clip):
+    """Cut a clip's asset from its File, returning False if it already exists."""
+    if not clip.file.checksum:
+        raise ValueError(f"{clip.file} has no checksum yet")
+    path = clip_path(clip)
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.{uuid.uuid4().hex}.tmp{ext}"
+    try:
+        media.cut(clip.file.file.path, tmp_path, clip.start_seconds, clip.end_seconds)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+
+def remove(checksum, start, end, ext):
+    try:
+        os.remove(asset_path(checksum, start, end, ext))
+    except FileNotFoundError:
+        pass
+
+
+def remove_all(checksum):
+    """Remove the clip assets cut from the File with ``checksum``."""
+    shutil.rmtree(
+        os.path.join(settings.MEDIA_ROOT, CLIPS_DIR, checksum), ignore_errors=True
+    )
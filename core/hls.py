@@ -0,0 +1,89 @@
+"""HLS segmenting of media files for adaptive, cacheable playback.
+
+Each File is cut (without re-encoding) into ``HLS_SEGMENT_DURATION``-second
+MPEG-TS segments plus a VOD playlist under ``MEDIA_ROOT/hls/<checksum>/``.
+Output is keyed by the checksum, so a segment's URL always names the same
+bytes and can be cached indefinitely. Segmenting runs in ``segment_hls``
+jobs or ``manage.py segment_media``.
+"""
+
+import os
+import re
+import shutil
+import uuid
+
+from django.conf import settings
+
+from . import media
+
+HLS_DIR = "hls"
+PLAYLIST_NAME = "index.m3u8"
+SEGMENT_NAME = re.compile(r"segment\d{5}\.ts")
+
+PLAYLIST_CONTENT_TYPE = "application/vnd.apple.mpegurl"
+SEGMENT_CONTENT_TYPE = "video/mp2t"
+
+
+def output_dir(file_obj):
+    """Return the directory holding a File's playlist and segments."""
+    return os.path.join(settings.MEDIA_ROOT, HLS_DIR, file_obj.checksum)
+
+
+def playlist_path(file_obj):
+    return os.path.join(output_dir(file_obj), PLAYLIST_NAME)
+
+
+def segment_path(file_obj, name):
+    """Return the path of segment ``name``, or None if it is not a segment name."""
+    if not SEGMENT_NAME.fullmatch(name):
+        return None
+    return os.path.join(output_dir(file_obj), name)
+
+
+def is_segmented(file_obj):
+    return bool(file_obj.checksum) and os.path.exists(playlist_path(file_obj))
+
+
+def segment(file_obj, force=False):
+    """Segment a File, returning False if its segments already exist.
+
+    Segments are written to a temporary directory that is renamed into place,
+    so readers never see a partial playlist.
+    """
+    if not file_obj.checksum:
+        raise ValueError(f"{file_obj} has no checksum yet")
+    if is_segmented(file_obj) and not force:
+        return False
+    final_dir = output_dir(file_obj)
+    tmp_dir = f"{final_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+    try:
+        media.segment_hls(
+            file_obj.file.path,
+            tmp_dir,
+            PLAYLIST_NAME,
+            "segment%05d.ts",
+            settings.HLS_SEGMENT_DURATION,
+        )
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.rename(tmp_dir, final_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return True
+
+
+def remove(checksum):
+    shutil.rmtree(
+        os.path.join(settings.MEDIA_ROOT, HLS_DIR, checksum), ignore_errors=True
+    )
+
+
+def orphaned_dirs(checksums):
+    """Yield output directories whose checksum is not in ``checksums``."""
+    root = os.path.join(settings.MEDIA_ROOT, HLS_DIR)
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        # Skip output that is still being written
+        if name not in checksums and not name.endswith(".tmp"):
+            yield os.path.join(root, name)
@@ -0,0 +1,164 @@
+"""Convert legacy hummedia annotation exports to IC_player annotations.
+
+A hummedia export is either one document or a JSON array of them; each
+document has ``media[0].tracks[].trackEvents[]`` with ``popcornOptions``
+start/end times. ``iter_documents`` decodes an array one element at a time,
+so a large export never has to be held in memory as a whole, and
+``convert_document`` turns a document into the IC_player event list of
+IC_player/scripts/hummedia2ic.py.
+
+``import_file`` is the unit of work of ``manage.py import_hummedia``: it has
+no database access so it can run in worker processes. Like
+IC_player/scripts/old_hummedia2ic.py, it merges the events of all documents
+of a file into one event list, per media name and creator, and leaves out
+documents without events.
+"""
+
+import datetime
+import json
+import os
+
+from . import checksums
+from . import timeline
+
+# hummedia event types and their IC_player equivalents
+EVENT_TYPES = {
+    "blank": "blank",
+    "darken": "blank",
+    "mutePlugin": "mute",
+    "skip": "skip",
+}
+
+READ_SIZE = 64 * 1024
+
+
+class ConversionError(ValueError):
+    """Raised for exports that cannot be converted."""
+
+
+def iter_documents(file, read_size=READ_SIZE):
+    """Yield the documents of a text file holding a document or an array of them."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    in_array = None
+    eof = False
+    while True:
+        # Skip whitespace and, inside the array, the separating commas
+        while position < len(buffer) and (
+            buffer[position].isspace() or (in_array and buffer[position] == ",")
+        ):
+            position += 1
+        if position == len(buffer) and not eof:
+            chunk = file.read(read_size)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        if in_array is None:
+            if position == len(buffer):
+                return
+            in_array = buffer[position] == "["
+            position += in_array
+            continue
+        if in_array and position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            document, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise ConversionError(f"Invalid JSON: {e}") from e
+            # The document continues past the buffer; grow it geometrically so
+            # a large document is not re-decoded once per chunk
+            chunk = file.read(max(read_size, len(buffer)))
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield document
+        buffer, position = buffer[end:], 0
+        if not in_array:
+            return
+
+
+def hms_label(seconds):
+    return str(datetime.timedelta(seconds=round(float(seconds))))
+
+
+def convert_document(document):
+    """Return the IC_player events of a hummedia document, sorted by start."""
+    events = []
+    try:
+        tracks = document["media"][0]["tracks"]
+    except (KeyError, IndexError, TypeError) as e:
+        raise ConversionError(f"Not a hummedia document: {e!r}") from e
+    for track in tracks:
+        for event in track.get("trackEvents") or []:
+            try:
+                kind = EVENT_TYPES[event["type"]]
+            except KeyError as e:
+                raise ConversionError(
+                    f"Event {event.get('type')!r} not implemented"
+                ) from e
+            start = event["popcornOptions"]["start"]
+            end = event["popcornOptions"]["end"]
+            try:
+                float(start), float(end)
+            except (TypeError, ValueError) as e:
+                raise ConversionError(f"Invalid times in {event!r}") from e
+            events.append(
+                {
+                    "options": {
+                        "label": f"{hms_label(start)} - {hms_label(end)}",
+                        "type": kind,
+                        "start": str(start),
+                        "end": str(end),
+                        "details": {},
+                    }
+                }
+            )
+    return sorted(events, key=event_start)
+
+
+def event_start(event):
+    return float(event["options"]["start"])
+
+
+def import_file(path, imported_checksums=frozenset()):
+    """Convert one export file.
+
+    Returns a dict with the file's ``path`` and ``checksum`` and either
+    ``skipped`` (already imported), ``error``, or ``documents``: one dict per
+    media name and creator with the ``name``, ``creator``, merged IC_player
+    ``annotations`` and compiled ``timeline`` and ``timeline_hash``.
+    """
+    result = {"path": path}
+    try:
+        with open(path, "rb") as f:
+            result["checksum"] = checksums.calculate_checksum(f)
+        if result["checksum"] in imported_checksums:
+            return dict(result, skipped=True)
+        merged = {}
+        with open(path, encoding="utf-8") as f:
+            for document in iter_documents(f):
+                events = convert_document(document)
+                if not events:
+                    continue
+                name = document["media"][0].get("name") or os.path.basename(path)
+                key = (str(name), document.get("creator"))
+                merged.setdefault(key, []).extend(events)
+        documents = []
+        for (name, creator), events in merged.items():
+            annotations = sorted(events, key=event_start)
+            compiled = timeline.compile_annotations(annotations)
+            documents.append(
+                {
+                    "name": name,
+                    "creator": creator,
+                    "annotations": annotations,
+                    "timeline": compiled,
+                    "timeline_hash": timeline.timeline_hash(compiled),
+                }
+            )
+    # ValueError includes ConversionError and UnicodeDecodeError
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return dict(result, error=str(e))
+    return dict(result, documents=documents)
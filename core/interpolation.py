@@ -0,0 +1,144 @@
+"""Interpolate censor box keyframes into packed per-frame tracks.
+
+Censor annotations give box positions (``[x, y, w, h]`` in percent of the
+frame, or ``[x, y]`` to keep the previous size) at a few keyframe times.
+``interpolate`` fills in a box for every frame at ``fps`` between the first
+and last keyframe, eased between keyframes, and clamps boxes to the frame.
+Instead of one string-keyed JSON entry per frame, the result is packed::
+
+    {"fps": 30, "start": 4.0, "frames": 61, "easing": "linear", "boxes": "<base64>"}
+
+where ``boxes`` holds ``frames`` rows of four little-endian float32s;
+``unpack`` and ``box_at`` read them back.
+
+NumPy is used when it is installed; otherwise an equivalent pure Python
+loop produces the same boxes, more slowly.
+"""
+
+from array import array
+import base64
+import bisect
+import logging
+import math
+import sys
+
+from django.conf import settings
+
+from .models import parse_time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Functions of the fraction u in [0, 1] of the way between two keyframes,
+# written to work on floats and on NumPy arrays alike
+EASINGS = {
+    "linear": lambda u: u,
+    "ease-in": lambda u: u * u,
+    "ease-out": lambda u: u * (2 - u),
+    "ease-in-out": lambda u: u * u * (3 - 2 * u),
+    "step": lambda u: u // 1,
+}
+
+
+def parse_keyframes(position):
+    """Return sorted keyframe times and ``[x, y, w, h]`` boxes of a position map.
+
+    ``position`` maps times (numbers, or strings like "12.5" or "0:00:12.5")
+    to boxes, or is a list of ``[time, box]`` pairs. Two-value boxes keep the
+    size of the previous one.
+    """
+    items = position.items() if isinstance(position, dict) else position
+    times, boxes = [], []
+    for time, box in sorted((parse_time(time), box) for time, box in items):
+        if len(box) == 2 and boxes:
+            box = [*box, *boxes[-1][2:]]
+        if len(box) != 4:
+            raise ValueError(f"Invalid box at {time}: {box!r}")
+        box = [float(value) for value in box]
+        if times and time == times[-1]:
+            boxes[-1] = box
+        else:
+            times.append(time)
+            boxes.append(box)
+    return times, boxes
+
+
+def frame_count(times, fps):
+    # Tolerate float error so a keyframe exactly on a frame gets that frame
+    return math.floor((times[-1] - times[0]) * fps + 1e-9) + 1
+
+
+def interpolate_numpy(times, boxes, fps, ease):
+    keys = np.asarray(times)
+    values = np.asarray(boxes)
+    frames = keys[0] + np.arange(frame_count(times, fps)) / fps
+    segment = np.clip(np.searchsorted(keys, frames, "right") - 1, 0, len(keys) - 2)
+    span = keys[segment + 1] - keys[segment]
+    u = ease(np.clip((frames - keys[segment]) / span, 0, 1))[:, None]
+    result = values[segment] + (values[segment + 1] - values[segment]) * u
+    # Keep boxes inside the frame
+    result[:, 2] = np.maximum(np.minimum(result[:, 2], 100 - result[:, 0]), 0)
+    result[:, 3] = np.maximum(np.minimum(result[:, 3], 100 - result[:, 1]), 0)
+    return result.astype("<f4").tobytes()
+
+
+def interpolate_python(times, boxes, fps, ease):
+    packed = array("f")
+    for frame in range(frame_count(times, fps)):
+        time = times[0] + frame / fps
+        segment = min(max(bisect.bisect_right(times, time) - 1, 0), len(times) - 2)
+        start, end = boxes[segment], boxes[segment + 1]
+        span = times[segment + 1] - times[segment]
+        u = ease(min(max((time - times[segment]) / span, 0), 1))
+        x, y, w, h = (a + (b - a) * u for a, b in zip(start, end))
+        packed.extend((x, y, max(min(w, 100 - x), 0), max(min(h, 100 - y), 0)))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def interpolate(position, fps=None, easing=None):
+    """Return the packed track of a censor's position map, or None if it has one box.
+
+    Unknown easings fall back to linear. Raises ValueError or TypeError for
+    malformed keyframes.
+    """
+    fps = fps or settings.ANNOTATION_INTERPOLATION_FPS
+    easing = easing or settings.ANNOTATION_INTERPOLATION_EASING
+    if easing not in EASINGS:
+        logger.warning("Unknown easing %r, interpolating linearly", easing)
+        easing = "linear"
+    times, boxes = parse_keyframes(position)
+    if len(times) < 2:
+        return None
+    pack = interpolate_numpy if np is not None else interpolate_python
+    data = pack(times, boxes, fps, EASINGS[easing])
+    return {
+        "fps": fps,
+        "start": times[0],
+        "frames": len(data) // 16,
+        "easing": easing,
+        "boxes": base64.b64encode(data).decode("ascii"),
+    }
+
+
+def unpack(track):
+    """Return the boxes of a packed track as a list of ``[x, y, w, h]``."""
+    values = array("f", base64.b64decode(track["boxes"]))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return [values[i : i + 4].tolist() for i in range(0, len(values), 4)]
+
+
+def box_at(track, time):
+    """Return the box of a packed track at ``time``."""
+    frame = round((time - track["start"]) * track["fps"])
+    frame = min(max(frame, 0), track["frames"] - 1)
+    values = array("f", base64.b64decode(track["boxes"])[frame * 16 : frame * 16 + 16])
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tolist()
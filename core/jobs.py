@@ -0,0 +1,203 @@
+"""Database-backed background job queue.
+
+Jobs are ``Job`` rows processed by ``manage.py run_workers``. Workers claim a
+job with a conditional UPDATE, so any number of worker processes can share
+the table without an external broker. Handlers are registered per job kind
+with the ``handler`` decorator and receive the ``Job``.
+"""
+
+from datetime import timedelta
+import logging
+import os
+import time
+import traceback
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from . import checksums
+from . import chunk_cache
+from . import clips
+from . import hls
+from . import media
+from . import mp4
+from . import stream_cache
+from .models import Clip
+from .models import File
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register the decorated function as the handler for ``kind`` jobs."""
+
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(kind, file=None, **payload):
+    """Queue a job of ``kind`` and return it."""
+    return Job.objects.create(kind=kind, file=file, payload=payload)
+
+
+def claim_job(worker):
+    """Mark the oldest runnable job as running for ``worker`` and return it."""
+    while True:
+        now = timezone.now()
+        job_id = (
+            Job.objects.filter(status=Job.Status.QUEUED, run_after__lte=now)
+            .order_by("id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if job_id is None:
+            return None
+        claimed = Job.objects.filter(id=job_id, status=Job.Status.QUEUED).update(
+            status=Job.Status.RUNNING,
+            worker=worker,
+            started_at=now,
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return Job.objects.select_related("file").get(id=job_id)
+        # Another worker claimed it first; try the next one
+
+
+def run_job(job):
+    """Run a claimed job, recording success, a retry or failure."""
+    try:
+        func = HANDLERS[job.kind]
+        func(job)
+    except Exception:
+        logger.exception("Job %s failed", job)
+        job.error = traceback.format_exc()
+        if job.attempts < settings.JOB_MAX_ATTEMPTS:
+            delay = settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            job.status = Job.Status.QUEUED
+            job.run_after = timezone.now() + timedelta(seconds=delay)
+        else:
+            job.status = Job.Status.FAILED
+            job.finished_at = timezone.now()
+    else:
+        job.status = Job.Status.DONE
+        job.error = ""
+        job.finished_at = timezone.now()
+    job.save(
+        update_fields=["status", "error", "run_after", "finished_at", "updated_at"]
+    )
+
+
+def requeue_stale():
+    """Requeue running jobs whose worker has presumably died."""
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_STALE_AFTER)
+    return Job.objects.filter(status=Job.Status.RUNNING, started_at__lt=cutoff).update(
+        status=Job.Status.QUEUED, run_after=timezone.now()
+    )
+
+
+def work(worker, burst=False, should_stop=lambda: False):
+    """Process jobs until ``should_stop()`` is true (or the queue drains in burst mode)."""
+    requeue_stale()
+    while not should_stop():
+        close_old_connections()
+        job = claim_job(worker)
+        if job is None:
+            if burst:
+                return
+            time.sleep(settings.JOB_POLL_INTERVAL)
+            continue
+        run_job(job)
+
+
+@handler("checksum")
+def checksum_file(job):
+    checksums.update_stored_checksum(job.file)
+
+
+@handler("probe_duration")
+def probe_duration(job):
+    duration = media.probe_duration(job.file.file.path)
+    File.objects.filter(pk=job.file_id).update(duration=duration)
+
+
+def changed_since_checksum(file_obj, path):
+    """Whether the file was modified after its checksum was computed."""
+    if not file_obj.checksum_at:
+        # Not computed yet: the "checksum" job will hash the current bytes
+        return False
+    return os.path.getmtime(path) > file_obj.checksum_at.timestamp()
+
+
+def content_replaced(file_obj):
+    """Re-hash a File whose bytes changed in place and redo what derives from them.
+
+    Drops this process's stream metadata and the chunk cache blocks of the
+    old ETag (other processes pick up the change within
+    STREAM_METADATA_CACHE_TTL), and removes the HLS output and clip assets
+    of the old checksum, queueing them again.
+    """
+    old_checksum = file_obj.checksum
+    segmented = hls.is_segmented(file_obj)
+    checksums.update_stored_checksum(file_obj)
+    stream_cache.invalidate(file_id=file_obj.pk)
+    if not old_checksum or old_checksum == file_obj.checksum:
+        return
+    chunk_cache.remove(f'"{old_checksum}"')
+    hls.remove(old_checksum)
+    clips.remove_all(old_checksum)
+    kinds = ["segment_hls"] if segmented else []
+    Job.objects.bulk_create(
+        [Job(kind=kind, file=file_obj) for kind in kinds]
+        + [
+            Job(kind="cut_clip", file=file_obj, payload={"clip": clip_id})
+            for clip_id in file_obj.clips.values_list("id", flat=True)
+        ]
+    )
+
+
+def queue_next(job):
+    """Queue the jobs a File.enqueue_jobs chain holds back until ``job`` is done."""
+    kinds = job.payload.pop("then", None)
+    if kinds:
+        job.file.enqueue_jobs(kinds)
+        Job.objects.filter(pk=job.pk).update(payload=job.payload)
+
+
+@handler("seek_index")
+def seek_index(job):
+    path = job.file.file.path
+    is_mp4 = os.path.splitext(path)[1].lower() in mp4.MP4_EXTENSIONS
+    if is_mp4 and settings.MP4_FASTSTART and not settings.MEDIA_CONTENT_ADDRESSED:
+        rewritten = mp4.rewrite_faststart(path)
+        # An earlier attempt may have rewritten the file and failed before
+        # updating the checksum
+        if rewritten or changed_since_checksum(job.file, path):
+            content_replaced(job.file)
+    # The file no longer changes, so jobs reading it may run
+    queue_next(job)
+    if is_mp4:
+        File.objects.filter(pk=job.file_id).update(seek_index=mp4.build_index(path))
+
+
+@handler("segment_hls")
+def segment_hls(job):
+    if not job.file.checksum:
+        raise ValueError("Checksum not computed yet")
+    hls.segment(job.file)
+
+
+@handler("cut_clip")
+def cut_clip(job):
+    clip = Clip.objects.select_related("file").filter(pk=job.payload["clip"]).first()
+    if clip is None:
+        # Deleted since the job was queued
+        return
+    clips.cut(clip)
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from core import access
+from core.models import CollectionRole
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the effective access table from scratch and report rows that "
+        "differ from the stored ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix", action="store_true", help="Write the rebuilt table"
+        )
+        parser.add_argument(
+            "--show",
+            type=int,
+            default=20,
+            help="Differing rows listed per kind of change",
+        )
+
+    def handle(self, *args, **options):
+        changes = access.refresh(dry_run=not options["fix"])
+        for kind, rows in changes._asdict().items():
+            for user_id, collection_id, role in rows[: options["show"]]:
+                self.stdout.write(
+                    f"{kind}: user {user_id}, collection {collection_id}, "
+                    f"{CollectionRole(role).label}"
+                )
+        summary = (
+            f"{len(changes.added)} missing, {len(changes.changed)} wrong role, "
+            f"{len(changes.removed)} stale"
+        )
+        if not changes:
+            self.stdout.write("Effective access is consistent")
+        elif options["fix"]:
+            self.stdout.write(f"Fixed {summary}")
+        else:
+            raise CommandError(f"Effective access is inconsistent: {summary}")
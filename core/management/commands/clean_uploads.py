@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core import uploads
+from core.models import Upload
+
+
+class Command(BaseCommand):
+    help = "Delete resumable uploads that were not finished in time."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.UPLOAD_EXPIRE_DAYS,
+            help="Age in days of the last received chunk",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        expired = Upload.objects.filter(file__isnull=True, updated_at__lt=cutoff)
+        count = 0
+        for upload in expired:
+            uploads.discard(upload)
+            count += 1
+        self.stdout.write(f"Removed {count} unfinished uploads")
@@ -0,0 +1,192 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+
+import django
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connections
+from django.db import transaction
+
+from core import hummedia
+from core.models import Annotation
+from core.models import AnnotationImport
+from core.models import File
+from core.models import User
+
+_imported_checksums = frozenset()
+
+
+def init_worker(imported_checksums):
+    # Needed when processes are spawned rather than forked (macOS, Windows)
+    django.setup()
+    global _imported_checksums
+    _imported_checksums = imported_checksums
+
+
+def import_file(path):
+    return hummedia.import_file(path, _imported_checksums)
+
+
+class Command(BaseCommand):
+    help = (
+        "Import legacy hummedia annotation exports as Annotations. Files whose "
+        "checksum was already imported are skipped, so interrupted runs resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Export files or directories")
+        parser.add_argument(
+            "--pattern", default="*.json", help="File name pattern in directories"
+        )
+        parser.add_argument(
+            "--file",
+            type=int,
+            help="File id to attach all annotations to (default: the newest File "
+            "of the Resource named like the hummedia media)",
+        )
+        parser.add_argument(
+            "--owner",
+            help="Netid of the owner when the export's creator is not a user",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of worker processes (default: number of CPUs)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Annotations written per transaction",
+        )
+
+    def handle(self, *args, **options):
+        self.file = None
+        if options["file"] is not None:
+            self.file = File.objects.filter(id=options["file"]).first()
+            if self.file is None:
+                raise CommandError(f"No File with id {options['file']}")
+        self.owner = None
+        if options["owner"]:
+            self.owner = User.objects.filter(netid=options["owner"]).first()
+            if self.owner is None:
+                raise CommandError(f"No user with netid {options['owner']}")
+        self.files_by_name = {}
+        self.users_by_netid = {}
+        self.pending = []
+        self.counts = dict.fromkeys(
+            ("imported", "annotations", "skipped", "errors", "unresolved"), 0
+        )
+
+        paths = sorted(self.find_paths(options["paths"], options["pattern"]))
+        imported = frozenset(
+            AnnotationImport.objects.values_list("checksum", flat=True)
+        )
+        if options["processes"] > 1:
+            # Forked workers must not share the parent's database connections
+            connections.close_all()
+            with ProcessPoolExecutor(
+                options["processes"],
+                initializer=init_worker,
+                initargs=(imported,),
+            ) as executor:
+                results = executor.map(import_file, paths, chunksize=16)
+                self.save_results(results, imported, options["batch_size"])
+        else:
+            results = (hummedia.import_file(path, imported) for path in paths)
+            self.save_results(results, imported, options["batch_size"])
+
+        self.stdout.write(
+            "Imported {annotations} annotations from {imported} files; skipped "
+            "{skipped} already imported, {unresolved} unresolved, {errors} "
+            "failed".format(**self.counts)
+        )
+
+    def find_paths(self, paths, pattern):
+        for path in map(Path, paths):
+            if path.is_dir():
+                yield from (str(p) for p in path.rglob(pattern) if p.is_file())
+            else:
+                yield str(path)
+
+    def save_results(self, results, imported, batch_size):
+        seen = set(imported)
+        for result in results:
+            if result.get("skipped") or result.get("checksum") in seen:
+                self.counts["skipped"] += 1
+                continue
+            if "error" in result:
+                self.counts["errors"] += 1
+                self.stderr.write(f"{result['path']}: {result['error']}")
+                continue
+            annotations = self.build_annotations(result)
+            if annotations is None:
+                self.counts["unresolved"] += 1
+                continue
+            seen.add(result["checksum"])
+            self.pending.append((result, annotations))
+            if sum(len(a) for _, a in self.pending) >= batch_size:
+                self.flush(batch_size)
+        self.flush(batch_size)
+
+    def build_annotations(self, result):
+        """Return unsaved Annotations for a converted file, or None if unresolved."""
+        annotations = []
+        for document in result["documents"]:
+            file_obj = self.file or self.resolve_file(document["name"])
+            owner = self.resolve_owner(document["creator"]) or self.owner
+            if file_obj is None or owner is None:
+                missing = "file" if file_obj is None else "owner"
+                self.stderr.write(
+                    f"{result['path']}: no {missing} for {document['name']!r}"
+                )
+                return None
+            annotations.append(
+                Annotation(
+                    file=file_obj,
+                    owner=owner,
+                    name=document["name"][:255],
+                    annotations=document["annotations"],
+                    timeline=document["timeline"],
+                    timeline_hash=document["timeline_hash"],
+                )
+            )
+        return annotations
+
+    def resolve_file(self, name):
+        if name not in self.files_by_name:
+            self.files_by_name[name] = (
+                File.objects.filter(resource__name=name).order_by("-created_at").first()
+            )
+        return self.files_by_name[name]
+
+    def resolve_owner(self, netid):
+        if not netid:
+            return None
+        if netid not in self.users_by_netid:
+            self.users_by_netid[netid] = User.objects.filter(netid=netid).first()
+        return self.users_by_netid[netid]
+
+    def flush(self, batch_size):
+        if not self.pending:
+            return
+        # Annotations and import records are written together, so a file is
+        # either fully imported or retried on the next run
+        with transaction.atomic():
+            Annotation.objects.bulk_create(
+                [a for _, annotations in self.pending for a in annotations],
+                batch_size=batch_size,
+            )
+            AnnotationImport.objects.bulk_create(
+                AnnotationImport(
+                    checksum=result["checksum"],
+                    path=result["path"][:1024],
+                    annotations=len(annotations),
+                )
+                for result, annotations in self.pending
+            )
+        self.counts["imported"] += len(self.pending)
+        self.counts["annotations"] += sum(len(a) for _, a in self.pending)
+        self.pending = []
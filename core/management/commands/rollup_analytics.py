@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core import analytics
+
+
+class Command(BaseCommand):
+    help = "Aggregate complete playback analytics partitions into watch histograms."
+
+    def handle(self, *args, **options):
+        partitions = analytics.complete_partitions()
+        if not partitions:
+            self.stdout.write("No complete partitions")
+            return
+        count = analytics.rollup(partitions)
+        self.stdout.write(
+            f"Rolled up {len(partitions)} partitions into {count} histograms"
+        )
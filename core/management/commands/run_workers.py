@@ -0,0 +1,65 @@
+import multiprocessing
+import os
+import signal
+import socket
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def worker_main(name, burst):
+    # Needed when processes are spawned rather than forked (macOS, Windows)
+    django.setup()
+    from core import jobs
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    # Finish the current job before exiting
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    jobs.work(name, burst=burst, should_stop=lambda: stopping)
+
+
+class Command(BaseCommand):
+    help = "Run background job workers (checksums, probing, derived assets)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of worker processes (default: number of CPUs)",
+        )
+        parser.add_argument(
+            "--burst",
+            action="store_true",
+            help="Exit once the queue is empty instead of polling",
+        )
+
+    def handle(self, *args, **options):
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+        host = socket.gethostname()
+        processes = []
+        for number in range(options["processes"]):
+            name = f"{host}:{os.getpid()}:{number}"
+            process = multiprocessing.Process(
+                target=worker_main, args=(name, options["burst"]), name=name
+            )
+            process.start()
+            processes.append(process)
+        self.stdout.write(f"Started {len(processes)} workers")
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
@@ -0,0 +1,60 @@
+import shutil
+
+from django.core.management.base import BaseCommand
+
+from core import hls
+from core.media import MediaToolError
+from core.models import File
+
+
+class Command(BaseCommand):
+    help = "Cut files into HLS segments and playlists (see core/hls.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "files", nargs="*", type=int, help="File ids (default: all files)"
+        )
+        parser.add_argument(
+            "--force", action="store_true", help="Segment already segmented files"
+        )
+        parser.add_argument(
+            "--enqueue",
+            action="store_true",
+            help="Queue segment_hls jobs for the workers instead",
+        )
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help="Remove segments of files that no longer exist",
+        )
+
+    def handle(self, *args, **options):
+        files = File.objects.exclude(checksum=None).exclude(file="")
+        if options["files"]:
+            files = files.filter(id__in=options["files"])
+
+        segmented = failed = 0
+        for file_obj in files.iterator():
+            if options["enqueue"]:
+                file_obj.enqueue_jobs(["segment_hls"])
+                continue
+            try:
+                if hls.segment(file_obj, force=options["force"]):
+                    segmented += 1
+            except MediaToolError as e:
+                failed += 1
+                self.stderr.write(f"{file_obj}: {e}")
+        if options["enqueue"]:
+            self.stdout.write(f"Queued {files.count()} files")
+        else:
+            self.stdout.write(f"Segmented {segmented} files, {failed} failed")
+
+        if options["prune"]:
+            checksums = set(
+                File.objects.exclude(checksum=None).values_list("checksum", flat=True)
+            )
+            pruned = 0
+            for path in hls.orphaned_dirs(checksums):
+                shutil.rmtree(path, ignore_errors=True)
+                pruned += 1
+            self.stdout.write(f"Removed {pruned} orphaned segment directories")
@@ -0,0 +1,193 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+import requests
+
+from core import access
+from core import api
+from core.models import Course
+from core.models import PrivilegeLevel
+from core.models import User
+
+logger = logging.getLogger(__name__)
+
+
+def is_set(flag):
+    return str(flag).strip().upper() in ("Y", "TRUE", "1")
+
+
+def course_key(record):
+    """Return the (dept, catalog number, section) of an enrollment record."""
+    catalog_number = str(record["catalog_number"]).strip()
+    catalog_number += str(record.get("catalog_suffix") or "").strip()
+    return (
+        str(record["teaching_area"]).strip().upper(),
+        catalog_number,
+        str(record["section_number"]).strip(),
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Sync students' course memberships from OIT enrollments for the current "
+        "term (and the next one near the end of a term). Access to collections "
+        "linked to their courses follows from the memberships."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "netids", nargs="*", help="Only sync these users (default: all students)"
+        )
+        parser.add_argument(
+            "--yearterm", help="Sync this year term (e.g. 20255) instead"
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.API_MAX_CONCURRENCY,
+            help="Enrollment lookups in flight at once",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Users whose changes are written per transaction",
+        )
+        parser.add_argument(
+            "--refresh",
+            action="store_true",
+            help="Ignore cached enrollments",
+        )
+
+    def handle(self, *args, **options):
+        client = api.Api()
+        if options["yearterm"]:
+            yearterms = [options["yearterm"]]
+        else:
+            current = client.get_current_year_term()
+            if not current or not current.get("yearterm"):
+                raise CommandError("No current year term; pass --yearterm")
+            yearterms = [current["yearterm"]]
+            if current["is_two_weeks_from_end"]:
+                # Students registered for next term get access before it starts
+                yearterms.append(client.calculate_next_year_term(current["yearterm"]))
+        self.stdout.write(f"Syncing year terms {', '.join(yearterms)}")
+
+        users = User.objects.filter(is_active=True).exclude(netid="")
+        if options["netids"]:
+            users = users.filter(netid__in=options["netids"])
+        else:
+            users = users.filter(privilege_level=PrivilegeLevel.STUDENT)
+        users = list(users.values_list("id", "netid"))
+
+        self.load_state([user_id for user_id, _ in users])
+        self.counts = defaultdict(int)
+
+        def lookup(user):
+            user_id, netid = user
+            records = []
+            try:
+                for yearterm in yearterms:
+                    if options["refresh"]:
+                        api.invalidate("student_enrollments", netid, yearterm)
+                    records += client.get_student_enrollments(netid, yearterm) or []
+            except (requests.RequestException, KeyError, ValueError):
+                logger.exception("Could not get enrollments of %s", netid)
+                return user_id, None
+            return user_id, records
+
+        # Fetch the token once, rather than from every lookup thread
+        api.get_auth_token()
+        batch = []
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            for user_id, records in executor.map(lookup, users):
+                if records is None:
+                    self.counts["failed"] += 1
+                    continue
+                batch.append((user_id, records))
+                if len(batch) >= options["batch_size"]:
+                    self.apply(batch)
+                    batch = []
+        self.apply(batch)
+
+        self.stdout.write(
+            "Synced {synced} users ({failed} failed): +{courses_added}/"
+            "-{courses_removed} course memberships".format_map(self.counts)
+        )
+
+    def load_state(self, user_ids):
+        """Load courses and existing memberships into memory."""
+        self.courses = {
+            (c.dept, c.catalog_number, c.section_number): c.id
+            for c in Course.objects.all()
+        }
+        self.memberships = defaultdict(dict)  # user -> {course: through row id}
+        for row_id, user_id, course_id in User.courses.through.objects.filter(
+            user_id__in=user_ids
+        ).values_list("id", "user_id", "course_id"):
+            self.memberships[user_id][course_id] = row_id
+
+    def course_ids(self, keys):
+        """Return the ids of courses by key, creating the missing ones."""
+        missing = []
+        for key in set(keys) - self.courses.keys():
+            course = Course(dept=key[0], catalog_number=key[1], section_number=key[2])
+            try:
+                course.clean_fields()
+            except ValidationError:
+                logger.warning("Skipping enrollment in invalid course %s", key)
+                self.courses[key] = None
+                continue
+            missing.append(course)
+        if missing:
+            Course.objects.bulk_create(missing, ignore_conflicts=True)
+            for course in Course.objects.filter(
+                dept__in={c.dept for c in missing},
+                catalog_number__in={c.catalog_number for c in missing},
+            ):
+                self.courses[
+                    course.dept, course.catalog_number, course.section_number
+                ] = course.id
+        return {key: self.courses.get(key) for key in keys}
+
+    def apply(self, batch):
+        """Diff a batch of users' enrollments against the database and apply it."""
+        if not batch:
+            return
+        enrolled = {
+            user_id: {
+                course_key(record)
+                for record in records
+                if not is_set(record.get("withdraw_flag"))
+            }
+            for user_id, records in batch
+        }
+        ids = self.course_ids(set().union(*enrolled.values()))
+
+        new_memberships, old_memberships = [], []
+        for user_id, keys in enrolled.items():
+            course_ids = {ids[key] for key in keys if ids[key]}
+            current = self.memberships[user_id]
+            for course_id in course_ids - current.keys():
+                new_memberships.append(
+                    User.courses.through(user_id=user_id, course_id=course_id)
+                )
+            old_memberships += [current[c] for c in current.keys() - course_ids]
+
+        with transaction.atomic():
+            User.courses.through.objects.bulk_create(
+                new_memberships, ignore_conflicts=True
+            )
+            User.courses.through.objects.filter(id__in=old_memberships).delete()
+            # Bulk writes send no signals to keep EffectiveAccess current
+            access.refresh(user_ids=list(enrolled))
+
+        self.counts["synced"] += len(batch)
+        self.counts["courses_added"] += len(new_memberships)
+        self.counts["courses_removed"] += len(old_memberships)
@@ -0,0 +1,110 @@
+"""Wrappers around the ffmpeg command line tools."""
+
+import json
+import os
+import subprocess
+
+from django.conf import settings
+
+
+class MediaToolError(Exception):
+    """Raised when ffmpeg/ffprobe is missing or fails."""
+
+
+def run_tool(args, binary):
+    """Run an ffmpeg tool and return its stdout, raising MediaToolError on failure."""
+    try:
+        result = subprocess.run(
+            [binary, *args], capture_output=True, text=True, check=False
+        )
+    except FileNotFoundError:
+        raise MediaToolError(f"{binary} is not installed")
+    if result.returncode != 0:
+        raise MediaToolError(result.stderr.strip() or f"{binary} failed")
+    return result.stdout
+
+
+def probe(path):
+    """Return ffprobe's format and stream information for a media file."""
+    output = run_tool(
+        [
+            "-v",
+            "error",
+            "-print_format",
+            "json",
+            "-show_format",
+            "-show_streams",
+            str(path),
+        ],
+        settings.FFPROBE_BINARY,
+    )
+    return json.loads(output)
+
+
+def probe_duration(path):
+    """Return the duration of a media file in seconds, or None if unknown."""
+    duration = probe(path).get("format", {}).get("duration")
+    return float(duration) if duration else None
+
+
+def segment_hls(path, output_dir, playlist_name, segment_pattern, segment_duration):
+    """Cut a media file into MPEG-TS segments and a VOD playlist, without re-encoding.
+
+    Segments start on keyframes, so their length can exceed
+    ``segment_duration`` when keyframes are sparse.
+    """
+    run_tool(
+        [
+            "-v",
+            "error",
+            "-y",
+            "-i",
+            str(path),
+            "-map",
+            "0:v:0?",
+            "-map",
+            "0:a:0?",
+            "-c",
+            "copy",
+            "-f",
+            "hls",
+            "-hls_time",
+            str(segment_duration),
+            "-hls_playlist_type",
+            "vod",
+            "-hls_segment_filename",
+            os.path.join(output_dir, segment_pattern),
+            os.path.join(output_dir, playlist_name),
+        ],
+        settings.FFMPEG_BINARY,
+    )
+
+
+def cut(path, output_path, start, end):
+    """Copy the ``start``-``end`` second window of a media file, without re-encoding.
+
+    The cut starts at the keyframe at or before ``start``.
+    """
+    run_tool(
+        [
+            "-v",
+            "error",
+            "-y",
+            "-ss",
+            f"{start:.3f}",
+            "-i",
+            str(path),
+            "-t",
+            f"{end - start:.3f}",
+            "-map",
+            "0",
+            "-c",
+            "copy",
+            "-avoid_negative_ts",
+            "make_zero",
+            "-movflags",
+            "+faststart",
+            str(output_path),
+        ],
+        settings.FFMPEG_BINARY,
+    )
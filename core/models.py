@@ -1,4 +1,5 @@
 import os
+import uuid
 
 from django.conf import settings
 from django.contrib.auth.base_user import BaseUserManager
@@ -6,8 +7,13 @@ from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.db import models
+from django.db import transaction
 from django.utils import timezone
-import xxhash
+
+from .checksums import cached_checksum
+from .checksums import get_checksum
+from .storage import media_storage
+from .storage import object_name
 
 HMS_VALIDATOR = RegexValidator(
     regex=r"^\d{1,2}:[0-5]\d:[0-5]\d(?:\.\d{1,4})?$",
@@ -16,6 +22,23 @@ HMS_VALIDATOR = RegexValidator(
 )
 
 
+def hms_to_seconds(value):
+    """Convert an H:MM:SS(.ffff) string to seconds."""
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def parse_time(value):
+    """Return seconds from a number or a "12.5" or "0:00:12.5" string."""
+    if isinstance(value, str) and ":" in value:
+        seconds = hms_to_seconds(value.strip())
+    else:
+        seconds = float(value)
+    if not 0 <= seconds < float("inf"):
+        raise ValueError(f"Invalid time: {value!r}")
+    return seconds
+
+
 class PrivilegeLevel(models.IntegerChoices):
     ADMIN = 0
     LAB_ASSISTANT = 1
@@ -158,6 +181,29 @@ class CollectionUserAccess(models.Model):  # "through" model
         return f"{self.user.netid} | {self.collection.name}"
 
 
+class EffectiveAccess(models.Model):
+    """A user's role in a collection, maintained by core.access.
+
+    Derived from collection ownership, CollectionUserAccess and shared courses;
+    never edit it directly.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+"
+    )
+    collection = models.ForeignKey(
+        Collection, on_delete=models.CASCADE, related_name="+"
+    )
+    role = models.IntegerField(choices=CollectionRole.choices)
+
+    class Meta:
+        unique_together = ("user", "collection")
+        indexes = [models.Index(fields=["collection", "role"])]
+
+    def __str__(self):
+        return f"{self.user_id} | {self.collection_id} | {self.get_role_display()}"
+
+
 def validate_media_file(file):
     """Validate that uploaded file is video, audio, or image."""
     valid_extensions = {
@@ -196,21 +242,20 @@ def validate_media_file(file):
         )
 
 
-def _calculate_checksum_for_file(file):
-    """Calculate and return the xxhash64 checksum of a file-like object."""
-    if not file:
-        return None
-    file.seek(0)
-    file_hash = xxhash.xxh64()
-    for chunk in iter(lambda: file.read(4096), b""):
-        file_hash.update(chunk)
-    file.seek(0)  # Reset the file pointer for subsequent reads
-    return file_hash.hexdigest()
-
-
 def validate_unique_checksum(file):
     """Validator to ensure the uploaded file's content is unique."""
-    new_checksum = _calculate_checksum_for_file(file)
+    if settings.CHECKSUM_IN_BACKGROUND and not cached_checksum(file):
+        # Duplicates are reported by the "checksum" job instead
+        return
+    new_checksum = get_checksum(file)
+    if new_checksum and settings.MEDIA_CONTENT_ADDRESSED:
+        # Stored content is found with a single stat, without a query
+        ext = os.path.splitext(file.name)[1]
+        name = object_name(new_checksum, ext)
+        if file.storage.exists(name) and name != file.name:
+            raise ValidationError(
+                f"A file with the same content already exists: {name}"
+            )
     if new_checksum:
         query = File.objects.filter(checksum=new_checksum)
         if file.instance.pk:
@@ -224,7 +269,13 @@ def validate_unique_checksum(file):
 
 
 def file_upload_path(instance, filename):
-    """Generate upload path: media/<resource name>/<version>.<ext>"""
+    """Generate upload path: media/<resource name>/<version>.<ext>
+
+    With MEDIA_CONTENT_ADDRESSED the path is the object named by the checksum
+    (see core/storage.py) instead.
+    """
+    if settings.MEDIA_CONTENT_ADDRESSED and instance.checksum:
+        return object_name(instance.checksum, os.path.splitext(filename)[1])
     if instance.resource and instance.version:
         ext = os.path.splitext(filename)[1]
         return f"{instance.resource.name}/{instance.version}{ext}"
@@ -234,6 +285,7 @@ def file_upload_path(instance, filename):
 class File(models.Model):
     file = models.FileField(
         upload_to=file_upload_path,
+        storage=media_storage,
         validators=[validate_media_file, validate_unique_checksum],
     )
     resource = models.ForeignKey(
@@ -249,21 +301,64 @@ class File(models.Model):
         max_length=16, blank=True, editable=False, unique=True, null=True
     )
     checksum_at = models.DateTimeField(null=True, blank=True, editable=False)
+    duration = models.FloatField(
+        null=True, blank=True, editable=False, help_text="Length in seconds"
+    )
+    seek_index = models.JSONField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="MP4 layout and keyframe time-to-byte index (see core/mp4.py)",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def delete(self, *args, **kwargs):
         """Delete the file from the filesystem when the model is deleted."""
-        if self.file:
-            self.file.delete(save=False)
-        super().delete(*args, **kwargs)
+        # Checksums are unique, so no other row stores the same object
+        name = self.file.name
+        result = super().delete(*args, **kwargs)
+        if name:
+            self.file.storage.delete(name)
+        return result
 
     def save(self, *args, **kwargs):
-        """Generate checksum before saving."""
-        if self.file and not self.checksum:
-            self.checksum = _calculate_checksum_for_file(self.file)
+        """Generate checksum and queue post-upload processing for new files.
+
+        With CHECKSUM_IN_BACKGROUND the checksum is computed by a job too.
+        """
+        file_changed = bool(self.file) and not self.file._committed
+        kinds = list(settings.FILE_PROCESSING_JOBS) if file_changed else []
+        if settings.CHECKSUM_IN_BACKGROUND:
+            if file_changed:
+                # Chunked uploads already know their checksum
+                self.checksum = cached_checksum(self.file)
+                self.checksum_at = timezone.now() if self.checksum else None
+                if not self.checksum:
+                    kinds.insert(0, "checksum")
+        elif self.file and (file_changed or not self.checksum):
+            self.checksum = get_checksum(self.file)
             self.checksum_at = timezone.now()
         super().save(*args, **kwargs)
+        if kinds:
+            transaction.on_commit(lambda: self.enqueue_jobs(kinds))
+
+    def enqueue_jobs(self, kinds):
+        """Queue background jobs of the given kinds for this file.
+
+        With MP4_FASTSTART a "seek_index" job may rewrite the file, so it is
+        queued alone and queues the other kinds once it is done.
+        """
+        if (
+            "seek_index" in kinds
+            and settings.MP4_FASTSTART
+            and not settings.MEDIA_CONTENT_ADDRESSED
+        ):
+            then = [kind for kind in kinds if kind != "seek_index"]
+            return Job.objects.bulk_create(
+                [Job(kind="seek_index", file=self, payload={"then": then})]
+            )
+        return Job.objects.bulk_create(Job(kind=kind, file=self) for kind in kinds)
 
     def __str__(self):
         return f"{self.file} | {self.resource.name}"
@@ -280,6 +375,9 @@ class Annotation(models.Model):
     name = models.CharField(max_length=255, blank=True)
     annotations = models.JSONField(blank=True)
     history = models.JSONField(blank=True, null=True)
+    # Compiled from annotations on save (see core/timeline.py)
+    timeline = models.JSONField(blank=True, null=True, editable=False)
+    timeline_hash = models.CharField(max_length=16, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -287,6 +385,18 @@ class Annotation(models.Model):
         return f"{self.owner} | {self.file.resource.name} | {self.file.version} | {self.id}"
 
 
+class AnnotationImport(models.Model):
+    """A source file imported by ``manage.py import_hummedia``, by checksum."""
+
+    checksum = models.CharField(max_length=16, unique=True)
+    path = models.CharField(max_length=1024)
+    annotations = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.path} | {self.annotations} | {self.checksum}"
+
+
 class Clip(models.Model):
     file = models.ForeignKey(File, on_delete=models.CASCADE, related_name="clips")
     owner = models.ForeignKey(
@@ -300,6 +410,23 @@ class Clip(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    @property
+    def start_seconds(self):
+        return hms_to_seconds(self.start_time)
+
+    @property
+    def end_seconds(self):
+        return hms_to_seconds(self.end_time)
+
+    def clean(self):
+        super().clean()
+        try:
+            if self.end_seconds <= self.start_seconds:
+                raise ValidationError({"end_time": "End time must be after start time"})
+        except ValueError:
+            # Badly formatted times are reported by HMS_VALIDATOR
+            pass
+
     def __str__(self):
         return f"{self.name} | {self.start_time}-{self.end_time} | {self.file.resource.name} | {self.file.version} | {self.id}"
 
@@ -456,4 +583,81 @@ class Email(models.Model):
 
 class AuthToken(models.Model):
     token = models.CharField(max_length=150, null=True)
+    # Tokens saved without an expiry last API_TOKEN_LIFETIME from creation
+    expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class Upload(models.Model):
+    """In-progress resumable upload, finalized into a File (see core/uploads.py)."""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="uploads"
+    )
+    resource = models.ForeignKey(
+        Resource, on_delete=models.CASCADE, related_name="uploads"
+    )
+    version = models.CharField(max_length=100)
+    full_video = models.BooleanField(default=True)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    file = models.OneToOneField(
+        File, on_delete=models.SET_NULL, related_name="upload", null=True, blank=True
+    )
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} | {self.offset}/{self.size} | {self.id}"
+
+
+class Job(models.Model):
+    """Background work item processed by ``manage.py run_workers``."""
+
+    class Status(models.TextChoices):
+        QUEUED = ("queued", "Queued")
+        RUNNING = ("running", "Running")
+        DONE = ("done", "Done")
+        FAILED = ("failed", "Failed")
+
+    kind = models.CharField(max_length=50)
+    file = models.ForeignKey(
+        File, on_delete=models.CASCADE, related_name="jobs", null=True, blank=True
+    )
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(
+        max_length=7, choices=Status.choices, default=Status.QUEUED
+    )
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+    def __str__(self):
+        return f"{self.kind} | {self.status} | {self.file_id} | {self.id}"
+
+
+class WatchHistogram(models.Model):
+    """Aggregated playback of a Content, built by ``manage.py rollup_analytics``."""
+
+    content = models.OneToOneField(
+        Content, on_delete=models.CASCADE, related_name="watch_histogram"
+    )
+    bucket_seconds = models.IntegerField()
+    # Seconds watched and seeks landing in each bucket_seconds slice of the video
+    watch_seconds = models.JSONField(default=list)
+    seeks = models.JSONField(default=list)
+    plays = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.content.title} | {sum(self.watch_seconds):.0f}s watched"
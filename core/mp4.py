@@ -0,0 +1,265 @@
+"""Parse MP4 box structure to build keyframe seek indexes.
+
+Only the box headers and the ``moov`` box are read, so indexing a multi-GB
+file costs a few small reads. The index maps each video keyframe's time to
+the byte offset of its sample, which lets the player translate a seek into a
+single Range request. ``rewrite_faststart`` moves a trailing ``moov`` in
+front of the media data so browsers don't have to fetch the end of the file
+before playback can start.
+"""
+
+from array import array
+import os
+import struct
+import sys
+
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts", b"dinf"}
+MP4_EXTENSIONS = {".mp4", ".m4v", ".mov", ".m4a"}
+
+
+class MP4Error(Exception):
+    """Raised for files that are not valid MP4/QuickTime containers."""
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yield (type, offset, header_size, size) for boxes in ``data[start:end]``."""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, offset + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise MP4Error(f"Invalid {box_type!r} box at {offset}")
+        yield box_type, offset, header_size, size
+        offset += size
+
+
+def read_top_level_boxes(f):
+    """Return {type: (offset, size)} for the first top-level box of each type."""
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    boxes = {}
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        header = f.read(16)
+        size, box_type = struct.unpack_from(">I4s", header)
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", header, 8)
+        elif size == 0:
+            size = file_size - offset
+        if size < 8:
+            raise MP4Error(f"Invalid {box_type!r} box at {offset}")
+        boxes.setdefault(box_type, (offset, size))
+        offset += size
+    if b"moov" not in boxes:
+        raise MP4Error("No moov box")
+    return boxes
+
+
+def find_boxes(data, path, start=0, end=None):
+    """Yield (offset, header_size, size) of boxes at ``path`` (a list of types)."""
+    for box_type, offset, header_size, size in iter_boxes(data, start, end):
+        if box_type != path[0]:
+            continue
+        if len(path) == 1:
+            yield offset, header_size, size
+        elif box_type in CONTAINERS:
+            yield from find_boxes(data, path[1:], offset + header_size, offset + size)
+
+
+def find_box(data, path, start=0, end=None):
+    """Return the first box at ``path``, or None."""
+    for box in find_boxes(data, path, start, end):
+        return box
+    return None
+
+
+def _u32_table(data, box, columns=1, skip=0):
+    """Return the entries of a full box's table of big-endian 32-bit integers."""
+    offset, header_size, _ = box
+    (count,) = struct.unpack_from(">I", data, offset + header_size + 4 + skip)
+    values = array("I")
+    first = offset + header_size + 8 + skip
+    values.frombytes(data[first : first + count * columns * 4])
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values
+
+
+def _chunk_offsets(data, stbl_start, stbl_end):
+    box = find_box(data, [b"stco"], stbl_start, stbl_end)
+    if box:
+        return _u32_table(data, box)
+    box = find_box(data, [b"co64"], stbl_start, stbl_end)
+    if box is None:
+        raise MP4Error("No chunk offset table")
+    offset, header_size, _ = box
+    (count,) = struct.unpack_from(">I", data, offset + header_size + 4)
+    return struct.unpack_from(f">{count}Q", data, offset + header_size + 8)
+
+
+def _sample_sizes(data, stbl_start, stbl_end):
+    offset, header_size, _ = find_box(data, [b"stsz"], stbl_start, stbl_end)
+    sample_size, count = struct.unpack_from(">II", data, offset + header_size + 4)
+    if sample_size:
+        return [sample_size] * count
+    return _u32_table(data, (offset, header_size, 0), skip=4)
+
+
+def _video_track(data):
+    """Return (timescale, stbl_start, stbl_end) for the first video track."""
+    for offset, header_size, size in find_boxes(data, [b"moov", b"trak"]):
+        trak_start, trak_end = offset + header_size, offset + size
+        hdlr = find_box(data, [b"mdia", b"hdlr"], trak_start, trak_end)
+        mdhd = find_box(data, [b"mdia", b"mdhd"], trak_start, trak_end)
+        stbl = find_box(data, [b"mdia", b"minf", b"stbl"], trak_start, trak_end)
+        if not (hdlr and mdhd and stbl):
+            continue
+        handler = data[hdlr[0] + hdlr[1] + 8 : hdlr[0] + hdlr[1] + 12]
+        if handler != b"vide":
+            continue
+        version = data[mdhd[0] + mdhd[1]]
+        timescale_at = mdhd[0] + mdhd[1] + (20 if version == 1 else 12)
+        (timescale,) = struct.unpack_from(">I", data, timescale_at)
+        return timescale, stbl[0] + stbl[1], stbl[0] + stbl[2]
+    return None
+
+
+def keyframes(moov, min_interval=1.0):
+    """Return [(seconds, byte offset)] for the video keyframes described by ``moov``.
+
+    Without a sync sample table every sample is a keyframe, so samples are
+    thinned to at most one per ``min_interval`` seconds.
+    """
+    track = _video_track(moov)
+    if track is None:
+        return []
+    timescale, stbl_start, stbl_end = track
+
+    stts = _u32_table(moov, find_box(moov, [b"stts"], stbl_start, stbl_end), 2)
+    stsc = _u32_table(moov, find_box(moov, [b"stsc"], stbl_start, stbl_end), 3)
+    stss_box = find_box(moov, [b"stss"], stbl_start, stbl_end)
+    sync = set(_u32_table(moov, stss_box)) if stss_box else None
+    sizes = _sample_sizes(moov, stbl_start, stbl_end)
+    chunk_offsets = _chunk_offsets(moov, stbl_start, stbl_end)
+
+    # Decode time of each sample, from (count, delta) runs
+    times = array("d")
+    time = 0
+    for i in range(0, len(stts), 2):
+        count, delta = stts[i], stts[i + 1]
+        for _ in range(count):
+            times.append(time / timescale)
+            time += delta
+
+    index = []
+    last_time = None
+    sample = 1
+    for run in range(0, len(stsc), 3):
+        first_chunk, per_chunk = stsc[run], stsc[run + 1]
+        next_chunk = stsc[run + 3] if run + 3 < len(stsc) else len(chunk_offsets) + 1
+        for chunk in range(first_chunk, next_chunk):
+            offset = chunk_offsets[chunk - 1]
+            for _ in range(per_chunk):
+                if sample > len(sizes) or sample > len(times):
+                    return index
+                seconds = times[sample - 1]
+                is_key = (
+                    sample in sync
+                    if sync is not None
+                    else (last_time is None or seconds - last_time >= min_interval)
+                )
+                if is_key:
+                    index.append((round(seconds, 3), offset))
+                    last_time = seconds
+                offset += sizes[sample - 1]
+                sample += 1
+    return index
+
+
+def build_index(path):
+    """Return the seek index for an MP4 file as a JSON-serializable dict."""
+    with open(path, "rb") as f:
+        boxes = read_top_level_boxes(f)
+        moov_offset, moov_size = boxes[b"moov"]
+        f.seek(moov_offset)
+        moov = f.read(moov_size)
+    mdat = boxes.get(b"mdat")
+    index = keyframes(moov)
+    return {
+        "moov": [moov_offset, moov_size],
+        "mdat": list(mdat) if mdat else None,
+        "faststart": mdat is None or moov_offset < mdat[0],
+        "keyframes": [[seconds for seconds, _ in index], [o for _, o in index]],
+    }
+
+
+def rewrite_faststart(path):
+    """Move a trailing moov box in front of the media data, in place.
+
+    Returns False if the file already starts with its moov box or if chunk
+    offsets would overflow 32-bit stco tables.
+    """
+    with open(path, "rb") as f:
+        boxes = read_top_level_boxes(f)
+        moov_offset, moov_size = boxes[b"moov"]
+        mdat = boxes.get(b"mdat")
+        if mdat is None or moov_offset < mdat[0]:
+            return False
+        f.seek(moov_offset)
+        moov = bytearray(f.read(moov_size))
+
+    # Every chunk now lies moov_size bytes further into the file
+    for offset, header_size, _ in find_boxes(
+        moov, [b"moov", b"trak", b"mdia", b"minf", b"stbl", b"stco"]
+    ):
+        table = _u32_table(moov, (offset, header_size, 0))
+        if table and max(table) + moov_size > 0xFFFFFFFF:
+            return False
+        first = offset + header_size + 8
+        struct.pack_into(
+            f">{len(table)}I", moov, first, *(value + moov_size for value in table)
+        )
+    for offset, header_size, _ in find_boxes(
+        moov, [b"moov", b"trak", b"mdia", b"minf", b"stbl", b"co64"]
+    ):
+        (count,) = struct.unpack_from(">I", moov, offset + header_size + 4)
+        first = offset + header_size + 8
+        values = struct.unpack_from(f">{count}Q", moov, first)
+        struct.pack_into(
+            f">{count}Q", moov, first, *(value + moov_size for value in values)
+        )
+
+    tmp_path = f"{path}.faststart"
+    with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+        src.seek(0, os.SEEK_END)
+        file_size = src.tell()
+        # Copy everything before the first mdat, then moov, then the rest
+        # without the old moov
+        segments = [
+            (0, mdat[0]),
+            None,
+            (mdat[0], moov_offset),
+            (moov_offset + moov_size, file_size),
+        ]
+        for segment in segments:
+            if segment is None:
+                dst.write(moov)
+                continue
+            start, end = segment
+            src.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = src.read(min(8 * 1024 * 1024, remaining))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                remaining -= len(chunk)
+    os.replace(tmp_path, path)
+    return True
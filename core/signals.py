@@ -0,0 +1,231 @@
+"""Signal handlers, connected in CoreConfig.ready()."""
+
+import os
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_migrate
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from . import access
+from . import clips
+from . import hls
+from . import stream_cache
+from . import timeline
+from .models import Annotation
+from .models import Clip
+from .models import Collection
+from .models import CollectionUserAccess
+from .models import Course
+from .models import File
+from .models import FileKey
+from .models import Job
+from .models import Resource
+from .models import User
+from .storage import is_object_name
+from .storage import readable_name
+from .storage import resource_dir
+
+
+def file_readable_name(file_obj):
+    ext = os.path.splitext(file_obj.file.name)[1]
+    return readable_name(file_obj.resource.name, file_obj.version, ext)
+
+
+def is_stored_object(file_obj):
+    return (
+        settings.MEDIA_CONTENT_ADDRESSED
+        and bool(file_obj.file)
+        and is_object_name(file_obj.file.name)
+    )
+
+
+@receiver(post_migrate)
+def create_cache_table(sender, using, **kwargs):
+    # The database cache is shared by all processes; its table has no model
+    if sender.name == "core":
+        call_command("createcachetable", database=using, verbosity=0)
+
+
+@receiver(pre_save, sender=Resource)
+def remember_resource_name(sender, instance, **kwargs):
+    if settings.MEDIA_CONTENT_ADDRESSED and instance.pk:
+        instance._previous_name = (
+            Resource.objects.filter(pk=instance.pk)
+            .values_list("name", flat=True)
+            .first()
+        )
+
+
+@receiver(post_save, sender=Resource)
+def rename_resource_links(sender, instance, **kwargs):
+    previous = getattr(instance, "_previous_name", None)
+    if previous and previous != instance.name:
+        storage = File._meta.get_field("file").storage
+        storage.rename_dir(resource_dir(previous), resource_dir(instance.name))
+
+
+@receiver(pre_save, sender=File)
+def remember_file_link(sender, instance, **kwargs):
+    if settings.MEDIA_CONTENT_ADDRESSED and instance.pk:
+        previous = (
+            File.objects.select_related("resource").filter(pk=instance.pk).first()
+        )
+        if previous and is_stored_object(previous):
+            instance._previous_link = file_readable_name(previous)
+
+
+@receiver(post_save, sender=File)
+def link_file(sender, instance, **kwargs):
+    if not is_stored_object(instance):
+        return
+    storage = instance.file.storage
+    link_name = file_readable_name(instance)
+    previous = getattr(instance, "_previous_link", None)
+    if previous and previous != link_name:
+        storage.delete(previous)
+    storage.link(instance.file.name, link_name)
+
+
+@receiver(post_delete, sender=File)
+def unlink_file(sender, instance, **kwargs):
+    if is_stored_object(instance):
+        instance.file.storage.delete(file_readable_name(instance))
+
+
+@receiver(post_delete, sender=File)
+def remove_derived_media(sender, instance, **kwargs):
+    if instance.checksum:
+        hls.remove(instance.checksum)
+        clips.remove_all(instance.checksum)
+
+
+@receiver(pre_save, sender=Annotation)
+def compile_annotation_timeline(sender, instance, **kwargs):
+    timeline.compile_annotation(instance)
+
+
+def clip_asset(clip):
+    """Return (asset key, extension) identifying a clip's pre-cut asset."""
+    return clips.asset_key(clip), os.path.splitext(clip.file.file.name)[1]
+
+
+def remove_unshared_asset(clip, asset):
+    """Remove a clip's asset unless another clip plays the same window."""
+    key, ext = asset
+    others = Clip.objects.filter(file_id=clip.file_id).exclude(pk=clip.pk)
+    if key[0] and not any(clips.asset_key(other) == key for other in others):
+        clips.remove(*key, ext)
+
+
+@receiver(pre_save, sender=Clip)
+def remember_clip_asset(sender, instance, **kwargs):
+    if instance.pk:
+        previous = Clip.objects.select_related("file").filter(pk=instance.pk).first()
+        if previous:
+            instance._previous_asset = clip_asset(previous)
+            instance._previous_file_id = previous.file_id
+
+
+@receiver(post_save, sender=Clip)
+def cut_clip(sender, instance, **kwargs):
+    previous = getattr(instance, "_previous_asset", None)
+    if previous == clip_asset(instance):
+        return
+    if previous:
+        # Times changed: the old window's asset is no longer needed
+        old_clip = Clip(pk=instance.pk, file_id=instance._previous_file_id)
+        remove_unshared_asset(old_clip, previous)
+    transaction.on_commit(
+        lambda: Job.objects.create(
+            kind="cut_clip", file=instance.file, payload={"clip": instance.pk}
+        )
+    )
+
+
+@receiver(post_delete, sender=Clip)
+def remove_clip_asset(sender, instance, **kwargs):
+    try:
+        asset = clip_asset(instance)
+    except File.DoesNotExist:
+        return
+    remove_unshared_asset(instance, asset)
+
+
+@receiver(post_save, sender=File)
+@receiver(post_delete, sender=File)
+def invalidate_file_stream_meta(sender, instance, **kwargs):
+    stream_cache.invalidate(file_id=instance.id)
+
+
+@receiver(post_save, sender=FileKey)
+@receiver(post_delete, sender=FileKey)
+def invalidate_file_key_stream_meta(sender, instance, **kwargs):
+    stream_cache.invalidate(file_key=instance.id)
+
+
+@receiver(pre_save, sender=Collection)
+def remember_collection_owner(sender, instance, **kwargs):
+    if instance.pk:
+        instance._previous_owner_id = (
+            Collection.objects.filter(pk=instance.pk)
+            .values_list("owner_id", flat=True)
+            .first()
+        )
+
+
+@receiver(post_save, sender=Collection)
+def refresh_collection_access(sender, instance, created, **kwargs):
+    if created or getattr(instance, "_previous_owner_id", None) != instance.owner_id:
+        access.refresh_on_commit(collection_ids=[instance.pk])
+
+
+@receiver(post_save, sender=CollectionUserAccess)
+@receiver(post_delete, sender=CollectionUserAccess)
+def refresh_user_access(sender, instance, **kwargs):
+    access.refresh_on_commit([instance.user_id], [instance.collection_id])
+
+
+@receiver(m2m_changed, sender=User.courses.through)
+def refresh_course_members_access(sender, instance, action, reverse, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if reverse:
+        # Members of a course changed: recompute the collections it is linked to
+        collection_ids = list(instance.collections.values_list("id", flat=True))
+        access.refresh_on_commit(collection_ids=collection_ids)
+    else:
+        access.refresh_on_commit(user_ids=[instance.pk])
+
+
+@receiver(m2m_changed, sender=Collection.courses.through)
+def refresh_course_collections_access(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            access.refresh_on_commit(collection_ids=[instance.pk])
+        return
+    if action == "pre_clear":
+        # The cleared collections are not passed to post_clear
+        instance._cleared_collection_ids = list(
+            instance.collections.values_list("id", flat=True)
+        )
+    elif action == "post_clear":
+        access.refresh_on_commit(collection_ids=instance._cleared_collection_ids)
+    elif action in ("post_add", "post_remove"):
+        access.refresh_on_commit(collection_ids=list(pk_set))
+
+
+@receiver(pre_delete, sender=Course)
+def refresh_deleted_course_access(sender, instance, **kwargs):
+    # Deleting a course removes its links without m2m_changed signals
+    collection_ids = list(instance.collections.values_list("id", flat=True))
+    if collection_ids:
+        access.refresh_on_commit(collection_ids=collection_ids)
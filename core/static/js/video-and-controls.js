@@ -32,7 +32,10 @@
 
         // Event data
         events: [],
+        timeline: null,
+        eventMuted: false,
         subtitles: [],
+        clips: [],
         displaySubtitles: null,
         subtitleTextIndex: null,
 
@@ -41,6 +44,16 @@
         iconTimer: null
     };
 
+    // Playback analytics, sent in batches (see core/analytics.py)
+    const analytics = {
+        url: null,
+        contentId: null,
+        queue: [],
+        lastTime: 0,
+        maxBatch: 500,
+        flushInterval: 15000
+    };
+
     // Initialize player when DOM is loaded
     function init() {
         // Get DOM elements
@@ -62,12 +75,20 @@
         }
 
         // Load data from Django context
+        const playerData = document.getElementById('player-data');
+        if (playerData) {
+            window.playerData = JSON.parse(playerData.textContent);
+        }
         if (window.playerData) {
-            player.events = window.playerData.events || [];
+            if (window.playerData.timeline) {
+                loadTimeline(window.playerData.timeline);
+            }
             player.subtitles = window.playerData.subtitles || [];
+            player.clips = window.playerData.clips || [];
         }
 
         bindEvents();
+        initAnalytics();
         checkBrowser();
         handleAspectRatio();
     }
@@ -381,29 +402,59 @@
         player.subtitleTextIndex = null;
     }
 
-    function handleEvents() {
-        if (!player.events || player.events.length === 0) return;
+    function loadTimeline(url) {
+        // The URL changes with the timeline's contents, so the browser may cache it
+        fetch(url)
+            .then(response => response.json())
+            .then(timeline => {
+                timeline.events.forEach(event => { event.active = true; });
+                player.timeline = timeline;
+                player.events = timeline.events;
+                if (player.duration) {
+                    loadSkipEvents();
+                }
+            })
+            .catch(error => console.error('Could not load annotations', error));
+    }
 
-        player.events.forEach(event => {
-            if (!event.active) return;
+    function activeEvents(time) {
+        // Last boundary at or before time; see core/timeline.py
+        const times = player.timeline.times;
+        let low = 0;
+        let high = times.length;
+        while (low < high) {
+            const mid = (low + high) >> 1;
+            if (times[mid] <= time) {
+                low = mid + 1;
+            } else {
+                high = mid;
+            }
+        }
+        return low ? player.timeline.active[low - 1].map(i => player.events[i]) : [];
+    }
 
-            const startTime = parseFloat(event.start);
-            const endTime = parseFloat(event.end || event.start);
+    function handleEvents() {
+        if (!player.timeline) return;
 
-            if (player.currentTime >= startTime && player.currentTime <= endTime) {
+        const events = activeEvents(player.currentTime);
+        events.forEach(event => {
+            if (event.active) {
                 executeEvent(event);
-            } else if (player.currentTime > endTime && event.type === 'Mute' && player.muted) {
-                player.muted = false;
-                player.video.muted = false;
-                event.active = false;
             }
         });
+
+        if (player.eventMuted && !events.some(event => event.type === 'Mute')) {
+            player.eventMuted = false;
+            player.muted = false;
+            player.video.muted = false;
+        }
     }
 
     function executeEvent(event) {
         switch (event.type) {
             case 'Mute':
                 if (!player.muted) {
+                    player.eventMuted = true;
                     player.muted = true;
                     player.video.muted = true;
                 }
@@ -417,7 +468,7 @@
                 break;
             case 'Skip':
                 event.active = false;
-                handleSeek(parseFloat(event.end));
+                handleSeek(event.end);
                 break;
         }
     }
@@ -432,8 +483,8 @@
         const skipEvents = player.events.filter(event => event.type === 'Skip');
 
         skipEvents.forEach(event => {
-            const startPercent = (parseFloat(event.start) / player.duration) * 100;
-            const endPercent = (parseFloat(event.end) / player.duration) * 100;
+            const startPercent = (event.start / player.duration) * 100;
+            const endPercent = (event.end / player.duration) * 100;
 
             const skipElement = document.createElement('div');
             skipElement.className = 'skip-event';
@@ -446,8 +497,7 @@
 
     function reactivateEvents(seekTime) {
         player.events.forEach(event => {
-            const endTime = parseFloat(event.end || event.start);
-            if (seekTime < endTime && !event.active) {
+            if (seekTime < event.end && !event.active) {
                 event.active = true;
             }
         });
@@ -483,6 +533,65 @@
         }
     }
 
+    function initAnalytics() {
+        analytics.url = player.video.dataset.analyticsUrl;
+        analytics.contentId = parseInt(player.video.dataset.contentId, 10);
+        if (!analytics.url || !analytics.contentId) {
+            return;
+        }
+        const heartbeat = parseFloat(player.video.dataset.analyticsHeartbeat) || 5;
+
+        player.video.addEventListener('play', () => trackEvent('play'));
+        player.video.addEventListener('pause', () => trackEvent('pause'));
+        player.video.addEventListener('ended', () => trackEvent('ended'));
+        player.video.addEventListener('seeking', () => trackEvent('seek', analytics.lastTime, player.video.currentTime));
+        player.video.addEventListener('timeupdate', () => {
+            if (!player.video.seeking) {
+                analytics.lastTime = player.video.currentTime;
+            }
+        });
+
+        setInterval(() => {
+            if (player.playing) {
+                trackEvent('heartbeat');
+            }
+        }, heartbeat * 1000);
+        setInterval(flushAnalytics, analytics.flushInterval);
+        document.addEventListener('visibilitychange', () => {
+            if (document.visibilityState === 'hidden') {
+                flushAnalytics();
+            }
+        });
+        window.addEventListener('pagehide', flushAnalytics);
+    }
+
+    function trackEvent(type, time = player.video.currentTime, to = undefined) {
+        const event = { type: type, t: time };
+        if (to !== undefined) {
+            event.to = to;
+        }
+        analytics.queue.push(event);
+    }
+
+    function flushAnalytics() {
+        while (analytics.queue.length) {
+            const body = JSON.stringify({
+                content: analytics.contentId,
+                events: analytics.queue.splice(0, analytics.maxBatch)
+            });
+            // sendBeacon survives the page being closed; fall back to fetch
+            const blob = new Blob([body], { type: 'application/json' });
+            if (!navigator.sendBeacon || !navigator.sendBeacon(analytics.url, blob)) {
+                fetch(analytics.url, {
+                    method: 'POST',
+                    body: body,
+                    keepalive: true,
+                    headers: { 'Content-Type': 'application/json' }
+                }).catch(() => {});
+            }
+        }
+    }
+
     function checkBrowser() {
         const isSafari = /^((?!chrome|android).)*safari/i.test(navigator.userAgent);
         const isIOS = /iPad|iPhone|iPod/.test(navigator.userAgent);
@@ -0,0 +1,93 @@
+"""Content-addressed media storage.
+
+With ``MEDIA_CONTENT_ADDRESSED`` enabled, uploaded bytes are stored once under
+``objects/<aa>/<bb>/<checksum><ext>``, named by their xxhash64 checksum, so
+identical content is never written twice and checking whether content is
+already stored is a single ``stat``. Human-readable paths
+(``by-name/<resource name>/<version><ext>``) are hard links to the objects,
+maintained by the signal handlers in ``core.signals``; renaming a resource
+renames one directory and orphans nothing.
+"""
+
+import os
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+
+OBJECTS_DIR = "objects"
+INCOMING_DIR = "objects/incoming"
+NAMES_DIR = "by-name"
+
+
+def object_name(checksum, ext):
+    """Return the storage name of the object holding content with ``checksum``."""
+    return f"{OBJECTS_DIR}/{checksum[:2]}/{checksum[2:4]}/{checksum}{ext.lower()}"
+
+
+def is_object_name(name):
+    return name.startswith(OBJECTS_DIR + "/") and not name.startswith(
+        INCOMING_DIR + "/"
+    )
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage that stores each object name at most once."""
+
+    def get_available_name(self, name, max_length=None):
+        if is_object_name(name):
+            # The same object name always means the same bytes
+            return name
+        return super().get_available_name(name, max_length)
+
+    def _save(self, name, content):
+        if not is_object_name(name):
+            return super()._save(name, content)
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            return name
+        incoming = super()._save(f"{INCOMING_DIR}/{uuid.uuid4().hex}", content)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        try:
+            # Atomic: if another upload stored the same bytes first, keep theirs
+            os.link(self.path(incoming), full_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(self.path(incoming))
+        return name
+
+    def link(self, name, link_name):
+        """Point the hard link ``link_name`` at the object ``name``."""
+        link_path = self.path(link_name)
+        os.makedirs(os.path.dirname(link_path), exist_ok=True)
+        tmp_path = f"{link_path}.{uuid.uuid4().hex}.tmp"
+        os.link(self.path(name), tmp_path)
+        os.replace(tmp_path, link_path)
+
+    def rename_dir(self, old_name, new_name):
+        """Rename a directory of readable names, if it exists."""
+        old_path = self.path(old_name)
+        if os.path.isdir(old_path):
+            new_path = self.path(new_name)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(old_path, new_path)
+
+
+def media_storage():
+    """Storage for File.file.
+
+    It stores names other than objects like FileSystemStorage, and object
+    names are only generated while MEDIA_CONTENT_ADDRESSED is set, so the
+    setting is read per upload rather than when models are loaded.
+    """
+    return ContentAddressedStorage()
+
+
+def resource_dir(resource_name):
+    """Return the directory holding the readable names of a resource's files."""
+    return f"{NAMES_DIR}/{resource_name}"
+
+
+def readable_name(resource_name, version, ext):
+    """Return the human-readable link name for a File's object."""
+    return f"{resource_dir(resource_name)}/{version}{ext}"
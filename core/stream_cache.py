@@ -0,0 +1,133 @@
+"""Per-process LRU cache of what ``stream_file`` needs to serve a FileKey.
+
+A viewing session makes hundreds of Range requests for the same FileKey.
+The first resolves the FileKey and File rows, stats the file and derives its
+content type and validators; the rest reuse that result for up to
+``STREAM_METADATA_CACHE_TTL`` seconds, with no queries and no syscalls before
+the file is opened. Saving or deleting a File or FileKey drops its entries
+in the current process (see core.signals); the TTL bounds staleness in other
+processes and after bulk ``update()`` calls, which send no signals.
+"""
+
+import asyncio
+from collections import OrderedDict
+import os
+import threading
+import time
+from typing import NamedTuple
+
+from django.conf import settings
+
+from .models import FileKey
+from .streaming import guess_content_type
+
+
+class StreamMeta(NamedTuple):
+    file_key: int
+    user_id: int
+    file_id: int
+    path: str
+    name: str
+    size: int
+    last_modified: int
+    content_type: str
+    etag: str
+
+
+_entries = OrderedDict()  # FileKey id -> (expires, StreamMeta)
+_lock = threading.Lock()
+
+
+def stream_meta(file_key_obj):
+    """Return the StreamMeta of a FileKey with its File, or None if there is no file."""
+    file_obj = file_key_obj.file
+    if not file_obj.file:
+        return None
+    path = file_obj.file.path
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # The stored xxhash64 checksum is a strong validator; files without one
+    # fall back to a weak size/mtime tag, which never satisfies If-Range
+    if file_obj.checksum:
+        etag = f'"{file_obj.checksum}"'
+    else:
+        etag = f'W/"{stat.st_size}-{stat.st_mtime}"'
+    return StreamMeta(
+        file_key=file_key_obj.id,
+        user_id=file_key_obj.user_id,
+        file_id=file_obj.id,
+        path=path,
+        name=file_obj.file.name,
+        size=stat.st_size,
+        last_modified=int(stat.st_mtime),
+        content_type=guess_content_type(path),
+        etag=etag,
+    )
+
+
+def get(file_key):
+    with _lock:
+        entry = _entries.get(file_key)
+        if entry is None:
+            return None
+        expires, meta = entry
+        if expires < time.monotonic():
+            del _entries[file_key]
+            return None
+        _entries.move_to_end(file_key)
+        return meta
+
+
+def put(meta):
+    with _lock:
+        _entries[meta.file_key] = (
+            time.monotonic() + settings.STREAM_METADATA_CACHE_TTL,
+            meta,
+        )
+        _entries.move_to_end(meta.file_key)
+        while len(_entries) > settings.STREAM_METADATA_CACHE_SIZE:
+            _entries.popitem(last=False)
+
+
+def resolve(file_key):
+    """Return the StreamMeta for a FileKey id, or None if it has no servable file."""
+    meta = get(file_key)
+    if meta is None:
+        file_key_obj = (
+            FileKey.objects.select_related("file").filter(id=file_key).first()
+        )
+        meta = file_key_obj and stream_meta(file_key_obj)
+        if meta:
+            put(meta)
+    return meta
+
+
+async def aresolve(file_key):
+    """Async resolve for async views; the stat runs in a worker thread."""
+    meta = get(file_key)
+    if meta is None:
+        file_key_obj = (
+            await FileKey.objects.select_related("file").filter(id=file_key).afirst()
+        )
+        if file_key_obj:
+            meta = await asyncio.to_thread(stream_meta, file_key_obj)
+        if meta:
+            put(meta)
+    return meta
+
+
+def invalidate(file_key=None, file_id=None):
+    """Drop the entry of a FileKey id, or all entries of a File id."""
+    with _lock:
+        if file_key is not None:
+            _entries.pop(file_key, None)
+        if file_id is not None:
+            for key in [k for k, (_, m) in _entries.items() if m.file_id == file_id]:
+                del _entries[key]
+
+
+def clear():
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,354 @@
+"""Serve media files over HTTP with byte-range support.
+
+Single ranges are answered with a ``FileResponse`` around a window of the file,
+so WSGI servers that implement ``wsgi.file_wrapper`` with ``sendfile``
+(gunicorn, uWSGI) hand the bytes to the kernel without copying them through
+Python. Multiple ranges are streamed as ``multipart/byteranges`` in bounded
+blocks. With ``asynchronous=True`` bodies are async iterators whose reads run
+in worker threads, so ASGI servers can serve many slow clients from a few
+processes. When ``STREAM_OFFLOAD`` is set, the front-end web server is asked to
+send the file instead (``X-Accel-Redirect`` for nginx, ``X-Sendfile`` for
+Apache/lighttpd).
+"""
+
+import asyncio
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import get_random_string
+from django.utils.http import http_date
+from django.utils.http import parse_http_date_safe
+
+from . import chunk_cache
+
+RANGE_SPEC_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+# More ranges than this (after merging) is almost certainly abuse; RFC 9110
+# allows ignoring the Range header and sending the whole file instead.
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when none of the requested ranges overlap the file."""
+
+
+# Media types of the extensions accepted by validate_media_file, looked up
+# before falling back to the mimetypes registry
+CONTENT_TYPES = {
+    ".mp4": "video/mp4",
+    ".m4v": "video/mp4",
+    ".webm": "video/webm",
+    ".mov": "video/quicktime",
+    ".qt": "video/quicktime",
+    ".avi": "video/x-msvideo",
+    ".mkv": "video/x-matroska",
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+    ".aac": "audio/aac",
+    ".wav": "audio/wav",
+    ".flac": "audio/flac",
+    ".ogg": "audio/ogg",
+}
+
+
+def guess_content_type(path):
+    """Return the MIME type for a media file path."""
+    content_type = CONTENT_TYPES.get(os.path.splitext(path)[1].lower())
+    if content_type:
+        return content_type
+    content_type, _ = mimetypes.guess_type(path)
+    return content_type or "application/octet-stream"
+
+
+def parse_range_header(header, size):
+    """Parse a Range header into a sorted list of inclusive (start, end) pairs.
+
+    Overlapping and adjacent ranges are merged. Returns None when the header
+    should be ignored (absent, malformed, or too many ranges) and raises
+    RangeNotSatisfiable when no range overlaps a file of ``size`` bytes.
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+
+    ranges = []
+    for spec in header[len("bytes=") :].split(","):
+        match = RANGE_SPEC_RE.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+        if not first:
+            # Suffix range like "bytes=-500": the last 500 bytes
+            if not last:
+                return None
+            length = int(last)
+            if length == 0 or size == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+            continue
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+class FileRange:
+    """Read-only file object limited to ``length`` bytes starting at ``start``.
+
+    It exposes ``fileno()`` and leaves the OS file position at ``start`` so
+    ``sendfile``-based file wrappers can send the window directly; they take
+    the byte count from the response's Content-Length.
+    """
+
+    def __init__(self, path, start, length):
+        self.file = open(path, "rb")
+        self.file.seek(start)
+        self.remaining = length
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+async def aiter_file_range(path, start, length, block_size):
+    """Yield ``length`` bytes of ``path`` from ``start`` without blocking the loop.
+
+    When an ASGI client disconnects Django cancels the response, which stops
+    the reads at the next await and closes the file.
+    """
+    fd = await asyncio.to_thread(os.open, path, os.O_RDONLY)
+    try:
+        offset = start
+        remaining = length
+        while remaining > 0:
+            chunk = await asyncio.to_thread(
+                os.pread, fd, min(block_size, remaining), offset
+            )
+            if not chunk:
+                break
+            offset += len(chunk)
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(os.close, fd)
+
+
+def if_range_matches(request, etag, last_modified):
+    """Return whether a Range request may be honored under its If-Range header.
+
+    An entity tag must match strongly; a date must equal Last-Modified.
+    """
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range:
+        return True
+    if if_range.startswith(('"', "W/")):
+        return (
+            etag is not None and not etag.startswith("W/") and if_range.strip() == etag
+        )
+    date = parse_http_date_safe(if_range)
+    return date is not None and last_modified is not None and date == last_modified
+
+
+def iter_multipart_ranges(path, parts, closing, block_size):
+    """Yield a multipart/byteranges body for pre-rendered part headers."""
+    with open(path, "rb") as f:
+        for header, (start, end) in parts:
+            yield header
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(block_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+            yield b"\r\n"
+    yield closing
+
+
+async def aiter_multipart_ranges(path, parts, closing, block_size):
+    """Async counterpart of iter_multipart_ranges."""
+    for header, (start, end) in parts:
+        yield header
+        async for chunk in aiter_file_range(path, start, end - start + 1, block_size):
+            yield chunk
+        yield b"\r\n"
+    yield closing
+
+
+def file_window_response(
+    path, start, length, status, content_type, asynchronous, cache_key=None
+):
+    """Return a response whose body is ``length`` bytes of ``path`` from ``start``.
+
+    With a ``cache_key`` the body is read through core.chunk_cache.
+    """
+    if cache_key:
+        iter_range = chunk_cache.aiter_range if asynchronous else chunk_cache.iter_range
+        response = StreamingHttpResponse(
+            iter_range(path, cache_key, start, length),
+            status=status,
+            content_type=content_type,
+        )
+    elif asynchronous:
+        response = StreamingHttpResponse(
+            aiter_file_range(path, start, length, settings.STREAM_BLOCK_SIZE),
+            status=status,
+            content_type=content_type,
+        )
+    else:
+        response = FileResponse(
+            FileRange(path, start, length), status=status, content_type=content_type
+        )
+        response.block_size = settings.STREAM_BLOCK_SIZE
+    response["Content-Length"] = str(length)
+    return response
+
+
+def offload_response(path, name, content_type):
+    """Ask the front-end server to send the file (it handles Range itself)."""
+    response = HttpResponse(content_type=content_type)
+    if settings.STREAM_OFFLOAD == "x-accel-redirect":
+        response["X-Accel-Redirect"] = settings.STREAM_OFFLOAD_PREFIX + quote(name)
+    elif settings.STREAM_OFFLOAD == "x-sendfile":
+        response["X-Sendfile"] = path
+    else:
+        raise ValueError(f"Unknown STREAM_OFFLOAD mode: {settings.STREAM_OFFLOAD}")
+    return response
+
+
+def serve_file(
+    request,
+    path,
+    name,
+    content_type=None,
+    headers=None,
+    etag=None,
+    last_modified=None,
+    asynchronous=False,
+    size=None,
+    cache_key=None,
+):
+    """Return a response streaming ``path`` that honors the request's Range header.
+
+    ``name`` is the storage-relative name used for offloaded responses and
+    ``headers`` are extra headers (e.g. caching) added to every response,
+    including 304s and 416s. ``etag`` and ``last_modified`` (a timestamp) are
+    the validators used for If-None-Match, If-Modified-Since and If-Range.
+    ``asynchronous`` selects async iterator bodies for async views, which
+    should call this in a worker thread since it may stat ``path``. ``size``
+    saves the stat when the caller already knows the file's size. Single ranges
+    and full responses are read through core.chunk_cache with ``cache_key``
+    (which must change whenever the content does) if STREAM_CHUNK_CACHE is set.
+    """
+    content_type = content_type or guess_content_type(path)
+    headers = dict(headers or {})
+    if etag:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        # 304 Not Modified or 412 Precondition Failed
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    if settings.STREAM_OFFLOAD:
+        response = offload_response(path, name, content_type)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    if size is None:
+        size = os.path.getsize(path)
+    if not settings.STREAM_CHUNK_CACHE:
+        cache_key = None
+    try:
+        if if_range_matches(request, etag, last_modified):
+            ranges = parse_range_header(request.META.get("HTTP_RANGE"), size)
+        else:
+            ranges = None
+    except RangeNotSatisfiable:
+        response = HttpResponse(status=416)  # Range Not Satisfiable
+        response["Content-Range"] = f"bytes */{size}"
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    if ranges is None:
+        response = file_window_response(
+            path, 0, size, 200, content_type, asynchronous, cache_key
+        )
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = file_window_response(
+            path, start, end - start + 1, 206, content_type, asynchronous, cache_key
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    else:
+        boundary = get_random_string(32)
+        parts = [
+            (
+                (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+                ).encode("ascii"),
+                (start, end),
+            )
+            for start, end in ranges
+        ]
+        closing = f"--{boundary}--\r\n".encode("ascii")
+        length = len(closing) + sum(
+            len(header) + (end - start + 1) + 2 for header, (start, end) in parts
+        )
+        iter_parts = aiter_multipart_ranges if asynchronous else iter_multipart_ranges
+        response = StreamingHttpResponse(
+            iter_parts(path, parts, closing, settings.STREAM_BLOCK_SIZE),
+            status=206,
+            content_type=f"multipart/byteranges; boundary={boundary}",
+        )
+        response["Content-Length"] = str(length)
+
+    response["Accept-Ranges"] = "bytes"
+    for header, value in headers.items():
+        response[header] = value
+    return response
@@ -1,8 +1,75 @@
 # Create your tests here.
 
+import asyncio
+from collections import Counter
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+from unittest import mock
+from unittest import skipUnless
+
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import AsyncRequestFactory
 from django.test import TestCase
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+import requests
+import xxhash
 
+from . import access
+from . import analytics
 from . import api
+from . import checksums
+from . import chunk_cache
+from . import clips
+from . import hls
+from . import hummedia
+from . import interpolation
+from . import jobs
+from . import mp4
+from . import stream_tokens
+from . import streaming
+from . import throttle
+from . import timeline
+from . import uploads
+from . import view_counts
+from .models import Annotation
+from .models import AnnotationImport
+from .models import AuthToken
+from .models import Clip
+from .models import Collection
+from .models import CollectionRole
+from .models import CollectionUserAccess
+from .models import Content
+from .models import Course
+from .models import EffectiveAccess
+from .models import File
+from .models import FileKey
+from .models import Job
+from .models import Language
+from .models import PrivilegeLevel
+from .models import Resource
+from .models import Subtitle
+from .models import User
+from .models import hms_to_seconds
+from .models import validate_unique_checksum
+from .storage import object_name
+from .views import stream_file_async
+from .views import stream_token_async
 
 
 class ApiTests(TestCase):
@@ -28,3 +95,1927 @@ class ApiTests(TestCase):
         self.assertEqual(spring_to_summer, "20264")
         summer_to_fall = new_api.calculate_next_year_term("20264")
         self.assertEqual(summer_to_fall, "20265")
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class StreamFileTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(netid="student1")
+        resource = Resource.objects.create(name="Lecture", requester_netid="prof1")
+        self.data = bytes(range(256)) * 64
+        self.file = File(resource=resource, version="1")
+        self.file.file.save("lecture.mp4", ContentFile(self.data))
+        self.file_key = FileKey.objects.create(user=self.user, file=self.file)
+        self.url = reverse("stream_file", args=[self.file_key.id])
+        self.client.force_login(self.user)
+
+    def test_full_file(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Length"], str(len(self.data)))
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+    def test_single_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=100-199")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 100-199/{len(self.data)}")
+        self.assertEqual(b"".join(response.streaming_content), self.data[100:200])
+
+    def test_suffix_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-10")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.data[-10:])
+
+    def test_multiple_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-9,20-29")
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response["Content-Type"].startswith("multipart/byteranges"))
+        body = b"".join(response.streaming_content)
+        self.assertEqual(len(body), int(response["Content-Length"]))
+        self.assertIn(self.data[0:10], body)
+        self.assertIn(self.data[20:30], body)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={len(self.data)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.data)}")
+
+    def test_if_none_match(self):
+        etag = f'"{self.file.checksum}"'
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get(self.url)["Last-Modified"]
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_range(self):
+        etag = f'"{self.file.checksum}"'
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE=etag
+        )
+        self.assertEqual(response.status_code, 206)
+        response = self.client.get(
+            self.url, HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE='"stale"'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+    async def test_async_range(self):
+        request = AsyncRequestFactory().get(
+            self.url, headers={"Range": "bytes=100-199"}
+        )
+
+        async def auser():
+            return self.user
+
+        request.auser = auser
+
+        def serve_file(*args, **kwargs):
+            # Not on the event loop, where stats and opens would block it
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return streaming.serve_file(*args, **kwargs)
+
+        with mock.patch("core.views.serve_file", serve_file):
+            response = await stream_file_async(request, self.file_key.id)
+        self.assertEqual(response.status_code, 206)
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(body, self.data[100:200])
+
+    def test_metadata_cached(self):
+        self.client.get(self.url)
+        # Only the viewer's session and user; the FileKey was issued to them
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, HTTP_RANGE="bytes=0-9")
+        self.assertEqual(b"".join(response.streaming_content), self.data[:10])
+
+        # Saving the File drops its cached metadata
+        self.file.file.save("lecture.mp4", ContentFile(b"new content"))
+        response = self.client.get(self.url)
+        self.assertEqual(b"".join(response.streaming_content), b"new content")
+
+    def test_stream_token(self):
+        self.file_key.file = self.file
+        url = reverse("stream_token", args=[stream_tokens.mint(self.file_key)])
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_RANGE="bytes=100-199")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Type"], "video/mp4")
+        self.assertEqual(response["ETag"], f'"{self.file.checksum}"')
+        self.assertEqual(b"".join(response.streaming_content), self.data[100:200])
+
+        request = AsyncRequestFactory().get(url)
+        token = url.rsplit("/", 1)[1]
+        response = async_to_sync(stream_token_async)(request, token)
+        self.assertEqual(response.status_code, 200)
+
+    def test_stream_token_rejected(self):
+        self.file_key.file = self.file
+        token = stream_tokens.mint(self.file_key)
+        tampered = reverse("stream_token", args=[token[:-1] + "x"])
+        self.assertEqual(self.client.get(tampered).status_code, 404)
+        with self.settings(STREAM_TOKEN_MAX_AGE=-1):
+            response = self.client.get(reverse("stream_token", args=[token]))
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(STREAM_OFFLOAD="x-accel-redirect")
+    def test_offload(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-9")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response["X-Accel-Redirect"], f"/protected-media/{self.file.file.name}"
+        )
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ChecksumTests(TestCase):
+    def setUp(self):
+        self.resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        self.data = b"frame" * 100000
+
+    def test_calculate_checksum(self):
+        expected = xxhash.xxh64(self.data).hexdigest()
+        self.assertEqual(checksums.calculate_checksum(ContentFile(self.data)), expected)
+        with tempfile.TemporaryFile() as f:
+            f.write(self.data)
+            self.assertEqual(checksums.calculate_checksum(f), expected)
+
+    def test_upload_hashed_once(self):
+        file_obj = File(resource=self.resource, version="1")
+        file_obj.file = SimpleUploadedFile("film.mp4", self.data)
+        with mock.patch(
+            "core.checksums.calculate_checksum", wraps=checksums.calculate_checksum
+        ) as calculate:
+            file_obj.full_clean()
+            file_obj.save()
+        self.assertEqual(calculate.call_count, 1)
+        self.assertEqual(file_obj.checksum, xxhash.xxh64(self.data).hexdigest())
+
+    def test_duplicate_rejected(self):
+        File.objects.create(
+            resource=self.resource,
+            version="1",
+            file=SimpleUploadedFile("film.mp4", self.data),
+        )
+        duplicate = File(resource=self.resource, version="2")
+        duplicate.file = SimpleUploadedFile("copy.mp4", self.data)
+        with self.assertRaises(ValidationError):
+            duplicate.full_clean()
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), JOB_RETRY_DELAY=0)
+class JobTests(TestCase):
+    def setUp(self):
+        self.resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        # Handlers registered by a test are removed after it
+        self.enterContext(mock.patch.dict(jobs.HANDLERS))
+
+    def test_claim_and_run(self):
+        calls = []
+        jobs.handler("test")(calls.append)
+        job = jobs.enqueue("test", answer=42)
+        claimed = jobs.claim_job("worker-1")
+        self.assertEqual(claimed.id, job.id)
+        self.assertIsNone(jobs.claim_job("worker-2"))
+        jobs.run_job(claimed)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.DONE)
+        self.assertEqual(calls[0].payload, {"answer": 42})
+
+    def test_retry_then_fail(self):
+        jobs.handler("broken")(lambda job: 1 / 0)
+        job = jobs.enqueue("broken")
+        with self.settings(JOB_MAX_ATTEMPTS=2), self.assertLogs("core.jobs"):
+            jobs.work("worker-1", burst=True)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.Status.FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIn("ZeroDivisionError", job.error)
+
+    @override_settings(CHECKSUM_IN_BACKGROUND=True, FILE_PROCESSING_JOBS=[])
+    def test_background_checksum(self):
+        data = b"frame" * 1000
+        with self.captureOnCommitCallbacks(execute=True):
+            file_obj = File.objects.create(
+                resource=self.resource,
+                version="1",
+                file=SimpleUploadedFile("film.mp4", data),
+            )
+        self.assertIsNone(file_obj.checksum)
+        self.assertEqual(
+            list(file_obj.jobs.values_list("kind", flat=True)), ["checksum"]
+        )
+        jobs.work("worker-1", burst=True)
+        file_obj.refresh_from_db()
+        self.assertEqual(file_obj.checksum, xxhash.xxh64(data).hexdigest())
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), UPLOAD_CHUNK_DIR=tempfile.mkdtemp())
+class UploadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(netid="admin1")
+        self.client.force_login(self.user)
+        self.resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        self.data = b"frame" * 300000
+
+    def start_upload(self, filename="film.mp4"):
+        response = self.client.post(
+            reverse("create_upload"),
+            {
+                "resource": self.resource.id,
+                "version": filename,
+                "filename": filename,
+                "size": len(self.data),
+            },
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()["url"]
+
+    def put_chunk(self, url, offset, chunk):
+        return self.client.put(
+            url,
+            chunk,
+            content_type="application/offset+octet-stream",
+            headers={"Upload-Offset": str(offset)},
+        )
+
+    def upload(self, filename="film.mp4"):
+        url = self.start_upload(filename)
+        middle = len(self.data) // 2
+        self.assertEqual(self.put_chunk(url, 0, self.data[:middle]).status_code, 204)
+        self.assertEqual(
+            self.put_chunk(url, middle, self.data[middle:]).status_code, 204
+        )
+        return self.client.post(url + "/finalize")
+
+    def test_chunked_upload(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 201)
+        file_obj = File.objects.get(id=response.json()["file"])
+        self.assertEqual(file_obj.checksum, xxhash.xxh64(self.data).hexdigest())
+        with file_obj.file.open("rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_offset_mismatch(self):
+        url = self.start_upload()
+        response = self.put_chunk(url, 10, self.data[10:20])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Upload-Offset"], "0")
+
+    def test_resume_after_lost_hash_state(self):
+        url = self.start_upload()
+        self.put_chunk(url, 0, self.data[:1000])
+        uploads._hashers.clear()
+        self.assertEqual(self.client.head(url)["Upload-Offset"], "1000")
+        self.put_chunk(url, 1000, self.data[1000:])
+        response = self.client.post(url + "/finalize")
+        file_obj = File.objects.get(id=response.json()["file"])
+        self.assertEqual(file_obj.checksum, xxhash.xxh64(self.data).hexdigest())
+
+    def test_duplicate_rejected_on_finalize(self):
+        self.assertEqual(self.upload("film.mp4").status_code, 201)
+        self.assertEqual(self.upload("copy.mp4").status_code, 409)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), MEDIA_CONTENT_ADDRESSED=True)
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        self.storage = File._meta.get_field("file").storage
+        self.resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        self.data = b"frame" * 1000
+        self.checksum = xxhash.xxh64(self.data).hexdigest()
+
+    def test_stored_by_checksum_with_readable_link(self):
+        file_obj = File.objects.create(
+            resource=self.resource,
+            version="1",
+            file=SimpleUploadedFile("film.mp4", self.data),
+        )
+        self.assertEqual(file_obj.file.name, object_name(self.checksum, ".mp4"))
+        link = self.storage.path("by-name/Film/1.mp4")
+        self.assertTrue(os.path.samefile(link, file_obj.file.path))
+
+        self.resource.name = "Film (2008)"
+        self.resource.save()
+        self.assertTrue(self.storage.exists("by-name/Film (2008)/1.mp4"))
+        self.assertFalse(self.storage.exists("by-name/Film/1.mp4"))
+
+        file_obj.delete()
+        self.assertFalse(self.storage.exists("by-name/Film (2008)/1.mp4"))
+
+    def test_storage_follows_setting(self):
+        resource = Resource.objects.create(name="Trailer", requester_netid="prof1")
+        with self.settings(MEDIA_CONTENT_ADDRESSED=False):
+            file_obj = File.objects.create(
+                resource=resource,
+                version="1",
+                file=SimpleUploadedFile("trailer.mp4", self.data),
+            )
+        self.assertEqual(file_obj.file.name, "Trailer/1.mp4")
+        self.assertFalse(self.storage.exists("by-name/Trailer/1.mp4"))
+
+    def test_identical_content_written_once(self):
+        name = object_name(self.checksum, ".mp4")
+        self.assertEqual(self.storage.save(name, ContentFile(self.data)), name)
+        self.assertEqual(self.storage.save(name, ContentFile(b"ignored")), name)
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_duplicate_rejected(self):
+        File.objects.create(
+            resource=self.resource,
+            version="1",
+            file=SimpleUploadedFile("film.mp4", self.data),
+        )
+        duplicate = File(resource=self.resource, version="2")
+        duplicate.file = SimpleUploadedFile("copy.mp4", self.data)
+        with self.assertNumQueries(0), self.assertRaises(ValidationError):
+            validate_unique_checksum(duplicate.file)
+
+
+def box(box_type, *payload):
+    data = b"".join(payload)
+    return struct.pack(">I4s", 8 + len(data), box_type) + data
+
+
+def full_box(box_type, fmt, *values):
+    return box(box_type, b"\0\0\0\0", struct.pack(fmt, *values))
+
+
+def sample_mp4(samples):
+    """Return an MP4 with ten 0.1s video samples, keyframes at 0s and 0.5s,
+    two chunks of five samples and the moov box after the media data."""
+    ftyp = box(b"ftyp", b"isom\0\0\0\0")
+    mdat_offset = len(ftyp) + 8
+    chunk_offsets = [mdat_offset, mdat_offset + sum(map(len, samples[:5]))]
+    stbl = box(
+        b"stbl",
+        full_box(b"stts", ">III", 1, len(samples), 1000),
+        full_box(b"stss", ">III", 2, 1, 6),
+        full_box(b"stsc", ">IIII", 1, 1, 5, 1),
+        full_box(b"stsz", f">II{len(samples)}I", 0, len(samples), *map(len, samples)),
+        full_box(b"stco", ">III", 2, *chunk_offsets),
+    )
+    mdia = box(
+        b"mdia",
+        full_box(b"mdhd", ">IIIIHH", 0, 0, 10000, 10000, 0, 0),
+        full_box(b"hdlr", ">I4s12sB", 0, b"vide", b"", 0),
+        box(b"minf", stbl),
+    )
+    moov = box(b"moov", box(b"trak", mdia))
+    return ftyp + box(b"mdat", *samples) + moov
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class SeekIndexTests(TestCase):
+    def setUp(self):
+        self.samples = [bytes([i]) * (100 + i) for i in range(10)]
+        self.path = os.path.join(tempfile.mkdtemp(), "film.mp4")
+        with open(self.path, "wb") as f:
+            f.write(sample_mp4(self.samples))
+
+    def assertKeyframesPointAtSamples(self, index):
+        times, offsets = index["keyframes"]
+        self.assertEqual(times, [0.0, 0.5])
+        with open(self.path, "rb") as f:
+            for offset, sample in zip(offsets, [self.samples[0], self.samples[5]]):
+                f.seek(offset)
+                self.assertEqual(f.read(len(sample)), sample)
+
+    def test_build_index(self):
+        index = mp4.build_index(self.path)
+        self.assertFalse(index["faststart"])
+        self.assertKeyframesPointAtSamples(index)
+
+    def test_rewrite_faststart(self):
+        size = os.path.getsize(self.path)
+        self.assertTrue(mp4.rewrite_faststart(self.path))
+        self.assertFalse(mp4.rewrite_faststart(self.path))
+        self.assertEqual(os.path.getsize(self.path), size)
+        index = mp4.build_index(self.path)
+        self.assertTrue(index["faststart"])
+        self.assertKeyframesPointAtSamples(index)
+
+    @override_settings(MP4_FASTSTART=True, FILE_PROCESSING_JOBS=["seek_index"])
+    def test_seek_index_job(self):
+        resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        user = User.objects.create_user(netid="student1")
+        with open(self.path, "rb") as f, self.captureOnCommitCallbacks(execute=True):
+            file_obj = File.objects.create(
+                resource=resource,
+                version="1",
+                file=SimpleUploadedFile("film.mp4", f.read()),
+            )
+        original_checksum = file_obj.checksum
+        jobs.work("worker-1", burst=True)
+        file_obj.refresh_from_db()
+        self.assertTrue(file_obj.seek_index["faststart"])
+        self.assertNotEqual(file_obj.checksum, original_checksum)
+
+        file_key = FileKey.objects.create(file=file_obj, user=user)
+        self.client.force_login(user)
+        response = self.client.get(reverse("seek_index", args=[file_key.id]))
+        self.assertEqual(response.json(), file_obj.seek_index)
+        self.assertEqual(response["ETag"], f'"{file_obj.checksum}"')
+
+    @override_settings(MP4_FASTSTART=True)
+    def test_seek_index_retry_updates_checksum(self):
+        resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        with open(self.path, "rb") as f:
+            file_obj = File.objects.create(
+                resource=resource,
+                version="1",
+                file=SimpleUploadedFile("film.mp4", f.read()),
+            )
+        # An earlier attempt rewrote the file, then failed
+        self.assertTrue(mp4.rewrite_faststart(file_obj.file.path))
+        jobs.seek_index(Job(file=file_obj))
+        file_obj.refresh_from_db()
+        with open(file_obj.file.path, "rb") as f:
+            self.assertEqual(file_obj.checksum, xxhash.xxh64(f.read()).hexdigest())
+
+    @override_settings(
+        MP4_FASTSTART=True,
+        FILE_PROCESSING_JOBS=["probe_duration", "seek_index", "segment_hls"],
+        STREAM_CHUNK_CACHE=True,
+    )
+    @mock.patch("core.media.probe_duration", return_value=1.0)
+    @mock.patch("core.media.run_tool")
+    def test_rewrite_refreshes_derived_media(self, run_tool, probe_duration):
+        run_tool.side_effect = lambda args, binary: (
+            fake_cut if "-ss" in args else fake_segment_hls
+        )(args, binary)
+        self.enterContext(self.settings(STREAM_CHUNK_CACHE_DIR=tempfile.mkdtemp()))
+        resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        user = User.objects.create_user(netid="student1")
+        with open(self.path, "rb") as f, self.captureOnCommitCallbacks(execute=True):
+            file_obj = File.objects.create(
+                resource=resource,
+                version="1",
+                file=SimpleUploadedFile("film.mp4", f.read()),
+            )
+        # Nothing reads the file before it may be rewritten
+        self.assertEqual(
+            list(Job.objects.values_list("kind", "payload")),
+            [("seek_index", {"then": ["probe_duration", "segment_hls"]})],
+        )
+        old_checksum = file_obj.checksum
+        self.addCleanup(hls.remove, old_checksum)
+        self.addCleanup(clips.remove_all, old_checksum)
+        hls.segment(file_obj)
+        with self.captureOnCommitCallbacks(execute=True):
+            clip = Clip.objects.create(
+                file=file_obj, owner=user, start_time="0:00:00", end_time="0:00:01"
+            )
+        clips.cut(clip)
+
+        file_key = FileKey.objects.create(file=file_obj, user=user)
+        self.client.force_login(user)
+        url = reverse("stream_file", args=[file_key.id])
+        response = self.client.get(url)
+        self.assertEqual(response["ETag"], f'"{old_checksum}"')
+        with open(self.path, "rb") as f:
+            self.assertEqual(b"".join(response.streaming_content), f.read())
+        old_blocks = chunk_cache.block_path(f'"{old_checksum}"', 0)
+        self.assertTrue(os.path.exists(old_blocks))
+
+        jobs.work("worker-1", burst=True)
+        file_obj.refresh_from_db()
+        self.addCleanup(hls.remove, file_obj.checksum)
+        self.addCleanup(clips.remove_all, file_obj.checksum)
+        self.assertNotEqual(file_obj.checksum, old_checksum)
+        self.assertEqual(probe_duration.call_count, 1)
+        response = self.client.get(url)
+        self.assertEqual(response["ETag"], f'"{file_obj.checksum}"')
+        with open(file_obj.file.path, "rb") as f:
+            self.assertEqual(b"".join(response.streaming_content), f.read())
+
+        # Output of the old content is replaced by output of the new
+        self.assertFalse(os.path.exists(old_blocks))
+        self.assertFalse(os.path.exists(hls.output_dir(File(checksum=old_checksum))))
+        self.assertTrue(hls.is_segmented(file_obj))
+        clip.refresh_from_db()
+        self.assertFalse(os.path.exists(clips.asset_path(old_checksum, 0, 1, ".mp4")))
+        self.assertTrue(clips.is_cut(clip))
+
+
+def fake_segment_hls(args, binary):
+    # Stands in for ffmpeg: writes a playlist and a single segment
+    playlist = args[-1]
+    output_dir = os.path.dirname(playlist)
+    with open(os.path.join(output_dir, "segment00000.ts"), "wb") as f:
+        f.write(b"G" * 188)
+    with open(playlist, "w") as f:
+        f.write("#EXTM3U\n#EXTINF:6.0,\nsegment00000.ts\n#EXT-X-ENDLIST\n")
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class HlsTests(TestCase):
+    def setUp(self):
+        resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        user = User.objects.create_user(netid="student1")
+        self.file = File.objects.create(
+            resource=resource,
+            version="1",
+            file=SimpleUploadedFile("film.mp4", b"frame" * 1000),
+        )
+        self.file_key = FileKey.objects.create(file=self.file, user=user)
+        self.client.force_login(user)
+
+    def url(self, name):
+        return reverse("hls_file", args=[self.file_key.id, name])
+
+    def test_not_segmented(self):
+        self.assertEqual(self.client.get(self.url("index.m3u8")).status_code, 404)
+
+    @mock.patch("core.media.run_tool", side_effect=fake_segment_hls)
+    def test_segment_and_serve(self, run_tool):
+        self.assertTrue(hls.segment(self.file))
+        self.assertFalse(hls.segment(self.file))
+        self.assertEqual(run_tool.call_count, 1)
+
+        response = self.client.get(self.url("index.m3u8"))
+        self.assertEqual(response["Content-Type"], hls.PLAYLIST_CONTENT_TYPE)
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertIn(b"segment00000.ts", b"".join(response.streaming_content))
+
+        response = self.client.get(self.url("segment00000.ts"))
+        self.assertEqual(response["Content-Type"], hls.SEGMENT_CONTENT_TYPE)
+        self.assertEqual(b"".join(response.streaming_content), b"G" * 188)
+        self.assertEqual(self.client.get(self.url("..")).status_code, 404)
+        self.assertEqual(self.client.get(self.url("secret.ts")).status_code, 404)
+
+        self.file.delete()
+        self.assertFalse(os.path.exists(hls.output_dir(self.file)))
+
+    @override_settings(STREAM_OFFLOAD="x-accel-redirect")
+    @mock.patch("core.media.run_tool", side_effect=fake_segment_hls)
+    def test_offload(self, run_tool):
+        hls.segment(self.file)
+        self.addCleanup(hls.remove, self.file.checksum)
+        response = self.client.get(self.url("segment00000.ts"))
+        self.assertEqual(
+            response["X-Accel-Redirect"],
+            f"/protected-media/hls/{self.file.checksum}/segment00000.ts",
+        )
+
+
+def fake_cut(args, binary):
+    # Stands in for ffmpeg: the clip asset is the requested window as text
+    with open(args[-1], "w") as f:
+        f.write(f"{args[args.index('-ss') + 1]}+{args[args.index('-t') + 1]}")
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), FILE_PROCESSING_JOBS=[])
+@mock.patch("core.media.run_tool", side_effect=fake_cut)
+class ClipTests(TestCase):
+    def setUp(self):
+        resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        self.user = User.objects.create_user(netid="student1")
+        self.file = File.objects.create(
+            resource=resource,
+            version="1",
+            file=SimpleUploadedFile("film.mp4", b"frame" * 1000),
+        )
+        self.file_key = FileKey.objects.create(file=self.file, user=self.user)
+        self.client.force_login(self.user)
+
+    def create_clip(self, start, end):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Clip.objects.create(
+                file=self.file,
+                owner=self.user,
+                name="Scene",
+                start_time=start,
+                end_time=end,
+            )
+
+    def test_hms_to_seconds(self, run_tool):
+        self.assertEqual(hms_to_seconds("1:23:45.5"), 5025.5)
+        clip = Clip(file=self.file, owner=self.user, start_time="0:01:00")
+        clip.end_time = "0:00:30"
+        with self.assertRaises(ValidationError):
+            clip.full_clean()
+
+    def test_stream_clip(self, run_tool):
+        clip = self.create_clip("0:01:00", "0:01:30")
+        url = reverse("stream_clip", args=[self.file_key.id, clip.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response["Location"].endswith("#t=60,90"))
+
+        jobs.work("worker-1", burst=True)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"60.000+30.000")
+        self.assertIn("immutable", response["Cache-Control"])
+
+    @override_settings(STREAM_OFFLOAD="x-accel-redirect")
+    def test_offload(self, run_tool):
+        clip = self.create_clip("0:03:00", "0:03:30")
+        jobs.work("worker-1", burst=True)
+        self.addCleanup(clips.remove_all, self.file.checksum)
+        response = self.client.get(
+            reverse("stream_clip", args=[self.file_key.id, clip.id])
+        )
+        self.assertEqual(
+            response["X-Accel-Redirect"],
+            f"/protected-media/clips/{self.file.checksum}/180.000-210.000.mp4",
+        )
+
+    def test_changed_times_invalidate_asset(self, run_tool):
+        clip = self.create_clip("0:01:00", "0:01:30")
+        jobs.work("worker-1", burst=True)
+        old_path = clips.clip_path(clip)
+        self.assertTrue(os.path.exists(old_path))
+
+        clip.end_time = "0:02:00"
+        with self.captureOnCommitCallbacks(execute=True):
+            clip.save()
+        self.assertFalse(os.path.exists(old_path))
+        self.assertFalse(clips.is_cut(clip))
+        jobs.work("worker-1", burst=True)
+        self.assertTrue(clips.is_cut(clip))
+
+        # Assets shared by clips of the same window outlive either clip
+        other = self.create_clip("0:01:00", "0:02:00")
+        clip.delete()
+        self.assertTrue(clips.is_cut(other))
+        other.delete()
+        self.assertFalse(clips.is_cut(other))
+
+
+@override_settings(
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    STREAM_THROTTLE=True,
+    STREAM_MAX_STREAMS_PER_FILE_KEY=1,
+)
+class ThrottleTests(TestCase):
+    def setUp(self):
+        self.enterContext(
+            self.settings(
+                STREAM_THROTTLE_DB=os.path.join(tempfile.mkdtemp(), "throttle.db")
+            )
+        )
+        self.user = User.objects.create_user(netid="student1")
+        resource = Resource.objects.create(name="Lecture", requester_netid="prof1")
+        self.data = b"frame" * 1000
+        file_obj = File(resource=resource, version="1")
+        file_obj.file.save("lecture.mp4", ContentFile(self.data))
+        self.file_key = FileKey.objects.create(user=self.user, file=file_obj)
+        self.url = reverse("stream_file", args=[self.file_key.id])
+        self.client.force_login(self.user)
+
+    def test_concurrent_streams_limited(self):
+        first = self.client.get(self.url)
+        refused = self.client.get(self.url)
+        self.assertEqual(refused.status_code, 429)
+        self.assertEqual(refused["Retry-After"], str(throttle.RETRY_AFTER))
+
+        self.assertEqual(b"".join(first.streaming_content), self.data)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        metrics = throttle.metrics()
+        self.assertEqual(metrics["streams_started"], 2)
+        self.assertEqual(metrics["streams_refused_file_key"], 1)
+        self.assertEqual(metrics["bytes_sent"], len(self.data))
+        self.assertEqual(metrics["active_streams"], 0)
+
+    @override_settings(
+        STREAM_GLOBAL_RATE=1000,
+        STREAM_USER_RATE=1000,
+        STREAM_BURST_SECONDS=1,
+        STREAM_THROTTLE_INTERVAL=0,
+    )
+    def test_fair_share(self):
+        alone = throttle.open_stream(user_id=1, file_key=1)
+        self.assertEqual(alone.take(1000), 0)
+        self.assertAlmostEqual(alone.take(500), 0.5, places=2)
+
+        # A second active user halves the first user's rate
+        other = throttle.open_stream(user_id=2, file_key=2)
+        other.take(1)
+        self.assertAlmostEqual(alone.take(250), 1.5, places=1)
+        alone.close()
+        other.close()
+        self.assertEqual(throttle.metrics()["chunks_delayed"], 3)
+
+    @override_settings(STREAM_USER_RATE=1000, STREAM_THROTTLE_INTERVAL=60)
+    def test_buckets_updated_per_interval(self):
+        stream = throttle.open_stream(user_id=1, file_key=1)
+        self.assertEqual(stream.take(10), 0)
+        with mock.patch.object(
+            throttle, "transaction", wraps=throttle.transaction
+        ) as transaction:
+            for _ in range(5):
+                self.assertEqual(stream.take(10), 0)
+            transaction.assert_not_called()
+            # An interval's worth of bytes at the stream's rate is written at once
+            stream.take(60000)
+            transaction.assert_called_once()
+        self.assertEqual(throttle.metrics()["bytes_sent"], 60060)
+        stream.take(5)
+        stream.close()
+        self.assertEqual(throttle.metrics()["bytes_sent"], 60065)
+
+    def test_async_close_in_thread(self):
+        stream = throttle.open_stream(user_id=1, file_key=1)
+        close = stream.close
+
+        def close_off_loop():
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            close()
+
+        stream.close = close_off_loop
+
+        async def chunks():
+            yield b"frame"
+
+        async def consume():
+            body = throttle.AsyncThrottledChunks(chunks(), stream)
+            return [chunk async for chunk in body]
+
+        self.assertEqual(async_to_sync(consume)(), [b"frame"])
+        self.assertEqual(throttle.metrics()["active_streams"], 0)
+
+    def test_metrics_export(self):
+        staff = User.objects.create_superuser(
+            netid="admin1", username="admin1", password="pw"
+        )
+        self.client.force_login(staff)
+        response = self.client.get(reverse("stream_metrics"))
+        self.assertContains(response, "yvideo_stream_streams_started_total 0")
+        self.assertContains(response, "# TYPE yvideo_stream_active_streams gauge")
+
+
+@override_settings(
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    STREAM_CHUNK_CACHE=True,
+    STREAM_CHUNK_SIZE=1000,
+    STREAM_CHUNK_CACHE_HEAD=2000,
+    STREAM_CHUNK_CACHE_MIN_READS=2,
+)
+class ChunkCacheTests(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.enterContext(self.settings(STREAM_CHUNK_CACHE_DIR=self.cache_dir))
+        # Block popularity is counted per process across tests
+        self.enterContext(mock.patch.object(chunk_cache, "_reads", Counter()))
+        user = User.objects.create_user(netid="student1")
+        resource = Resource.objects.create(name="Lecture", requester_netid="prof1")
+        self.data = bytes(range(250)) * 22
+        file_obj = File(resource=resource, version="1")
+        file_obj.file.save("lecture.mp4", ContentFile(self.data))
+        file_key = FileKey.objects.create(user=user, file=file_obj)
+        self.url = reverse("stream_file", args=[file_key.id])
+        self.client.force_login(user)
+
+    def get_range(self, start, end):
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={start}-{end}")
+        self.assertEqual(
+            b"".join(response.streaming_content), self.data[start : end + 1]
+        )
+
+    def test_head_and_popular_blocks_cached(self):
+        self.get_range(500, 2499)
+        stats = chunk_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["stored"]), (0, 3, 2))
+
+        # Block 2 is past the head, so it is cached on its second read
+        self.get_range(500, 2499)
+        stats = chunk_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["stored"]), (2, 4, 3))
+        self.get_range(0, len(self.data) - 1)
+        stats = chunk_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["stored"]), (5, 7, 3))
+        self.assertEqual(stats["bytes_from_cache"], 2000 + 3000)
+
+    def test_eviction(self):
+        with self.settings(STREAM_CHUNK_CACHE_MAX_SIZE=2500):
+            for _ in range(2):
+                self.get_range(0, len(self.data) - 1)
+        blocks = [
+            name
+            for _, _, names in os.walk(self.cache_dir)
+            for name in names
+            if name.endswith(".block")
+        ]
+        self.assertLessEqual(len(blocks), 2)
+        self.assertGreater(chunk_cache.stats()["evicted"], 0)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), VIEW_COUNT_FLUSH_INTERVAL=60)
+class ViewCountTests(TestCase):
+    def setUp(self):
+        # No flusher thread writing to the test database
+        self.thread = self.enterContext(
+            mock.patch.object(view_counts.threading, "Thread")
+        )
+        self.enterContext(mock.patch.object(view_counts, "_flusher_pid", None))
+        cache.clear()
+        self.resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        file_obj = File.objects.create(
+            resource=self.resource,
+            version="1",
+            file=SimpleUploadedFile("film.mp4", b"frame" * 1000),
+        )
+        self.content = Content.objects.create(title="Film", file=file_obj)
+        self.other = Content.objects.create(title="Film again", file=file_obj)
+        view_counts.flush()
+
+    def test_views_buffered_and_deduplicated(self):
+        self.assertTrue(view_counts.record_view(self.content, "user:1"))
+        self.assertFalse(view_counts.record_view(self.content, "user:1"))
+        view_counts.record_view(self.content, "user:2")
+        view_counts.record_view(self.content, None)
+        view_counts.record_view(self.other, "user:1")
+        self.content.refresh_from_db()
+        self.assertEqual(self.content.views, 0)
+
+        # One UPDATE per model and distinct increment, in a savepoint
+        with self.assertNumQueries(5):
+            self.assertTrue(view_counts.flush())
+        self.content.refresh_from_db()
+        self.other.refresh_from_db()
+        self.resource.refresh_from_db()
+        self.assertEqual((self.content.views, self.other.views), (3, 1))
+        self.assertEqual(self.resource.views, 4)
+
+    def test_flushed_by_thread(self):
+        view_counts.record_view(self.content, "user:1")
+        view_counts.record_view(self.content, "user:2")
+        # One thread per process
+        self.thread.assert_called_once_with(
+            target=view_counts.flush_periodically, name="view-counts", daemon=True
+        )
+        # One interval passes, then the thread is stopped
+        stop = mock.Mock(**{"wait.side_effect": [False, True]})
+        with mock.patch.object(view_counts, "_stop", stop):
+            view_counts.flush_periodically()
+        stop.wait.assert_called_with(60)
+        self.content.refresh_from_db()
+        self.assertEqual(self.content.views, 2)
+
+
+@override_settings(ANALYTICS_BUCKET_SECONDS=10, ANALYTICS_HEARTBEAT_SECONDS=5)
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        self.enterContext(self.settings(ANALYTICS_DIR=tempfile.mkdtemp()))
+        self.content = Content.objects.create(title="Film")
+
+    def post_events(self, events, content=None):
+        return self.client.post(
+            reverse("playback_events"),
+            {"content": content or self.content.id, "events": events},
+            content_type="application/json",
+        )
+
+    def test_events_rolled_up(self):
+        response = self.post_events(
+            [
+                {"type": "play", "t": 0},
+                {"type": "heartbeat", "t": 5},
+                {"type": "heartbeat", "t": 10},
+                {"type": "seek", "t": 12, "to": 31},
+                {"type": "heartbeat", "t": 35},
+                {"type": "pause", "t": 36},
+            ]
+        )
+        self.assertEqual(response.json(), {"stored": 6})
+        self.post_events([{"type": "play", "t": 0}, {"type": "heartbeat", "t": 5}])
+
+        # The current hour's partition is still being written to
+        self.assertEqual(analytics.complete_partitions(), [])
+        partitions = analytics.complete_partitions(now=time.time() + 3600)
+        self.assertEqual(len(partitions), 1)
+        self.assertEqual(analytics.rollup(partitions), 1)
+        self.assertFalse(os.path.exists(partitions[0]))
+
+        histogram = self.content.watch_histogram
+        self.assertEqual(histogram.watch_seconds, [10, 5, 0, 5])
+        self.assertEqual(histogram.seeks, [0, 0, 0, 1])
+        self.assertEqual(histogram.plays, 2)
+
+    def test_torn_record_ignored(self):
+        self.post_events([{"type": "heartbeat", "t": 5}])
+        (partition,) = analytics.complete_partitions(now=time.time() + 3600)
+        (name,) = os.listdir(partition)
+        with open(os.path.join(partition, name), "ab") as f:
+            f.write(b"\x00" * 5)
+        analytics.rollup([partition])
+        self.assertEqual(self.content.watch_histogram.watch_seconds, [5])
+
+    def test_invalid_events_rejected(self):
+        for events in (
+            [{"type": "rewind", "t": 1}],
+            [{"type": "heartbeat"}],
+            [{"type": "heartbeat", "t": -1}],
+            [{"type": "heartbeat", "t": 1e12}],
+            [{"type": "seek", "t": 1, "to": 1e39}],
+            [{"type": "seek", "t": 1, "to": -1}],
+            "heartbeat",
+        ):
+            self.assertEqual(self.post_events(events).status_code, 400)
+        with self.settings(ANALYTICS_MAX_BATCH=1):
+            events = [{"type": "play", "t": 0}] * 2
+            self.assertEqual(self.post_events(events).status_code, 400)
+        self.assertEqual(analytics.complete_partitions(now=time.time() + 3600), [])
+
+    def test_requires_access(self):
+        owner = User.objects.create_user(netid="prof1", username="prof1")
+        with self.captureOnCommitCallbacks(execute=True):
+            collection = Collection.objects.create(name="Private", owner=owner)
+        content = Content.objects.create(title="Film", collection=collection)
+        events = [{"type": "heartbeat", "t": 5}]
+        self.assertEqual(self.post_events(events, content.id).status_code, 404)
+        self.assertEqual(self.post_events(events, 2**31).status_code, 404)
+        self.assertEqual(analytics.complete_partitions(now=time.time() + 3600), [])
+
+        self.client.force_login(owner)
+        self.assertEqual(self.post_events(events, content.id).json(), {"stored": 1})
+
+    def test_out_of_range_records_skipped(self):
+        self.post_events([{"type": "heartbeat", "t": 5}])
+        (partition,) = analytics.complete_partitions(now=time.time() + 3600)
+        (name,) = os.listdir(partition)
+        with open(os.path.join(partition, name), "ab") as f:
+            for position, value in ((1e12, 0), (-1, 0), (1, -1), (1, 1e12)):
+                f.write(
+                    analytics.RECORD.pack(
+                        0, self.content.id, 0, analytics.SEEK, position, value
+                    )
+                )
+        self.assertEqual(analytics.rollup([partition]), 1)
+        self.assertEqual(self.content.watch_histogram.watch_seconds, [5])
+        self.assertEqual(self.content.watch_histogram.seeks, [])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class PlayerTests(TestCase):
+    def setUp(self):
+        # Write the views the player buffers while the test database exists,
+        # rather than from a flusher thread
+        self.enterContext(mock.patch.object(view_counts, "start_flusher"))
+        self.addCleanup(view_counts.flush)
+        self.user = User.objects.create_user(netid="viewer")
+        resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        self.file = File.objects.create(
+            resource=resource,
+            version="1",
+            file=SimpleUploadedFile("film.mp4", b"frame" * 1000),
+        )
+        self.file_key = FileKey.objects.create(user=self.user, file=self.file)
+        annotation = Annotation.objects.create(
+            file=self.file,
+            owner=self.user,
+            annotations=[{"type": "Skip", "start": 5, "end": 10}],
+        )
+        self.content = Content.objects.create(
+            title="Film", file=self.file, annotation=annotation
+        )
+        for name, start, end in (
+            ("Ending", "00:01:00", "00:01:30"),
+            ("Opening", "00:00:00", "00:00:30"),
+        ):
+            clip = Clip.objects.create(
+                file=self.file,
+                owner=self.user,
+                name=name,
+                start_time=start,
+                end_time=end,
+            )
+            self.content.clips.add(clip)
+        for language in ("Spanish", "English"):
+            Subtitle.objects.create(
+                file=self.file,
+                owner=self.user,
+                language=Language.objects.create(language=language),
+                name=language,
+                subtitles=[{"start": 1, "end": 2, "text": language}],
+            )
+
+    def test_query_count(self):
+        # Content with File and Annotation, Clips, Subtitles with Languages,
+        # the (placeholder) user and their FileKey
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse("player", args=[self.content.id]))
+        self.assertEqual(response.status_code, 200)
+        # The timeline itself is fetched by the player script
+        self.assertEqual(
+            response.context["content"].annotation.get_deferred_fields(),
+            {"annotations", "history", "timeline"},
+        )
+
+        data = response.context["player_data"]
+        annotation = self.content.annotation
+        self.assertEqual(
+            data["timeline"],
+            reverse(
+                "annotation_timeline", args=[annotation.id, annotation.timeline_hash]
+            ),
+        )
+        self.assertEqual(
+            [(s["language"], s["content"][0]["text"]) for s in data["subtitles"]],
+            [("English", "English"), ("Spanish", "Spanish")],
+        )
+        self.assertEqual(
+            [(c["name"], c["start"], c["end"]) for c in data["clips"]],
+            [("Opening", 0, 30), ("Ending", 60, 90)],
+        )
+        self.assertEqual(
+            data["clips"][0]["url"],
+            reverse("stream_clip", args=[self.file_key.id, data["clips"][0]["id"]]),
+        )
+        self.assertContains(response, 'id="player-data"')
+
+    def test_captions_disabled(self):
+        self.content.allow_captions = False
+        self.content.save()
+        response = self.client.get(reverse("player", args=[self.content.id]))
+        self.assertEqual(response.context["player_data"]["subtitles"], [])
+
+
+class TimelineTests(TestCase):
+    def setUp(self):
+        self.events = [
+            {"type": "Mute", "start": "20", "end": "25"},
+            {"type": "Skip", "start": "5", "end": "10"},
+            {"type": "Skip", "start": "8.5", "end": "0:00:12"},
+            {"type": "Pause", "start": "30", "message": "Discuss"},
+            {
+                "type": "Censor",
+                "start": "21",
+                "end": "22",
+                "position": {"21.5": [1, 2, 3, 4], "21": [0, 0, 3, 4]},
+            },
+        ]
+
+    def test_compile(self):
+        with self.assertLogs("core.timeline", "WARNING"):
+            compiled = timeline.compile_annotations(
+                self.events + [{"type": "Skip", "start": "later"}]
+            )
+        self.assertEqual(
+            [(e["type"], e["start"], e["end"]) for e in compiled["events"]],
+            [
+                ("Skip", 5, 12),
+                ("Mute", 20, 25),
+                ("Censor", 21, 22),
+                ("Pause", 30, 30),
+            ],
+        )
+        self.assertEqual(
+            compiled["events"][2]["position"],
+            [[21, [0, 0, 3, 4]], [21.5, [1, 2, 3, 4]]],
+        )
+        self.assertEqual(compiled["times"], [5, 12, 20, 21, 22, 25, 30])
+
+        def active(time):
+            return [e["type"] for e in timeline.active_events(compiled, time)]
+
+        self.assertEqual(active(0), [])
+        self.assertEqual(active(9), ["Skip"])
+        self.assertEqual(active(12), [])
+        self.assertEqual(active(21.5), ["Mute", "Censor"])
+        self.assertEqual(active(22), ["Mute"])
+        # Instantaneous events stay in effect until the next boundary
+        self.assertEqual(active(31), ["Pause"])
+
+    def test_hash(self):
+        compiled = timeline.compile_annotations(self.events)
+        reordered = timeline.compile_annotations(list(reversed(self.events)))
+        self.assertEqual(
+            timeline.timeline_hash(compiled), timeline.timeline_hash(reordered)
+        )
+        changed = timeline.compile_annotations(self.events[1:])
+        self.assertNotEqual(
+            timeline.timeline_hash(compiled), timeline.timeline_hash(changed)
+        )
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_served_by_hash(self):
+        user = User.objects.create_user(netid="editor")
+        resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        file_obj = File.objects.create(
+            resource=resource,
+            version="1",
+            file=SimpleUploadedFile("film.mp4", b"frame"),
+        )
+        annotation = Annotation.objects.create(
+            file=file_obj, owner=user, annotations=self.events
+        )
+        self.assertEqual(annotation.timeline["times"][0], 5)
+        old_hash = annotation.timeline_hash
+        url = reverse("annotation_timeline", args=[annotation.id, old_hash])
+        self.client.force_login(user)
+        response = self.client.get(url)
+        self.assertEqual(response.json(), annotation.timeline)
+        self.assertIn("immutable", response["Cache-Control"])
+
+        annotation.annotations = self.events[:1]
+        annotation.save()
+        self.assertNotEqual(annotation.timeline_hash, old_hash)
+        self.assertRedirects(
+            self.client.get(url),
+            reverse(
+                "annotation_timeline", args=[annotation.id, annotation.timeline_hash]
+            ),
+        )
+
+
+@override_settings(
+    ANNOTATION_INTERPOLATION_FPS=4, ANNOTATION_INTERPOLATION_EASING="linear"
+)
+class InterpolationTests(TestCase):
+    position = {"2": [10, 10, 20, 20], "3": [30, 10], "3.5": [90, 50, 20, 20]}
+
+    def test_interpolate(self):
+        track = interpolation.interpolate(self.position)
+        self.assertEqual((track["fps"], track["start"], track["frames"]), (4, 2.0, 7))
+        self.assertEqual(
+            interpolation.unpack(track),
+            [
+                [10, 10, 20, 20],
+                [15, 10, 20, 20],
+                [20, 10, 20, 20],
+                [25, 10, 20, 20],
+                # The size is kept from the previous keyframe
+                [30, 10, 20, 20],
+                # Clamped to the frame
+                [60, 30, 20, 20],
+                [90, 50, 10, 20],
+            ],
+        )
+        self.assertEqual(interpolation.box_at(track, 2.6), [20, 10, 20, 20])
+        self.assertEqual(interpolation.box_at(track, 99), [90, 50, 10, 20])
+        self.assertIsNone(interpolation.interpolate({"1": [0, 0, 5, 5]}))
+
+    def test_hms_keyframes(self):
+        hms = {"0:00:02": [10, 10, 20, 20], "0:00:03.5": [90, 50, 20, 20]}
+        seconds = {"2": [10, 10, 20, 20], "3.5": [90, 50, 20, 20]}
+        self.assertEqual(
+            interpolation.interpolate(hms), interpolation.interpolate(seconds)
+        )
+
+    def test_easing(self):
+        track = interpolation.interpolate(
+            {"0": [0, 0, 10, 10], "1": [40, 0, 10, 10]}, easing="ease-in"
+        )
+        self.assertEqual(
+            [box[0] for box in interpolation.unpack(track)], [0, 2.5, 10, 22.5, 40]
+        )
+        with self.assertLogs("core.interpolation", "WARNING"):
+            bounce = interpolation.interpolate(self.position, easing="bounce")
+        self.assertEqual(
+            bounce, dict(interpolation.interpolate(self.position), easing="linear")
+        )
+
+    @skipUnless(interpolation.np is not None, "NumPy is not installed")
+    def test_numpy(self):
+        with mock.patch.object(
+            interpolation, "interpolate_python", side_effect=AssertionError
+        ):
+            track = interpolation.interpolate(self.position)
+        self.assertEqual(
+            interpolation.unpack(track),
+            [
+                [10, 10, 20, 20],
+                [15, 10, 20, 20],
+                [20, 10, 20, 20],
+                [25, 10, 20, 20],
+                [30, 10, 20, 20],
+                [60, 30, 20, 20],
+                [90, 50, 10, 20],
+            ],
+        )
+
+    def test_without_numpy(self):
+        with mock.patch("core.interpolation.np", None):
+            track = interpolation.interpolate(
+                self.position, fps=30, easing="ease-in-out"
+            )
+        for expected, box in zip(
+            interpolation.unpack(
+                interpolation.interpolate(self.position, fps=30, easing="ease-in-out")
+            ),
+            interpolation.unpack(track),
+        ):
+            for a, b in zip(expected, box):
+                self.assertAlmostEqual(a, b, places=4)
+
+    def test_compiled_into_timeline(self):
+        compiled = timeline.compile_annotations(
+            [
+                {
+                    "options": {
+                        "start": "2",
+                        "end": "4",
+                        "type": "censor",
+                        "details": {
+                            "type": "black",
+                            "interpolate": True,
+                            "position": self.position,
+                        },
+                    }
+                },
+                {"options": {"start": "5", "end": "6", "type": "skip", "details": {}}},
+            ]
+        )
+        censor, skip = compiled["events"]
+        self.assertEqual(
+            (censor["type"], censor["details"]),
+            ("Censor", {"type": "black", "interpolate": True}),
+        )
+        self.assertEqual(censor["position"][0], [2, [10, 10, 20, 20]])
+        self.assertEqual(censor["track"]["frames"], 7)
+        self.assertEqual((skip["type"], skip["start"], skip["end"]), ("Skip", 5, 6))
+
+    def test_uninterpolable_censor_kept(self):
+        position = {"2": [10, 10, 20, 20], "3": ["left", 10, 20, 20]}
+        with self.assertLogs("core.timeline", "WARNING"):
+            compiled = timeline.compile_annotations(
+                [{"start": "2", "end": "4", "type": "censor", "position": position}]
+            )
+        (censor,) = compiled["events"]
+        self.assertEqual(censor["type"], "Censor")
+        self.assertEqual(
+            censor["position"], [[2, [10, 10, 20, 20]], [3, ["left", 10, 20, 20]]]
+        )
+        self.assertNotIn("track", censor)
+
+
+def hummedia_document(name, *events, creator="prof1"):
+    return {
+        "media": [
+            {
+                "name": name,
+                "tracks": [
+                    {
+                        "trackEvents": [
+                            {
+                                "type": kind,
+                                "popcornOptions": {"start": start, "end": end},
+                            }
+                            for kind, start, end in events
+                        ]
+                    }
+                ],
+            }
+        ],
+        "creator": creator,
+    }
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class HummediaImportTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(netid="prof1")
+        resource = Resource.objects.create(name="Volcano", requester_netid="prof1")
+        self.file = File.objects.create(
+            resource=resource, version="1", file=SimpleUploadedFile("v.mp4", b"frame")
+        )
+        self.dir = tempfile.mkdtemp()
+        self.write(
+            "old/volcano.json",
+            [
+                # An empty layer, as at the start of real exports
+                hummedia_document("Volcano"),
+                hummedia_document("Volcano", ("skip", "948.5", "983.1")),
+                hummedia_document(
+                    "Volcano",
+                    ("darken", "3569.1", "3582.2"),
+                    ("mutePlugin", "10", "12"),
+                ),
+            ],
+        )
+        self.write("new.json", hummedia_document("Volcano", ("skip", "1", "2")))
+        # A copy of an export is imported once
+        self.write("copy.json", hummedia_document("Volcano", ("skip", "1", "2")))
+        self.write("bad.json", hummedia_document("Volcano", ("popup", "1", "2")))
+        self.write("times.json", hummedia_document("Volcano", ("skip", "one", "2")))
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def run_import(self, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command("import_hummedia", self.dir, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_iter_documents(self):
+        documents = [hummedia_document(str(i), ("skip", i, i + 1)) for i in range(20)]
+        for data in (documents, documents[0]):
+            text = io.StringIO(" " + json.dumps(data, indent=2) + "\n")
+            expected = data if isinstance(data, list) else [data]
+            self.assertEqual(list(hummedia.iter_documents(text, read_size=7)), expected)
+        with self.assertRaises(hummedia.ConversionError):
+            list(hummedia.iter_documents(io.StringIO('[{"media": []}, {"med')))
+
+    def test_import(self):
+        out, err = self.run_import("--processes", "1")
+        self.assertIn("Imported 2 annotations from 2 files; skipped 1", out)
+        self.assertIn("2 failed", out)
+        self.assertIn("'popup' not implemented", err)
+        self.assertIn("Invalid times", err)
+        annotations = Annotation.objects.order_by("id")
+        self.assertEqual(annotations.count(), 2)
+        self.assertEqual({a.file_id for a in annotations}, {self.file.id})
+        # The documents of an export are merged into one annotation
+        merged = next(a for a in annotations if len(a.annotations) == 3)
+        self.assertEqual(
+            [e["options"]["type"] for e in merged.annotations],
+            ["mute", "skip", "blank"],
+        )
+        # Timelines are compiled although bulk_create skips save()
+        self.assertEqual(
+            [e["type"] for e in merged.timeline["events"]], ["Mute", "Skip", "Blank"]
+        )
+        self.assertEqual(merged.timeline_hash, timeline.timeline_hash(merged.timeline))
+        self.assertEqual(AnnotationImport.objects.count(), 2)
+
+        # Re-runs skip imported files
+        out, _ = self.run_import("--processes", "2")
+        self.assertIn("Imported 0 annotations from 0 files; skipped 3", out)
+        self.assertEqual(Annotation.objects.count(), 2)
+
+    def test_unresolved_retried(self):
+        self.file.resource.name = "Other"
+        self.file.resource.save()
+        out, err = self.run_import("--processes", "1")
+        self.assertIn("3 unresolved", out)
+        self.assertIn("no file for 'Volcano'", err)
+        self.assertFalse(AnnotationImport.objects.exists())
+
+        out, _ = self.run_import("--processes", "1", "--file", str(self.file.id))
+        self.assertIn("Imported 2 annotations from 2 files", out)
+
+
+class StubOitHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def respond(self):
+        if self.command == "POST":
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path, _, query = self.path.partition("?")
+        self.server.requests.append((path, query))
+        time.sleep(self.server.delay)
+        statuses = self.server.failures.get(path)
+        status = statuses.pop(0) if statuses else 200
+        body = json.dumps(self.server.routes.get(path, {"data": []})).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Lookup threads writing to the in-memory test database would lock it, so a
+# local memory cache stands in for the shared database cache
+LOCAL_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@override_settings(API_RETRY_BACKOFF=0, API_TIMEOUT=(2, 2), CACHES=LOCAL_CACHES)
+class StubOitServerTestCase(TestCase):
+    """Runs the OIT API client against a local stub server."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubOitHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.failures = {}
+        self.server.delay = 0
+        self.server.routes = {
+            "/token": {"access_token": "stub-token", "expires_in": 3600},
+            "/worker-id": {"data": [{"worker_id": "W1"}]},
+            "/worker-summary": {
+                "data": [
+                    {
+                        "preferred_first_name": "Pat",
+                        "preferred_last_name": "Smith",
+                        "work_email_address": "pat@example.com",
+                        "positions": [
+                            {
+                                "employee_or_contingent_worker_type_reference_id": "FAC",
+                                "job_profile": "Professor",
+                                "business_title": "Professor",
+                            }
+                        ],
+                    }
+                ]
+            },
+            "/student-summary": {
+                "data": [
+                    {
+                        "preferred_name": "Pat Q",
+                        "preferred_last_name": "Smith",
+                        "student_email_address": "pat@student.example.com",
+                        "net_id": "pat1",
+                    }
+                ]
+            },
+            "/enrollments": {
+                "data": [
+                    dict.fromkeys(
+                        [
+                            "curriculum_id",
+                            "title_code",
+                            "section_number",
+                            "teaching_area",
+                            "catalog_number",
+                            "catalog_suffix",
+                            "credit_hours",
+                            "withdraw_flag",
+                            "audit_flag",
+                        ],
+                        "x",
+                    )
+                ]
+            },
+        }
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        for name, path in (
+            ("API_AUTH_TOKEN_URL", "/token"),
+            ("API_YEARTERM_URL", "/yearterm"),
+            ("API_WORKER_ID_IAM_URL", "/worker-id"),
+            ("API_WORKER_SUMMARY_URL", "/worker-summary"),
+            ("API_STUDENT_SUMMARY_URL", "/student-summary"),
+            ("API_STUDENT_ENROLLMENTS_URL", "/enrollments"),
+        ):
+            self.enterContext(
+                mock.patch.object(api.secret_settings, name, base + path, create=True)
+            )
+        # A new session and token per test, so counts start at zero
+        self.enterContext(mock.patch.object(api, "_session", None))
+        self.enterContext(mock.patch.object(api, "_auth_token", None))
+        api.cache.clear()
+
+
+class OitApiClientTests(StubOitServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client_api = api.Api()
+
+    def test_connection_reused(self):
+        self.assertEqual(self.client_api.build_auth_header(), "Bearer stub-token")
+        for _ in range(3):
+            self.assertEqual(self.client_api.get_worker_id_from_byu_id("123"), "W1")
+        self.assertEqual(self.server.connections, 1)
+        self.assertIn(("/worker-id", "byu_id=123"), self.server.requests)
+
+    def test_retries(self):
+        self.server.failures["/student-summary"] = [503, 502]
+        summary = self.client_api.get_student_summary("123")
+        self.assertEqual(summary["net_id"], "pat1")
+        self.assertEqual(
+            self.server.requests.count(("/student-summary", "byu_id=123")), 3
+        )
+
+        api.invalidate("student_summary", "123")
+        self.server.failures["/student-summary"] = [503] * 4
+        with self.assertRaises(requests.exceptions.RetryError):
+            self.client_api.get_student_summary("123")
+
+    def test_login_details_fetched_concurrently(self):
+        api.get_auth_token()
+        self.server.delay = 0.3
+        started = time.monotonic()
+        with mock.patch.object(api.connections, "close_all") as close_all:
+            details = self.client_api.get_login_details("123", "pat1", yearterm="20255")
+        elapsed = time.monotonic() - started
+        self.assertEqual(details["student_summary"]["first_name"], "Pat")
+        self.assertEqual(details["enrollments"][0]["curriculum_id"], "x")
+        self.assertTrue(details["worker_summary"]["is_faculty"])
+        # Two rounds (the worker summary needs the worker id), not four requests
+        self.assertLess(elapsed, 0.9)
+        # Each concurrent call closed its thread's database connections
+        self.assertEqual(close_all.call_count, 3)
+        self.assertIn(
+            ("/enrollments", "net_id=pat1&year_term=20255"), self.server.requests
+        )
+
+
+class AuthTokenTests(StubOitServerTestCase):
+    def token_requests(self):
+        return [r for r in self.server.requests if r[0] == "/token"]
+
+    def test_cold_start_from_database(self):
+        AuthToken.objects.create(
+            token="saved", expires_at=timezone.now() + timedelta(minutes=30)
+        )
+        self.assertEqual(api.Api().build_auth_header(), "Bearer saved")
+        # Later instances use the token cached in the process
+        with self.assertNumQueries(0):
+            self.assertEqual(api.Api().build_auth_header(), "Bearer saved")
+        self.assertEqual(self.token_requests(), [])
+
+    def test_refreshed_before_expiry(self):
+        AuthToken.objects.create(
+            token="expiring", expires_at=timezone.now() + timedelta(minutes=2)
+        )
+        self.assertEqual(api.get_auth_token(), "stub-token")
+        self.assertEqual(api.get_auth_token(), "stub-token")
+        self.assertEqual(len(self.token_requests()), 1)
+        (saved,) = AuthToken.objects.all()
+        self.assertEqual(saved.token, "stub-token")
+        self.assertAlmostEqual(
+            (saved.expires_at - timezone.now()).total_seconds(), 3600, delta=5
+        )
+
+    @override_settings(API_TOKEN_REFRESH_WAIT=0.3)
+    def test_single_refresh_across_workers(self):
+        # Another worker holds the refresh lock
+        api.cache.add(api.TOKEN_REFRESH_LOCK, 1)
+        AuthToken.objects.create(
+            token="expiring", expires_at=timezone.now() + timedelta(minutes=2)
+        )
+        # The current token is still valid, so it is used meanwhile
+        self.assertEqual(api.get_auth_token(), "expiring")
+        self.assertEqual(self.token_requests(), [])
+
+        # With no valid token, wait for the other worker, then give up on it
+        AuthToken.objects.update(expires_at=timezone.now())
+        with mock.patch.object(api, "_auth_token", None):
+            self.assertEqual(api.get_auth_token(), "stub-token")
+        self.assertEqual(len(self.token_requests()), 1)
+
+
+class ApiCacheTests(StubOitServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client_api = api.Api()
+        self.server.routes["/yearterm"] = {
+            "data": [
+                {
+                    "year_term": "20255",
+                    "start_date_time": "2000-01-01T00:00:00",
+                    "end_date_time": "2999-01-01T00:00:00",
+                }
+            ]
+        }
+
+    def lookups(self, path):
+        return [r for r in self.server.requests if r[0] == path]
+
+    def test_lookups_cached(self):
+        for _ in range(2):
+            self.assertEqual(
+                self.client_api.get_student_summary("123")["net_id"], "pat1"
+            )
+            self.assertEqual(
+                self.client_api.get_current_year_term()["yearterm"], "20255"
+            )
+        self.assertEqual(len(self.lookups("/student-summary")), 1)
+        self.assertEqual(len(self.lookups("/yearterm")), 1)
+
+        api.invalidate("student_summary", "123")
+        self.client_api.get_student_summary("123")
+        self.assertEqual(len(self.lookups("/student-summary")), 2)
+
+        api.invalidate_all()
+        self.client_api.get_student_summary("123")
+        self.client_api.get_current_year_term()
+        self.assertEqual(len(self.lookups("/student-summary")), 3)
+        self.assertEqual(len(self.lookups("/yearterm")), 2)
+
+    def test_cached_lookup_only_reads(self):
+        self.client_api.get_student_summary("123")
+        with mock.patch.object(api, "cache", wraps=api.cache) as cache:
+            self.client_api.get_student_summary("123")
+        # The key version and the entry
+        self.assertEqual([name for name, *_ in cache.method_calls], ["get", "get"])
+
+    @override_settings(API_CACHE_TTLS={"worker_id": 0})
+    def test_caching_disabled(self):
+        self.client_api.get_worker_id_from_byu_id("123")
+        self.client_api.get_worker_id_from_byu_id("123")
+        self.assertEqual(len(self.lookups("/worker-id")), 2)
+
+    def test_stale_while_refreshing(self):
+        key = api.cache_key("worker_id", ["123"])
+        api.cache.set(key, (time.time() - 1, "W0"), 60)
+        # Another process is refreshing the entry
+        api.cache.add(f"{key}:lock", 1)
+        self.assertEqual(self.client_api.get_worker_id_from_byu_id("123"), "W0")
+        self.assertEqual(self.lookups("/worker-id"), [])
+
+        api.cache.delete(f"{key}:lock")
+        self.assertEqual(self.client_api.get_worker_id_from_byu_id("123"), "W1")
+        self.assertEqual(self.client_api.get_worker_id_from_byu_id("123"), "W1")
+        self.assertEqual(len(self.lookups("/worker-id")), 1)
+
+    def test_stale_on_failure(self):
+        key = api.cache_key("worker_id", ["123"])
+        api.cache.set(key, (time.time() - 1, "W0"), 60)
+        self.server.failures["/worker-id"] = [503] * 4
+        with self.assertLogs("core.api", "WARNING"):
+            self.assertEqual(self.client_api.get_worker_id_from_byu_id("123"), "W0")
+
+
+def enrollment(dept, catalog_number, section, suffix="", withdrawn="N", audit="N"):
+    return {
+        "teaching_area": dept,
+        "catalog_number": catalog_number,
+        "catalog_suffix": suffix,
+        "section_number": section,
+        "withdraw_flag": withdrawn,
+        "audit_flag": audit,
+    }
+
+
+class SyncRostersTests(TestCase):
+    def setUp(self):
+        self.student = User.objects.create_user(netid="stu1", username="stu1")
+        self.auditor = User.objects.create_user(netid="stu2", username="stu2")
+        self.instructor = User.objects.create_user(
+            netid="prof1", username="prof1", privilege_level=PrivilegeLevel.INSTRUCTOR
+        )
+        self.dropped = Course.objects.create(
+            dept="HIST", catalog_number="201", section_number="001"
+        )
+        self.student.courses.add(self.dropped)
+        self.instructor.courses.add(self.dropped)
+        self.spanish = Course.objects.create(
+            dept="SPAN", catalog_number="101", section_number="002"
+        )
+        self.collection = Collection.objects.create(name="Films", owner=self.instructor)
+        self.collection.courses.add(self.spanish)
+        self.history = Collection.objects.create(name="History", owner=self.instructor)
+        self.history.courses.add(self.dropped)
+        CollectionUserAccess.objects.create(user=self.student, collection=self.history)
+        self.enrollments = {
+            ("stu1", "20255"): [
+                enrollment("SPAN", "101", "002"),
+                enrollment("C S", "142", "001", withdrawn="Y"),
+            ],
+            ("stu1", "20261"): [enrollment("ENGL", "150", "010", suffix="R")],
+            ("stu2", "20255"): [enrollment("SPAN", "101", "002", audit="Y")],
+        }
+        self.enterContext(
+            mock.patch.object(
+                api.Api,
+                "get_current_year_term",
+                return_value={"yearterm": "20255", "is_two_weeks_from_end": True},
+            )
+        )
+        self.enterContext(
+            mock.patch.object(
+                api.Api,
+                "get_student_enrollments",
+                autospec=True,
+                side_effect=lambda _, netid, term: self.enrollments.get((netid, term)),
+            )
+        )
+        self.enterContext(mock.patch("core.api.get_auth_token", return_value="token"))
+
+    def sync(self, *args):
+        out = io.StringIO()
+        call_command("sync_rosters", *args, "--concurrency", "2", stdout=out)
+        return out.getvalue()
+
+    def test_sync(self):
+        out = self.sync()
+        self.assertIn("Syncing year terms 20255, 20261", out)
+        self.assertIn("Synced 2 users (0 failed): +3/-1 course memberships", out)
+        self.assertEqual(
+            {str(c) for c in self.student.courses.all()},
+            {"SPAN 101-002", "ENGL 150R-010"},
+        )
+        # Instructors are not synced
+        self.assertEqual(list(self.instructor.courses.all()), [self.dropped])
+        # Course access is derived from the memberships, not stored as rows
+        self.assertEqual(
+            set(
+                EffectiveAccess.objects.filter(
+                    user__in=[self.student, self.auditor]
+                ).values_list("user__netid", "collection", "role")
+            ),
+            {
+                ("stu1", self.history.id, CollectionRole.STUDENT),
+                ("stu1", self.collection.id, CollectionRole.STUDENT),
+                ("stu2", self.collection.id, CollectionRole.STUDENT),
+            },
+        )
+        self.assertFalse(
+            CollectionUserAccess.objects.filter(collection=self.collection).exists()
+        )
+
+        # Nothing changes on a second run
+        self.assertIn("+0/-0 course memberships", self.sync())
+
+    def test_granted_access_kept(self):
+        # stu1 was added to History by hand and has dropped its course
+        self.sync()
+        self.assertEqual(
+            CollectionUserAccess.objects.get(user=self.student).collection,
+            self.history,
+        )
+        self.assertEqual(
+            EffectiveAccess.objects.get(
+                user=self.student, collection=self.history
+            ).role,
+            CollectionRole.STUDENT,
+        )
+
+    def test_no_current_term(self):
+        self.enterContext(
+            mock.patch.object(
+                api.Api,
+                "get_current_year_term",
+                return_value={"yearterm": None, "is_two_weeks_from_end": False},
+            )
+        )
+        with self.assertRaisesMessage(CommandError, "--yearterm"):
+            self.sync()
+
+    def test_failed_lookup_keeps_memberships(self):
+        self.enterContext(
+            mock.patch.object(
+                api.Api,
+                "get_student_enrollments",
+                side_effect=requests.ConnectionError,
+            )
+        )
+        with self.assertLogs("core.management.commands.sync_rosters", "ERROR"):
+            out = self.sync("stu1", "--yearterm", "20255")
+        self.assertIn("Synced 0 users (1 failed)", out)
+        self.assertEqual(list(self.student.courses.all()), [self.dropped])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class EffectiveAccessTests(TestCase):
+    def setUp(self):
+        self.enterContext(mock.patch.object(view_counts, "start_flusher"))
+        self.addCleanup(view_counts.flush)
+        self.owner = User.objects.create_user(
+            netid="prof1", username="prof1", privilege_level=PrivilegeLevel.INSTRUCTOR
+        )
+        self.ta = User.objects.create_user(netid="ta1", username="ta1")
+        self.student = User.objects.create_user(netid="stu1", username="stu1")
+        self.course = Course.objects.create(
+            dept="SPAN", catalog_number="101", section_number="002"
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.collection = Collection.objects.create(
+                name="Films", owner=self.owner, published=True
+            )
+            self.collection.courses.add(self.course)
+            CollectionUserAccess.objects.create(
+                user=self.ta,
+                collection=self.collection,
+                collection_role=CollectionRole.TA,
+            )
+            self.student.courses.add(self.course)
+        resource = Resource.objects.create(name="Film", requester_netid="prof1")
+        self.file = File.objects.create(
+            resource=resource,
+            version="1",
+            file=SimpleUploadedFile("film.mp4", b"frame" * 1000),
+        )
+        self.content = Content.objects.create(
+            title="Film", collection=self.collection, file=self.file, published=True
+        )
+
+    def roles(self):
+        return set(EffectiveAccess.objects.values_list("user__netid", "role"))
+
+    def test_signals_maintain_table(self):
+        self.assertEqual(
+            self.roles(),
+            {
+                ("prof1", CollectionRole.INSTRUCTOR),
+                ("ta1", CollectionRole.TA),
+                ("stu1", CollectionRole.STUDENT),
+            },
+        )
+        # An explicit access takes precedence over the course
+        with self.captureOnCommitCallbacks(execute=True):
+            CollectionUserAccess.objects.create(
+                user=self.student,
+                collection=self.collection,
+                collection_role=CollectionRole.AUDITOR,
+            )
+        self.assertIn(("stu1", CollectionRole.AUDITOR), self.roles())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            CollectionUserAccess.objects.filter(user=self.student).get().delete()
+            self.course.users.remove(self.student)
+        self.assertNotIn("stu1", {netid for netid, _ in self.roles()})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.collection.owner = self.student
+            self.collection.save()
+        self.assertIn(("stu1", CollectionRole.INSTRUCTOR), self.roles())
+        self.assertNotIn("prof1", {netid for netid, _ in self.roles()})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.course.collections.clear()
+            self.collection.delete()
+        self.assertFalse(EffectiveAccess.objects.exists())
+
+    def test_can_view(self):
+        self.assertTrue(access.can_view(self.student, self.content))
+        self.collection.published = False
+        self.assertFalse(access.can_view(self.student, self.content))
+        self.assertTrue(access.can_view(self.ta, self.content))
+
+        outsider = User.objects.create_user(netid="out1", username="out1")
+        self.assertFalse(access.can_view(outsider, self.content))
+        outsider.privilege_level_override = PrivilegeLevel.ADMIN
+        self.assertTrue(access.can_view(outsider, self.content))
+
+        self.collection.published = True
+        self.collection.public = True
+        self.assertTrue(access.can_view(outsider, self.content))
+
+    def test_player_checks_access(self):
+        url = reverse("player", args=[self.content.id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_login(self.student)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_file_views_check_access(self):
+        file_key = FileKey.objects.create(user=self.owner, file=self.file)
+        File.objects.filter(pk=self.file.pk).update(seek_index={"faststart": True})
+        annotation = Annotation.objects.create(
+            file=self.file, owner=self.owner, annotations=[]
+        )
+        self.content.annotation = annotation
+        self.content.save()
+        clip = Clip.objects.create(
+            file=self.file,
+            owner=self.owner,
+            name="Scene",
+            start_time="00:00:00",
+            end_time="00:00:01",
+        )
+        responses = {
+            reverse("stream_file", args=[file_key.id]): 200,
+            reverse("seek_index", args=[file_key.id]): 200,
+            reverse("stream_clip", args=[file_key.id, clip.id]): 302,
+            reverse(
+                "annotation_timeline", args=[annotation.id, annotation.timeline_hash]
+            ): 200,
+        }
+        outsider = User.objects.create_user(netid="out1", username="out1")
+        for user in (None, outsider):
+            if user:
+                self.client.force_login(user)
+            for url in responses:
+                self.assertEqual(self.client.get(url).status_code, 404, url)
+
+        # Another user's FileKey streams to a viewer of the file's content
+        self.client.force_login(self.student)
+        for url, status in responses.items():
+            self.assertEqual(self.client.get(url).status_code, status, url)
+
+    def test_user_scoped_refresh(self):
+        other = Course.objects.create(dept="HIST", catalog_number="201")
+        with self.captureOnCommitCallbacks(execute=True):
+            Collection.objects.create(name="History", owner=self.ta).courses.add(other)
+        self.assertEqual(
+            access.compute_access(user_ids=[self.student.id]),
+            {(self.student.id, self.collection.id): CollectionRole.STUDENT},
+        )
+
+    def test_check_access(self):
+        EffectiveAccess.objects.filter(user=self.ta).update(role=CollectionRole.STUDENT)
+        EffectiveAccess.objects.filter(user=self.student).delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            other = Collection.objects.create(name="Other", owner=self.ta)
+        EffectiveAccess.objects.create(
+            user=self.student, collection=other, role=CollectionRole.STUDENT
+        )
+        with self.assertRaisesMessage(CommandError, "1 missing, 1 wrong role, 1 stale"):
+            call_command("check_access", stdout=io.StringIO())
+
+        out = io.StringIO()
+        call_command("check_access", "--fix", stdout=out)
+        self.assertIn(f"added: user {self.student.id}", out.getvalue())
+        self.assertFalse(access.refresh(dry_run=True))
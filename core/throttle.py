@@ -0,0 +1,286 @@
+"""Bandwidth shaping and concurrency limits for media streams.
+
+With ``STREAM_THROTTLE`` enabled, every stream is registered before it is
+served and paced while it is sent:
+
+- each user may have at most ``STREAM_MAX_STREAMS_PER_USER`` active streams,
+  and each FileKey ``STREAM_MAX_STREAMS_PER_FILE_KEY``; more are refused with
+  429 Too Many Requests;
+- sent bytes are taken from a per-user and a global token bucket. A user's
+  bucket refills at ``STREAM_USER_RATE`` or an equal share of
+  ``STREAM_GLOBAL_RATE`` among active users, whichever is lower, so
+  bandwidth is shared fairly when the uplink is busy.
+
+Buckets allow debt: a chunk is always sent, and the stream then sleeps until
+the debt is repaid, so pacing needs no retries. A stream writes its sent bytes
+to the buckets every ``STREAM_THROTTLE_INTERVAL`` seconds, or sooner once it
+has sent that long's worth at its rate, rather than once per chunk. State lives in a small SQLite database (``STREAM_THROTTLE_DB``) so limits hold
+across worker processes on a host. Streams that have sent nothing for
+``STREAM_IDLE_TIMEOUT`` seconds (paused players, crashed workers) stop
+counting as active.
+"""
+
+import asyncio
+from contextlib import contextmanager
+import sqlite3
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS streams (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    file_key INTEGER NOT NULL,
+    heartbeat REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS streams_heartbeat ON streams (heartbeat);
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+# Seconds clients are asked to wait after 429 Too Many Requests
+RETRY_AFTER = 5
+
+# Rows of finished or abandoned streams are kept this long, so a paused stream
+# that resumes is counted again
+FORGET_AFTER = 60 * 60
+
+METRICS = (
+    "streams_started",
+    "streams_refused_user",
+    "streams_refused_file_key",
+    "bytes_sent",
+    "chunks_delayed",
+    "delay_seconds",
+)
+
+_local = threading.local()
+
+
+class TooManyStreams(Exception):
+    """Raised when a user or FileKey already has the maximum number of streams."""
+
+    def __init__(self, reason):
+        super().__init__(f"Too many concurrent streams per {reason}")
+        self.reason = reason
+
+
+def connection():
+    """Return this thread's connection to the throttle database."""
+    path = str(settings.STREAM_THROTTLE_DB)
+    conn = getattr(_local, "connection", None)
+    if conn is None or _local.path != path:
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=wal")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.connection, _local.path = conn, path
+    return conn
+
+
+@contextmanager
+def transaction():
+    """Run statements in a write transaction, serialized across processes."""
+    conn = connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+
+def increment(conn, name, amount=1):
+    conn.execute(
+        "INSERT INTO metrics (name, value) VALUES (?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+        (name, amount),
+    )
+
+
+def take_tokens(conn, key, amount, rate, now):
+    """Take ``amount`` tokens from a bucket, returning the seconds until it is out of debt."""
+    capacity = rate * settings.STREAM_BURST_SECONDS
+    row = conn.execute(
+        "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+    ).fetchone()
+    tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+    tokens -= amount
+    conn.execute(
+        "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+        (key, tokens, now),
+    )
+    return max(0.0, -tokens / rate)
+
+
+class Stream:
+    """A registered stream; ``take`` paces it and ``close`` unregisters it."""
+
+    def __init__(self, user_id, file_key):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.file_key = file_key
+        self.closed = False
+        # Bytes sent since the buckets were last updated, and when that was
+        self.pending = 0
+        self.synced = 0.0
+        self.rate = settings.STREAM_USER_RATE
+
+    def open(self):
+        now = time.time()
+        active_since = now - settings.STREAM_IDLE_TIMEOUT
+        with transaction() as conn:
+            conn.execute(
+                "DELETE FROM streams WHERE heartbeat < ?", (now - FORGET_AFTER,)
+            )
+            limits = [
+                ("user", "user_id", self.user_id, settings.STREAM_MAX_STREAMS_PER_USER),
+                (
+                    "file_key",
+                    "file_key",
+                    self.file_key,
+                    settings.STREAM_MAX_STREAMS_PER_FILE_KEY,
+                ),
+            ]
+            refused = None
+            for reason, column, value, limit in limits:
+                (count,) = conn.execute(
+                    f"SELECT COUNT(*) FROM streams WHERE {column} = ? AND heartbeat >= ?",
+                    (value, active_since),
+                ).fetchone()
+                if count >= limit:
+                    refused = reason
+                    break
+            if refused:
+                increment(conn, f"streams_refused_{refused}")
+            else:
+                conn.execute(
+                    "INSERT INTO streams (id, user_id, file_key, heartbeat) VALUES (?, ?, ?, ?)",
+                    (self.id, self.user_id, self.file_key, now),
+                )
+                increment(conn, "streams_started")
+        if refused:
+            raise TooManyStreams(refused)
+        return self
+
+    def take(self, amount):
+        """Account for ``amount`` sent bytes and return how long to wait before sending more."""
+        self.pending += amount
+        now = time.time()
+        interval = settings.STREAM_THROTTLE_INTERVAL
+        if now - self.synced < interval and self.pending < self.rate * interval:
+            return 0.0
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE streams SET heartbeat = ? WHERE id = ?", (now, self.id)
+            )
+            wait = self.charge(conn, now)
+        return wait
+
+    def charge(self, conn, now):
+        """Take the pending bytes from the buckets, returning the seconds to wait."""
+        (active_users,) = conn.execute(
+            "SELECT COUNT(DISTINCT user_id) FROM streams WHERE heartbeat >= ?",
+            (now - settings.STREAM_IDLE_TIMEOUT,),
+        ).fetchone()
+        fair_share = settings.STREAM_GLOBAL_RATE / max(active_users, 1)
+        self.rate = min(settings.STREAM_USER_RATE, fair_share)
+        amount, self.pending, self.synced = self.pending, 0, now
+        wait = max(
+            take_tokens(conn, f"user:{self.user_id}", amount, self.rate, now),
+            take_tokens(conn, "global", amount, settings.STREAM_GLOBAL_RATE, now),
+        )
+        increment(conn, "bytes_sent", amount)
+        if wait:
+            increment(conn, "chunks_delayed")
+            increment(conn, "delay_seconds", wait)
+        return wait
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            with transaction() as conn:
+                if self.pending:
+                    # Charged so the user's next stream is paced for them
+                    self.charge(conn, time.time())
+                conn.execute("DELETE FROM streams WHERE id = ?", (self.id,))
+
+
+def open_stream(user_id, file_key):
+    """Register a stream, raising TooManyStreams if a limit is reached."""
+    return Stream(user_id, file_key).open()
+
+
+class ThrottledChunks:
+    """A response body paced by ``stream``.
+
+    Django calls ``close`` when the response is closed, which releases the
+    stream even if the body was never iterated.
+    """
+
+    def __init__(self, chunks, stream):
+        self.chunks = chunks
+        self.stream = stream
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            wait = self.stream.take(len(chunk))
+            if wait:
+                time.sleep(wait)
+            yield chunk
+        self.stream.close()
+
+    def close(self):
+        self.stream.close()
+
+
+class AsyncThrottledChunks(ThrottledChunks):
+    __iter__ = None
+
+    async def __aiter__(self):
+        async for chunk in self.chunks:
+            wait = await asyncio.to_thread(self.stream.take, len(chunk))
+            if wait:
+                await asyncio.sleep(wait)
+            yield chunk
+        # Closing writes to SQLite
+        await asyncio.to_thread(self.stream.close)
+
+
+def throttle_response(response, stream):
+    """Pace a streaming response's body with ``stream``.
+
+    Responses without a body to pace (304, 416, offloaded) release the stream
+    at once. Paced FileResponses are no longer sent with sendfile.
+    """
+    if not response.streaming:
+        stream.close()
+        return response
+    chunks = AsyncThrottledChunks if response.is_async else ThrottledChunks
+    response.streaming_content = chunks(response.streaming_content, stream)
+    return response
+
+
+def metrics():
+    """Return the throttling counters and current activity."""
+    now = time.time()
+    conn = connection()
+    values = dict.fromkeys(METRICS, 0)
+    values.update(conn.execute("SELECT name, value FROM metrics").fetchall())
+    values["active_streams"], values["active_users"] = conn.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT user_id) FROM streams WHERE heartbeat >= ?",
+        (now - settings.STREAM_IDLE_TIMEOUT,),
+    ).fetchone()
+    return values
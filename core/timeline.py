@@ -0,0 +1,167 @@
+"""Compile Annotation events into a timeline the player can search.
+
+``Annotation.annotations`` holds IC_player events: dicts with a ``type``
+(skip, mute, blank, blur, censor, pause, ...), ``start``/``end`` times stored
+as strings, and for censors a ``position`` map of time -> box. Scanning
+them all on every ``timeupdate`` is linear in the number of events, so on
+save they are compiled into::
+
+    {
+        "version": 1,
+        "events": [...],        # normalized, sorted by start
+        "times": [t0, t1, ...], # sorted event boundaries
+        "active": [[i, ...], ...],
+    }
+
+``active[k]`` lists the events in effect from ``times[k]`` until
+``times[k + 1]``, so the player finds what applies at any time with one
+binary search over ``times``. Instantaneous events (``end == start``) are in
+effect for the segment starting at their time, so a ``timeupdate`` that lands
+after them still fires them. The timeline is identified by a hash of its
+contents, which the player uses to cache it.
+"""
+
+import bisect
+import json
+import logging
+
+import xxhash
+
+from . import interpolation
+from .models import parse_time
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+# Overlapping events of these types have the same effect as one longer event
+MERGEABLE_TYPES = {"Skip", "Mute", "Blank"}
+
+
+def normalize_event(event):
+    """Return a flat copy of ``event`` with float times and interpolated positions.
+
+    IC_player events wrap their fields in ``options`` with the censor
+    settings and ``position`` map under ``options.details``; those are
+    flattened so every event has ``type``, ``start`` and ``end`` at the top.
+    Censor positions become a sorted ``position`` list of ``[time, box]``
+    keyframes and, unless ``interpolate`` is false, a packed per-frame
+    ``track`` (see core/interpolation.py). Keyframes that cannot be
+    interpolated are kept as given, without a track, so the censor still
+    applies.
+    """
+    if isinstance(event.get("options"), dict):
+        event = event["options"]
+    details = dict(event.get("details") or {})
+    position = details.pop("position", None) or event.get("position")
+    start = parse_time(event["start"])
+    end = parse_time(event["end"]) if event.get("end") not in (None, "") else start
+    if end < start:
+        raise ValueError(f"Event ends before it starts: {event!r}")
+    normalized = dict(event, type=str(event["type"]).strip().capitalize())
+    normalized.update(start=start, end=end)
+    normalized.pop("active", None)
+    if "details" in event:
+        normalized["details"] = details
+    if isinstance(position, dict):
+        normalized["position"] = position
+        try:
+            normalized["position"] = [
+                [time, box]
+                for time, box in sorted(
+                    (parse_time(time), box) for time, box in position.items()
+                )
+            ]
+            if details.get("interpolate", event.get("interpolate", True)):
+                track = interpolation.interpolate(
+                    position, easing=details.get("easing")
+                )
+                if track:
+                    normalized["track"] = track
+        except (TypeError, ValueError) as e:
+            logger.warning("Not interpolating censor %r: %s", event, e)
+    return normalized
+
+
+def iter_events(annotations):
+    """Yield the raw events of an annotations document (a list, or lists by key)."""
+    if isinstance(annotations, dict):
+        for value in annotations.values():
+            if isinstance(value, list):
+                yield from value
+    elif isinstance(annotations, list):
+        yield from annotations
+
+
+def merge_events(events):
+    """Merge overlapping or touching events of the same mergeable type."""
+    merged = []
+    last_by_type = {}
+    for event in sorted(events, key=lambda e: (e["start"], e["end"])):
+        last = last_by_type.get(event["type"])
+        if (
+            event["type"] in MERGEABLE_TYPES
+            and last is not None
+            and event["start"] <= last["end"]
+        ):
+            last["end"] = max(last["end"], event["end"])
+            continue
+        merged.append(event)
+        if event["type"] in MERGEABLE_TYPES:
+            last_by_type[event["type"]] = event
+    return merged
+
+
+def compile_annotations(annotations):
+    """Return the compiled timeline of an annotations document.
+
+    Malformed events are logged and left out.
+    """
+    events = []
+    for event in iter_events(annotations):
+        try:
+            events.append(normalize_event(event))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            logger.warning("Skipping malformed annotation event %r", event)
+    events = merge_events(events)
+    events.sort(key=lambda e: (e["start"], e["end"], e["type"]))
+
+    times = sorted({e["start"] for e in events} | {e["end"] for e in events})
+    active = [[] for _ in times]
+    for index, event in enumerate(events):
+        first = bisect.bisect_left(times, event["start"])
+        last = max(bisect.bisect_left(times, event["end"]), first + 1)
+        for segment in range(first, last):
+            active[segment].append(index)
+    return {"version": VERSION, "events": events, "times": times, "active": active}
+
+
+def timeline_hash(timeline):
+    """Return the xxhash64 of a timeline's canonical JSON encoding."""
+    encoded = json.dumps(timeline, sort_keys=True, separators=(",", ":"))
+    return xxhash.xxh64(encoded.encode()).hexdigest()
+
+
+def active_events(timeline, time):
+    """Return the events in effect at ``time`` (the lookup the player does)."""
+    segment = bisect.bisect_right(timeline["times"], time) - 1
+    if segment < 0:
+        return []
+    return [timeline["events"][i] for i in timeline["active"][segment]]
+
+
+def compile_annotation(annotation):
+    """Compile ``annotation.annotations`` into its ``timeline`` and ``timeline_hash``."""
+    annotation.timeline = compile_annotations(annotation.annotations)
+    annotation.timeline_hash = timeline_hash(annotation.timeline)
+
+
+def compiled(annotation):
+    """Return an annotation's timeline hash, compiling it first if it never was."""
+    if annotation.timeline_hash:
+        return annotation.timeline_hash
+    compile_annotation(annotation)
+    type(annotation).objects.filter(pk=annotation.pk).update(
+        timeline=annotation.timeline, timeline_hash=annotation.timeline_hash
+    )
+    return annotation.timeline_hash
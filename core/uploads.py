@@ -0,0 +1,161 @@
+"""Resumable, chunked uploads of large media files.
+
+Clients create an ``Upload`` with the total size, send the bytes in ordered
+chunks tagged with their offset, and finalize it into a ``File``. Chunks are
+hashed with xxh64 as they are written, so finalizing needs no second pass
+over the file; the partial file is then moved into media storage.
+
+The running hash state lives in the worker process. If a chunk lands on a
+different process (or after a restart) the partial file is rehashed once to
+catch up.
+"""
+
+from collections import OrderedDict
+import fcntl
+import os
+import threading
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+from django.utils import timezone
+import xxhash
+
+from . import checksums
+from .models import File
+
+READ_SIZE = 1024 * 1024
+MAX_HASHERS = 256
+
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+class OffsetMismatch(Exception):
+    """Raised when a chunk does not start at the upload's current offset."""
+
+    def __init__(self, offset):
+        super().__init__(f"Expected offset {offset}")
+        self.offset = offset
+
+
+class UploadTooLarge(Exception):
+    """Raised when a chunk would extend past the declared upload size."""
+
+
+class PartialFile(UploadedFile):
+    """A completed partial upload that storage can move instead of copying."""
+
+    def __init__(self, path, name, size):
+        super().__init__(open(path, "rb"), name=name, size=size)
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def partial_path(upload):
+    return os.path.join(settings.UPLOAD_CHUNK_DIR, f"{upload.id}.part")
+
+
+def _hasher(upload, f):
+    """Return an xxh64 hasher fed with the first ``upload.offset`` bytes of ``f``."""
+    with _hashers_lock:
+        offset, hasher = _hashers.pop(upload.id, (None, None))
+    if offset != upload.offset:
+        hasher = xxhash.xxh64()
+        f.seek(0)
+        remaining = upload.offset
+        while remaining > 0:
+            chunk = f.read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
+
+
+def _remember(upload, hasher):
+    with _hashers_lock:
+        _hashers[upload.id] = (upload.offset, hasher)
+        while len(_hashers) > MAX_HASHERS:
+            _hashers.popitem(last=False)
+
+
+def append_chunk(upload, offset, stream):
+    """Write the bytes of ``stream`` at ``offset`` and return the new offset."""
+    path = partial_path(upload)
+    os.makedirs(settings.UPLOAD_CHUNK_DIR, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "r+b") as f:
+        # Serialize concurrent chunks for the same upload across processes
+        fcntl.flock(f, fcntl.LOCK_EX)
+        upload.refresh_from_db(fields=["offset"])
+        if offset != upload.offset:
+            raise OffsetMismatch(upload.offset)
+
+        hasher = _hasher(upload, f)
+        f.seek(offset)
+        f.truncate()
+        while chunk := stream.read(READ_SIZE):
+            if offset + len(chunk) > upload.size:
+                f.truncate(upload.offset)
+                raise UploadTooLarge(f"Upload is limited to {upload.size} bytes")
+            f.write(chunk)
+            hasher.update(chunk)
+            offset += len(chunk)
+        f.flush()
+
+        upload.offset = offset
+        upload.save(update_fields=["offset", "updated_at"])
+        _remember(upload, hasher)
+    return offset
+
+
+def finalize(upload):
+    """Turn a complete upload into a File.
+
+    Raises ValidationError for unsupported or duplicate content.
+    """
+    path = partial_path(upload)
+    with open(path, "rb") as f:
+        hasher = _hasher(upload, f)
+    checksum = hasher.hexdigest()
+
+    file_obj = File(
+        resource=upload.resource,
+        version=upload.version,
+        full_video=upload.full_video,
+        checksum=checksum,
+        checksum_at=timezone.now(),
+    )
+    partial = PartialFile(path, upload.filename, upload.size)
+    file_obj.file = partial
+    checksums.set_checksum(file_obj.file, checksum)
+    try:
+        # Runs validate_media_file and the validate_unique_checksum dedupe
+        # check, which reuses the checksum set above
+        file_obj.full_clean()
+        with transaction.atomic():
+            file_obj.save()
+            upload.file = file_obj
+            upload.save(update_fields=["file", "updated_at"])
+    finally:
+        partial.close()
+    if os.path.exists(path):
+        # Content-addressed storage keeps an existing copy instead of moving
+        os.remove(path)
+    with _hashers_lock:
+        _hashers.pop(upload.id, None)
+    return file_obj
+
+
+def discard(upload):
+    """Delete an upload and its partial file."""
+    with _hashers_lock:
+        _hashers.pop(upload.id, None)
+    try:
+        os.remove(partial_path(upload))
+    except FileNotFoundError:
+        pass
+    upload.delete()
@@ -1,10 +1,23 @@
+from django.conf import settings
 from django.urls import path
 
+from .views import annotation_timeline
 from .views import create_collection
+from .views import create_upload
+from .views import finalize_upload
+from .views import hls_file
 from .views import index
 from .views import manage_collections
+from .views import playback_events
 from .views import player
+from .views import seek_index
+from .views import stream_clip
 from .views import stream_file
+from .views import stream_file_async
+from .views import stream_metrics
+from .views import stream_token
+from .views import stream_token_async
+from .views import upload_detail
 
 app_name = "core"
 
@@ -13,5 +26,27 @@ urlpatterns = [
     path("manage-collections/", manage_collections, name="manage_collections"),
     path("collections/create/", create_collection, name="create_collection"),
     path("player/<int:content_id>", player, name="player"),
-    path("stream/<int:file_key>", stream_file, name="stream_file"),
+    path(
+        "stream/<int:file_key>",
+        stream_file_async if settings.STREAM_ASYNC else stream_file,
+        name="stream_file",
+    ),
+    path(
+        "stream/t/<str:token>",
+        stream_token_async if settings.STREAM_ASYNC else stream_token,
+        name="stream_token",
+    ),
+    path("stream/metrics", stream_metrics, name="stream_metrics"),
+    path("stream/<int:file_key>/clips/<int:clip_id>", stream_clip, name="stream_clip"),
+    path("hls/<int:file_key>/<str:name>", hls_file, name="hls_file"),
+    path("seek-index/<int:file_key>", seek_index, name="seek_index"),
+    path(
+        "timeline/<int:annotation_id>/<str:digest>",
+        annotation_timeline,
+        name="annotation_timeline",
+    ),
+    path("analytics/events", playback_events, name="playback_events"),
+    path("uploads/", create_upload, name="create_upload"),
+    path("uploads/<uuid:upload_id>", upload_detail, name="upload_detail"),
+    path("uploads/<uuid:upload_id>/finalize", finalize_upload, name="finalize_upload"),
 ]
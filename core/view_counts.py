@@ -0,0 +1,105 @@
+"""Batched view counting for Content and Resource.
+
+Incrementing ``views`` on every playback would make each player hit a write
+transaction, and under SQLite every write waits for the single writer lock.
+``record_view`` only adds to an in-process buffer, which a thread in each
+process flushes every ``VIEW_COUNT_FLUSH_INTERVAL`` seconds as a few
+``UPDATE ... SET views = views + n`` statements (one per distinct n). They
+are atomic, so totals stay correct with any number of processes.
+
+Repeat views by the same viewer within ``VIEW_COUNT_DEDUPE_SECONDS`` are
+ignored using ``cache.add`` on the default cache, which all processes share.
+Views buffered when a process is killed (at most one interval's worth) are
+lost.
+"""
+
+import atexit
+from collections import Counter
+from collections import defaultdict
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db import transaction
+from django.db.models import F
+
+from .models import Content
+from .models import Resource
+
+logger = logging.getLogger(__name__)
+
+_pending = {Content: Counter(), Resource: Counter()}
+_lock = threading.Lock()
+# Process whose flusher thread is running; setting _stop ends the thread
+_flusher_pid = None
+_stop = threading.Event()
+
+
+def record_view(content, viewer=None):
+    """Count a view of ``content`` by ``viewer`` (e.g. a user or session id).
+
+    Returns False for a repeat view that was not counted.
+    """
+    if viewer is not None:
+        key = f"core.view:{content.id}:{viewer}"
+        if not cache.add(key, True, settings.VIEW_COUNT_DEDUPE_SECONDS):
+            return False
+    resource_id = content.file.resource_id if content.file_id else None
+    with _lock:
+        _pending[Content][content.id] += 1
+        if resource_id:
+            _pending[Resource][resource_id] += 1
+    start_flusher()
+    return True
+
+
+def start_flusher():
+    """Start this process's flusher thread unless it is running."""
+    global _flusher_pid
+    with _lock:
+        # Threads do not survive a fork
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=flush_periodically, name="view-counts", daemon=True).start()
+
+
+def flush_periodically():
+    while not _stop.wait(settings.VIEW_COUNT_FLUSH_INTERVAL):
+        with _lock:
+            pending = any(_pending.values())
+        if pending:
+            flush()
+            close_old_connections()
+
+
+def flush():
+    """Write buffered view counts to the database, returning whether it succeeded.
+
+    On failure the counts are kept in the buffer for the next flush.
+    """
+    with _lock:
+        pending = {model: counts.copy() for model, counts in _pending.items()}
+        for counts in _pending.values():
+            counts.clear()
+    try:
+        with transaction.atomic():
+            for model, counts in pending.items():
+                ids_by_amount = defaultdict(list)
+                for pk, amount in counts.items():
+                    ids_by_amount[amount].append(pk)
+                for amount, ids in ids_by_amount.items():
+                    model.objects.filter(pk__in=ids).update(views=F("views") + amount)
+    except Exception:
+        logger.exception("Could not save view counts; will retry")
+        with _lock:
+            for model, counts in pending.items():
+                _pending[model].update(counts)
+        return False
+    return True
+
+
+atexit.register(flush)
@@ -1,16 +1,46 @@
-import mimetypes
+import asyncio
+import json
 import os
-import re
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.db.models import Prefetch
 from django.http import Http404
 from django.http import HttpResponse
+from django.http import HttpResponseRedirect
+from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render
-
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import require_POST
+
+from . import access
+from . import analytics
+from . import chunk_cache
+from . import clips
+from . import hls
+from . import stream_cache
+from . import stream_tokens
+from . import throttle
+from . import timeline
+from . import uploads
+from . import view_counts
+from .models import Annotation
+from .models import Clip
 from .models import Collection
 from .models import Content
+from .models import File
 from .models import FileKey
+from .models import Resource
+from .models import Subtitle
+from .models import Upload
 from .models import User
+from .streaming import serve_file
 
 
 def index(request):
@@ -25,135 +55,506 @@ def index(request):
     return render(request, "index.html", context)
 
 
+PLAYER_CLIP_FIELDS = ("id", "name", "start_time", "end_time")
+
+
+def player_data(content, file_key):
+    """Serialize what the player script needs from a Content prefetched by ``player``."""
+    annotation = content.annotation
+    timeline_url = None
+    if annotation:
+        timeline_url = reverse(
+            "annotation_timeline", args=[annotation.id, timeline.compiled(annotation)]
+        )
+    subtitles = content.file.subtitles.all() if content.file else []
+    clip_list = sorted(content.clips.all(), key=lambda clip: clip.start_seconds)
+    return {
+        "timeline": timeline_url,
+        "subtitles": [
+            {
+                "id": subtitle.id,
+                "language": subtitle.language.language,
+                "name": subtitle.name,
+                "content": subtitle.subtitles or [],
+            }
+            for subtitle in subtitles
+        ]
+        if content.allow_captions
+        else [],
+        "clips": [
+            {
+                "id": clip.id,
+                "name": clip.name,
+                "start": clip.start_seconds,
+                "end": clip.end_seconds,
+                "url": reverse("stream_clip", args=[file_key.id, clip.id])
+                if file_key
+                else None,
+            }
+            for clip in clip_list
+        ],
+    }
+
+
 def player(request, content_id):
-    """Render the video player page."""
-    content = get_object_or_404(Content, id=content_id)
+    """Render the video player page.
+
+    Everything on the page is loaded in a fixed number of queries: the Content
+    with its Collection, File and Annotation, the viewer's role in the
+    collection, its Clips, the File's Subtitles with their Languages, and the
+    viewer's FileKey.
+    """
+    content = get_object_or_404(
+        Content.objects.select_related("collection", "file", "annotation")
+        # The player fetches the timeline by its hash (see annotation_timeline)
+        .defer("annotation__annotations", "annotation__history", "annotation__timeline")
+        .prefetch_related(
+            Prefetch("clips", queryset=Clip.objects.only(*PLAYER_CLIP_FIELDS)),
+            Prefetch(
+                "file__subtitles",
+                queryset=Subtitle.objects.select_related("language").order_by(
+                    "language__language", "name"
+                ),
+            ),
+        ),
+        id=content_id,
+    )
+    if not access.can_view(request.user, content):
+        raise Http404("Content not found")
+    if request.user.is_authenticated:
+        viewer = f"user:{request.user.pk}"
+    else:
+        viewer = request.session.session_key
+    view_counts.record_view(content, viewer)
     user = User.objects.first()  # TODO: Delete
     # user = request.user  # TODO: Uncomment
+    file_key = None
     if content.file:
-        file_key = FileKey.objects.filter(file=content.file, user=user).first()
-
+        file_key = (
+            FileKey.objects.select_related("file")
+            .filter(file=content.file, user=user)
+            .first()
+        )
+    stream_url = None
+    if file_key:
+        # Range requests on this URL are served without database queries
+        stream_url = reverse("stream_token", args=[stream_tokens.mint(file_key)])
+
+    data = player_data(content, file_key)
     context = {
         "content": content,
         "file_key": file_key.id if file_key else None,
-        "allow_events": True,
-        "events": [],
-        "subtitles": [],
-        "clips": [],
+        "stream_url": stream_url,
+        "analytics_heartbeat": settings.ANALYTICS_HEARTBEAT_SECONDS,
+        "hls": bool(file_key) and hls.is_segmented(content.file),
+        "subtitles": data["subtitles"],
+        "clips": data["clips"],
+        "player_data": data,
     }
 
     return render(request, "player.html", context)
 
 
+# Private: responses depend on who is asking (see core.access)
+STREAM_HEADERS = {"Cache-Control": "private, max-age=3600"}
+
+
+def require_file_access(user, file_key_user_id, file_id):
+    if not access.can_view_file(user, file_key_user_id, file_id):
+        raise Http404("File not found")
+
+
+def throttled(user_id, file_key, respond):
+    """Return ``respond()``, paced by core.throttle when STREAM_THROTTLE is set."""
+    if not settings.STREAM_THROTTLE:
+        return respond()
+    try:
+        stream = throttle.open_stream(user_id, file_key)
+    except throttle.TooManyStreams as e:
+        return HttpResponse(
+            str(e), status=429, headers={"Retry-After": str(throttle.RETRY_AFTER)}
+        )
+    try:
+        response = respond()
+    except BaseException:
+        stream.close()
+        raise
+    return throttle.throttle_response(response, stream)
+
+
+@staff_member_required
+def stream_metrics(request):
+    """Export stream throttling and chunk cache metrics in the Prometheus text format."""
+    metrics = {}
+    if settings.STREAM_THROTTLE:
+        for name, value in throttle.metrics().items():
+            metrics[f"stream_{name}"] = value
+    if settings.STREAM_CHUNK_CACHE:
+        for name, value in chunk_cache.stats().items():
+            metrics[f"chunk_cache_{name}"] = value
+    lines = []
+    for name, value in metrics.items():
+        kind = "gauge" if name.startswith("stream_active_") else "counter"
+        metric = f"yvideo_{name}"
+        if kind == "counter":
+            metric += "_total"
+        lines += [f"# TYPE {metric} {kind}", f"{metric} {value:g}"]
+    return HttpResponse(
+        "\n".join(lines) + "\n", content_type="text/plain; version=0.0.4"
+    )
+
+
 def stream_file(request, file_key):
     """Stream file content with support for HTTP Range requests (partial content)."""
     try:
-        # Get the FileKey object
-        file_key_obj = get_object_or_404(FileKey, id=file_key)
-        file_obj = file_key_obj.file
-
-        # Check if file exists
-        if not file_obj.file or not os.path.exists(file_obj.file.path):
+        # FileKey, File and file metadata, usually from the per-process cache
+        meta = stream_cache.resolve(file_key)
+        if meta is None:
             raise Http404("File not found")
+        require_file_access(request.user, meta.user_id, meta.file_id)
 
-        file_path = file_obj.file.path
-        file_size = os.path.getsize(file_path)
-
-        # Get proper MIME type
-        content_type, _ = mimetypes.guess_type(file_path)
-        if not content_type:
-            if file_obj.file.name.lower().endswith((".mp4", ".m4v")):
-                content_type = "video/mp4"
-            elif file_obj.file.name.lower().endswith(".webm"):
-                content_type = "video/webm"
-            elif file_obj.file.name.lower().endswith((".mov", ".qt")):
-                content_type = "video/quicktime"
-            elif file_obj.file.name.lower().endswith(".mp3"):
-                content_type = "audio/mpeg"
-            elif file_obj.file.name.lower().endswith(".m4a"):
-                content_type = "audio/mp4"
-            elif file_obj.file.name.lower().endswith(".wav"):
-                content_type = "audio/wav"
-            else:
-                content_type = "application/octet-stream"
-
-        # Parse Range header
-        range_header = request.META.get("HTTP_RANGE")
-        if range_header:
-            # Parse range header like "bytes=0-1023" or "bytes=1024-"
-            range_match = re.match(r"bytes=(\d+)-(\d*)", range_header)
-            if range_match:
-                start = int(range_match.group(1))
-                end = (
-                    int(range_match.group(2)) if range_match.group(2) else file_size - 1
-                )
-
-                # Validate range - fix the validation logic
-                if start >= file_size:
-                    response = HttpResponse(status=416)  # Range Not Satisfiable
-                    response["Content-Range"] = f"bytes */{file_size}"
-                    return response
-
-                # Ensure end doesn't exceed file size
-                end = min(end, file_size - 1)
-
-                # Read file chunk
-                with open(file_path, "rb") as f:
-                    f.seek(start)
-                    chunk_size = end - start + 1
-                    content = f.read(chunk_size)
-
-                # Create partial content response
-                response = HttpResponse(content, status=206)  # Partial Content
-                response["Content-Range"] = f"bytes {start}-{end}/{file_size}"
-                response["Content-Length"] = str(chunk_size)
-                response["Accept-Ranges"] = "bytes"
-                response["Content-Type"] = content_type
-
-                # Add caching headers for better performance
-                response["Cache-Control"] = "public, max-age=3600"
-                response["ETag"] = f'"{file_size}-{os.path.getmtime(file_path)}"'
-
-                return response
-
-        # No range header - return full file (but WebKit will likely request ranges anyway)
-        # For large files, consider always forcing range requests
-        response = HttpResponse()
-        response["Content-Length"] = str(file_size)
-        response["Accept-Ranges"] = "bytes"
-        response["Content-Type"] = content_type
-        response["Cache-Control"] = "public, max-age=3600"
-        response["ETag"] = f'"{file_size}-{os.path.getmtime(file_path)}"'
-
-        # For large video files, encourage range requests
-        if file_size > 1024 * 1024 and content_type.startswith("video/"):  # > 1MB
-            # Return 206 with full range to encourage proper range handling
-            response.status_code = 206
-            response["Content-Range"] = f"bytes 0-{file_size - 1}/{file_size}"
-
-        # Stream the content in chunks to avoid memory issues
-        def file_iterator(file_path, chunk_size=8192):
-            with open(file_path, "rb") as f:
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    yield chunk
-
-        response = HttpResponse(file_iterator(file_path), content_type=content_type)
-        response["Content-Length"] = str(file_size)
-        response["Accept-Ranges"] = "bytes"
-        response["Cache-Control"] = "public, max-age=3600"
-        response["ETag"] = f'"{file_size}-{os.path.getmtime(file_path)}"'
-
-        return response
-
-    except FileKey.DoesNotExist:
-        raise Http404("Invalid file key")
+        return throttled(
+            meta.user_id,
+            meta.file_key,
+            lambda: serve_meta(request, meta),
+        )
+
+    except Http404:
+        raise
     except Exception as e:
         return HttpResponse(f"Error streaming file: {str(e)}", status=500)
 
 
+async def stream_file_async(request, file_key):
+    """Async stream_file for ASGI servers; file system calls run in worker threads."""
+    meta = await stream_cache.aresolve(file_key)
+    if meta is None:
+        raise Http404("File not found")
+    user = await request.auser()
+    await sync_to_async(require_file_access)(user, meta.user_id, meta.file_id)
+
+    def respond():
+        return serve_meta(request, meta, asynchronous=True)
+
+    if not settings.STREAM_THROTTLE:
+        return await asyncio.to_thread(respond)
+    return await asyncio.to_thread(throttled, meta.user_id, meta.file_key, respond)
+
+
+def serve_meta(request, meta, asynchronous=False):
+    """Serve a file described by a core.stream_cache.StreamMeta."""
+    try:
+        return serve_file(
+            request,
+            meta.path,
+            meta.name,
+            content_type=meta.content_type,
+            headers=STREAM_HEADERS,
+            etag=meta.etag,
+            last_modified=meta.last_modified,
+            asynchronous=asynchronous,
+            size=meta.size,
+            cache_key=meta.etag,
+        )
+    except FileNotFoundError:
+        # Removed since it was cached
+        stream_cache.invalidate(file_key=meta.file_key)
+        raise Http404("File not found")
+
+
+def load_stream_token(token):
+    try:
+        return stream_tokens.load(token)
+    except signing.BadSignature:
+        raise Http404("Invalid or expired stream token")
+
+
+def serve_stream_token(request, data, asynchronous=False):
+    """Serve the file described by a loaded stream token, without queries."""
+    path = File._meta.get_field("file").storage.path(data["name"])
+    if data["checksum"]:
+        etag = f'"{data["checksum"]}"'
+    else:
+        etag = f'W/"{data["size"]}-{data["mtime"]}"'
+    try:
+        return serve_file(
+            request,
+            path,
+            data["name"],
+            content_type=data["content_type"],
+            headers=STREAM_HEADERS,
+            etag=etag,
+            last_modified=data["mtime"],
+            asynchronous=asynchronous,
+            size=data["size"],
+            cache_key=etag,
+        )
+    except FileNotFoundError:
+        raise Http404("File not found")
+
+
+def stream_token(request, token):
+    """Stream the file of a signed stream token (see core/stream_tokens.py)."""
+    data = load_stream_token(token)
+    return throttled(
+        data["user_id"],
+        data["file_key"],
+        lambda: serve_stream_token(request, data),
+    )
+
+
+async def stream_token_async(request, token):
+    """Async stream_token for ASGI servers."""
+    data = load_stream_token(token)
+
+    def respond():
+        return serve_stream_token(request, data, asynchronous=True)
+
+    if not settings.STREAM_THROTTLE:
+        return await asyncio.to_thread(respond)
+    return await asyncio.to_thread(
+        throttled, data["user_id"], data["file_key"], respond
+    )
+
+
+@require_http_methods(["GET", "HEAD"])
+def seek_index(request, file_key):
+    """Return the keyframe seek index of a FileKey's MP4 file.
+
+    ``keyframes`` holds parallel lists of times (seconds) and byte offsets, so
+    a seek to time t can request ``bytes=<offset of the last keyframe <= t>-``
+    directly instead of probing the file.
+    """
+    file_key_obj = get_object_or_404(
+        FileKey.objects.select_related("file"), id=file_key
+    )
+    require_file_access(request.user, file_key_obj.user_id, file_key_obj.file_id)
+    file_obj = file_key_obj.file
+    if not file_obj.seek_index:
+        raise Http404("No seek index")
+    response = JsonResponse(file_obj.seek_index, headers=STREAM_HEADERS)
+    if file_obj.checksum:
+        response["ETag"] = f'"{file_obj.checksum}"'
+    return response
+
+
+IMMUTABLE_HEADERS = {"Cache-Control": "private, max-age=31536000, immutable"}
+
+
+def hls_file(request, file_key, name):
+    """Serve a FileKey's HLS playlist or one of its segments."""
+    file_key_obj = get_object_or_404(
+        FileKey.objects.select_related("file"), id=file_key
+    )
+    require_file_access(request.user, file_key_obj.user_id, file_key_obj.file_id)
+    file_obj = file_key_obj.file
+    if not hls.is_segmented(file_obj):
+        raise Http404("File has not been segmented")
+    if name == hls.PLAYLIST_NAME:
+        path = hls.playlist_path(file_obj)
+        content_type = hls.PLAYLIST_CONTENT_TYPE
+    else:
+        path = hls.segment_path(file_obj, name)
+        content_type = hls.SEGMENT_CONTENT_TYPE
+        if path is None or not os.path.exists(path):
+            raise Http404("Segment not found")
+    # Output is keyed by checksum, so both playlist and segments are immutable
+    return serve_file(
+        request,
+        path,
+        f"{hls.HLS_DIR}/{file_obj.checksum}/{name}",
+        content_type=content_type,
+        headers=IMMUTABLE_HEADERS,
+        etag=f'"{file_obj.checksum}-{name}"',
+        last_modified=int(os.path.getmtime(path)),
+    )
+
+
+def stream_clip(request, file_key, clip_id):
+    """Stream only a clip's window of a FileKey's file.
+
+    Serves the clip's pre-cut asset. Until its cut_clip job has run, redirects
+    to the full stream with a media fragment so the player seeks straight to
+    the window.
+    """
+    file_key_obj = get_object_or_404(
+        FileKey.objects.select_related("file"), id=file_key
+    )
+    require_file_access(request.user, file_key_obj.user_id, file_key_obj.file_id)
+    clip = get_object_or_404(Clip, id=clip_id, file=file_key_obj.file)
+    clip.file = file_key_obj.file
+    if not clips.is_cut(clip):
+        url = reverse("stream_file", args=[file_key])
+        return HttpResponseRedirect(
+            f"{url}#t={clip.start_seconds:g},{clip.end_seconds:g}"
+        )
+    path = clips.clip_path(clip)
+    checksum, start, end = clips.asset_key(clip)
+    # The asset is named by its content, so it never changes
+    return serve_file(
+        request,
+        path,
+        f"{clips.CLIPS_DIR}/{checksum}/{os.path.basename(path)}",
+        headers=IMMUTABLE_HEADERS,
+        etag=f'"{checksum}-{start:g}-{end:g}"',
+        last_modified=int(os.path.getmtime(path)),
+    )
+
+
+def annotation_timeline(request, annotation_id, digest):
+    """Serve an Annotation's compiled timeline (see core/timeline.py).
+
+    The URL carries the timeline's hash, so responses never change and can be
+    cached for good; an outdated hash redirects to the current timeline.
+    """
+    annotation = get_object_or_404(
+        Annotation.objects.only("owner_id", "annotations", "timeline", "timeline_hash"),
+        id=annotation_id,
+    )
+    user = request.user
+    if not (user.is_authenticated and user.pk == annotation.owner_id):
+        contents = annotation.contents.select_related("collection")
+        if not access.can_view_any(user, contents):
+            raise Http404("Annotation not found")
+    current = timeline.compiled(annotation)
+    if digest != current:
+        return HttpResponseRedirect(
+            reverse("annotation_timeline", args=[annotation_id, current])
+        )
+    response = JsonResponse(annotation.timeline, headers=IMMUTABLE_HEADERS)
+    response["ETag"] = f'"{current}"'
+    return response
+
+
+@csrf_exempt
+@require_POST
+def playback_events(request):
+    """Store a batch of playback events from the player (see core/analytics.py).
+
+    Exempt from CSRF checks because batches are also sent with
+    navigator.sendBeacon, which cannot set headers; the endpoint only appends
+    telemetry, and only for content the viewer may watch.
+    """
+    try:
+        data = json.loads(request.body)
+        content_id = int(data["content"])
+        if not 0 < content_id < 2**32:
+            raise ValueError(content_id)
+        content = (
+            Content.objects.select_related("collection").filter(id=content_id).first()
+        )
+        if content is None or not access.can_view(request.user, content):
+            raise Http404("Content not found")
+        if request.user.is_authenticated:
+            viewer = f"user:{request.user.pk}"
+        else:
+            viewer = request.session.session_key or request.META.get("REMOTE_ADDR")
+        count = analytics.append_events(content_id, viewer, data["events"])
+    except (ValueError, KeyError, TypeError) as e:
+        return JsonResponse({"error": f"Invalid events: {e}"}, status=400)
+    return JsonResponse({"stored": count})
+
+
+def upload_state(upload):
+    return {
+        "id": str(upload.id),
+        "offset": upload.offset,
+        "size": upload.size,
+        "file": upload.file_id,
+        "url": reverse("upload_detail", args=[upload.id]),
+    }
+
+
+@require_POST
+def create_upload(request):
+    """Start a resumable upload of a new File for a resource."""
+    if not request.user.has_perm("core.add_file"):
+        return JsonResponse({"error": "Permission denied"}, status=403)
+    resource = get_object_or_404(Resource, id=request.POST.get("resource"))
+    try:
+        size = int(request.POST.get("size") or request.headers["Upload-Length"])
+    except (KeyError, ValueError):
+        return JsonResponse({"error": "size is required"}, status=400)
+    if size <= 0 or not request.POST.get("filename") or not request.POST.get("version"):
+        return JsonResponse(
+            {"error": "filename, version and a positive size are required"},
+            status=400,
+        )
+
+    upload = Upload.objects.create(
+        owner=request.user,
+        resource=resource,
+        version=request.POST["version"],
+        full_video=request.POST.get("full_video", "true").lower() != "false",
+        filename=os.path.basename(request.POST["filename"]),
+        size=size,
+    )
+    response = JsonResponse(upload_state(upload), status=201)
+    response["Location"] = upload_state(upload)["url"]
+    response["Upload-Offset"] = "0"
+    return response
+
+
+@require_http_methods(["GET", "HEAD", "PUT", "PATCH", "DELETE"])
+def upload_detail(request, upload_id):
+    """Report (GET/HEAD), extend (PUT/PATCH) or abandon (DELETE) an upload.
+
+    Chunks carry their starting byte in the Upload-Offset header; a chunk at
+    the wrong offset gets 409 with the offset the server expects.
+    """
+    upload = get_object_or_404(Upload, id=upload_id, owner=request.user.pk)
+
+    if request.method == "DELETE":
+        uploads.discard(upload)
+        return HttpResponse(status=204)
+
+    if request.method in ("PUT", "PATCH"):
+        if upload.file_id:
+            return JsonResponse({"error": "Upload already finalized"}, status=409)
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            return JsonResponse({"error": "Upload-Offset is required"}, status=400)
+        if int(request.headers.get("Content-Length") or 0) > (
+            settings.UPLOAD_MAX_CHUNK_SIZE
+        ):
+            return JsonResponse({"error": "Chunk too large"}, status=413)
+        try:
+            uploads.append_chunk(upload, offset, request)
+        except uploads.OffsetMismatch as e:
+            response = JsonResponse(upload_state(upload), status=409)
+            response["Upload-Offset"] = str(e.offset)
+            return response
+        except uploads.UploadTooLarge as e:
+            return JsonResponse({"error": str(e)}, status=413)
+        response = HttpResponse(status=204)
+    else:
+        response = JsonResponse(upload_state(upload))
+
+    response["Upload-Offset"] = str(upload.offset)
+    response["Upload-Length"] = str(upload.size)
+    response["Cache-Control"] = "no-store"
+    return response
+
+
+@require_POST
+def finalize_upload(request, upload_id):
+    """Create the File for a complete upload."""
+    upload = get_object_or_404(Upload, id=upload_id, owner=request.user.pk)
+    if upload.file_id:
+        return JsonResponse(upload_state(upload))
+    if upload.offset != upload.size:
+        return JsonResponse(
+            {"error": f"Upload incomplete: {upload.offset}/{upload.size} bytes"},
+            status=400,
+        )
+    try:
+        uploads.finalize(upload)
+    except ValidationError as e:
+        return JsonResponse({"error": e.messages}, status=409)
+    return JsonResponse(upload_state(upload), status=201)
+
+
 def manage_collections(request):
     collections = Collection.objects.filter(owner=request.user)
 
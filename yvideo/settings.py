@@ -87,6 +87,17 @@ DATABASES = {
     }
 }
 
+# Seen by every process: holds the OIT token refresh lock and cached OIT
+# lookups (see core/api.py) and repeat view markers (see core/view_counts.py).
+# `manage.py migrate` creates its table; point it at Redis or memcached to
+# take the load off the database.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "yvideo_cache",
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -131,3 +142,140 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 MEDIA_ROOT = BASE_DIR / "media"
 MEDIA_URL = "/media/"
+
+# Media streaming
+# Serve /stream/ with the async view; enable when running under an ASGI server.
+STREAM_ASYNC = False
+# Block size for Python-level reads when the server has no sendfile support.
+STREAM_BLOCK_SIZE = 512 * 1024
+# None to stream from Django, "x-accel-redirect" (nginx) or "x-sendfile"
+# (Apache/lighttpd) to let the front-end server send media files.
+STREAM_OFFLOAD = None
+# Internal location nginx maps to MEDIA_ROOT when using X-Accel-Redirect.
+STREAM_OFFLOAD_PREFIX = "/protected-media/"
+
+# Cache blocks of streamed files on local disk (see core/chunk_cache.py); worth
+# enabling when MEDIA_ROOT is on NFS or other slow storage. Cached responses
+# are not sent with sendfile.
+STREAM_CHUNK_CACHE = False
+STREAM_CHUNK_CACHE_DIR = BASE_DIR / "cache" / "chunks"
+STREAM_CHUNK_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+# Size of cached blocks, and how much of the start of every file is cached
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_CHUNK_CACHE_HEAD = 8 * 1024 * 1024
+# Reads of a block beyond the head after which it is cached
+STREAM_CHUNK_CACHE_MIN_READS = 2
+
+# Per-process cache of resolved FileKeys for /stream/ (see core/stream_cache.py):
+# number of entries, and seconds before an entry is looked up again.
+STREAM_METADATA_CACHE_SIZE = 1024
+STREAM_METADATA_CACHE_TTL = 60
+
+# Lifetime in seconds of the signed stream URLs minted by the player (see
+# core/stream_tokens.py); it should outlast a viewing session.
+STREAM_TOKEN_MAX_AGE = 6 * 60 * 60
+
+# Bandwidth and concurrency limits for /stream/ (see core/throttle.py). Limits
+# are shared by the worker processes of one host through STREAM_THROTTLE_DB.
+# Paced responses are not sent with sendfile; with STREAM_OFFLOAD, shape
+# bandwidth in the front-end server instead.
+STREAM_THROTTLE = False
+STREAM_THROTTLE_DB = BASE_DIR / "throttle.sqlite3"
+# Bytes per second for all streams together and for each user. Each active
+# user also gets no more than an equal share of the global rate.
+STREAM_GLOBAL_RATE = 100 * 1024 * 1024
+STREAM_USER_RATE = 4 * 1024 * 1024
+# Seconds of unused bandwidth a bucket may save up for bursts
+STREAM_BURST_SECONDS = 4
+STREAM_MAX_STREAMS_PER_USER = 6
+STREAM_MAX_STREAMS_PER_FILE_KEY = 3
+# Seconds without sending after which a stream no longer counts as active
+STREAM_IDLE_TIMEOUT = 30
+# Seconds between a stream's updates of the shared buckets; bytes sent in
+# between are taken from them together.
+STREAM_THROTTLE_INTERVAL = 0.25
+
+# Store media once per checksum under MEDIA_ROOT/objects/, with readable hard
+# links under MEDIA_ROOT/by-name/ (see core/storage.py). Requires checksums to
+# be computed inline, i.e. CHECKSUM_IN_BACKGROUND = False.
+MEDIA_CONTENT_ADDRESSED = False
+
+# Upload checksums
+# Block size for hashing uploads that are not backed by a file on disk.
+CHECKSUM_BUFFER_SIZE = 8 * 1024 * 1024
+# Hash uploads in a "checksum" job instead of while validating them.
+# Duplicate content then fails the job rather than the upload.
+CHECKSUM_IN_BACKGROUND = False
+
+# Resumable uploads (see core/uploads.py)
+UPLOAD_CHUNK_DIR = BASE_DIR / "uploads"
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# Days after which unfinished uploads are removed by `manage.py clean_uploads`
+UPLOAD_EXPIRE_DAYS = 7
+
+# Background jobs (see core/jobs.py and `manage.py run_workers`)
+# Job kinds queued for every newly uploaded File.
+FILE_PROCESSING_JOBS = ["probe_duration", "seek_index", "segment_hls"]
+JOB_MAX_ATTEMPTS = 3
+# Seconds before a failed job is retried; doubles with each attempt.
+JOB_RETRY_DELAY = 60
+# Seconds after which a running job is assumed to belong to a dead worker.
+JOB_STALE_AFTER = 6 * 60 * 60
+JOB_POLL_INTERVAL = 2
+
+# Rewrite MP4 files with a trailing moov box to faststart layout while
+# indexing them; the other FILE_PROCESSING_JOBS then wait for the
+# "seek_index" job. Ignored with MEDIA_CONTENT_ADDRESSED, whose objects are
+# immutable.
+MP4_FASTSTART = False
+
+# Length in seconds of HLS segments (see core/hls.py)
+HLS_SEGMENT_DURATION = 6
+
+# View counting (see core/view_counts.py): seconds between writes of buffered
+# counts, and seconds during which repeat views by a viewer are not counted.
+VIEW_COUNT_FLUSH_INTERVAL = 10
+VIEW_COUNT_DEDUPE_SECONDS = 30 * 60
+
+# Playback analytics (see core/analytics.py): raw event partitions, the most
+# events accepted per post, the player's heartbeat interval and the width of
+# watch histogram buckets, in seconds. Positions past ANALYTICS_MAX_POSITION
+# seconds are rejected, which bounds the size of a histogram.
+ANALYTICS_DIR = BASE_DIR / "analytics"
+ANALYTICS_MAX_BATCH = 500
+ANALYTICS_MAX_POSITION = 12 * 60 * 60
+ANALYTICS_HEARTBEAT_SECONDS = 5
+ANALYTICS_BUCKET_SECONDS = 10
+
+# Censor boxes in annotations are interpolated to this many frames per second,
+# eased between keyframes with one of core.interpolation.EASINGS by default.
+ANNOTATION_INTERPOLATION_FPS = 30
+ANNOTATION_INTERPOLATION_EASING = "linear"
+
+# OIT API client (see core/api.py): (connect, read) timeouts in seconds,
+# retries with exponential backoff, pooled connections per host and the most
+# lookups run at once.
+API_TIMEOUT = (3.05, 10)
+API_RETRIES = 3
+API_RETRY_BACKOFF = 0.5
+API_POOL_SIZE = 10
+API_MAX_CONCURRENCY = 8
+# Bearer token lifetime when OIT does not say, how long before expiry it is
+# refreshed, and how long other processes wait for a refresh in progress.
+API_TOKEN_LIFETIME = 60 * 60
+API_TOKEN_REFRESH_MARGIN = 5 * 60
+API_TOKEN_REFRESH_WAIT = 15
+# Seconds OIT lookups are cached for (0 disables caching of a lookup), and how
+# long callers wait for another process to fetch a missing entry.
+API_CACHE_TTLS = {
+    "year_terms": 24 * 60 * 60,
+    "worker_id": 24 * 60 * 60,
+    "worker_summary": 24 * 60 * 60,
+    "student_summary": 24 * 60 * 60,
+    "student_enrollments": 60 * 60,
+}
+API_CACHE_LOCK_TIMEOUT = 15
+
+# Command line tools used for media processing
+FFMPEG_BINARY = "ffmpeg"
+FFPROBE_BINARY = "ffprobe"